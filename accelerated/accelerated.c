@@ -98,7 +98,7 @@ int varint_decode(unsigned PY_LONG_LONG *result,
     }
 
     shift += 7;
-  } while (shift < 64);
+  }
 
   // Error decoding varint - buffer too short.
   return 0;
@@ -309,6 +309,475 @@ error:
   return NULL;
 }
 
+// Kinds of decode plan entries. These must match the PLAN_* constants in
+// grr/lib/rdfvalues/structs.py.
+#define PLAN_SINGLE 0
+#define PLAN_REPEATED 1
+#define PLAN_PACKED 2
+
+
+// Read the next field off the buffer. On success the encoded tag, encoded
+// length and data are returned as new references and the number of consumed
+// bytes is stored in consumed. Returns 0 and sets an exception on error.
+static int read_field(const char *buffer, Py_ssize_t length,
+                      PyObject **encoded_tag, PyObject **encoded_length,
+                      PyObject **data, Py_ssize_t *consumed) {
+  Py_ssize_t tag_length = 0;
+  Py_ssize_t prefix_length = 0;
+  Py_ssize_t data_length = 0;
+  unsigned PY_LONG_LONG tag;
+  unsigned PY_LONG_LONG value;
+
+  if (!varint_decode(&tag, buffer, length, &tag_length)) {
+    PyErr_SetString(PyExc_ValueError, "Invalid tag");
+    return 0;
+  }
+
+  switch (tag & TAG_TYPE_MASK) {
+    case WIRETYPE_VARINT:
+      if (!varint_decode(&value, buffer + tag_length, length - tag_length,
+                         &data_length)) {
+        PyErr_SetString(PyExc_ValueError, "Invalid varint");
+        return 0;
+      }
+      break;
+
+    case WIRETYPE_FIXED64:
+      data_length = 8;
+      break;
+
+    case WIRETYPE_FIXED32:
+      data_length = 4;
+      break;
+
+    case WIRETYPE_LENGTH_DELIMITED:
+      if (!varint_decode(&value, buffer + tag_length, length - tag_length,
+                         &prefix_length)) {
+        PyErr_SetString(PyExc_ValueError, "Invalid length");
+        return 0;
+      }
+
+      if (value > (unsigned PY_LONG_LONG)(length - tag_length - prefix_length)) {
+        PyErr_SetString(
+            PyExc_ValueError, "Length tag exceeds available buffer.");
+        return 0;
+      }
+
+      data_length = (Py_ssize_t)value;
+      break;
+
+    default:
+      PyErr_SetString(PyExc_ValueError, "Unexpected Tag");
+      return 0;
+  }
+
+  if (tag_length + prefix_length + data_length > length) {
+    PyErr_SetString(PyExc_ValueError, "Field exceeds available buffer.");
+    return 0;
+  }
+
+  *encoded_tag = PyString_FromStringAndSize(buffer, tag_length);
+  *encoded_length = PyString_FromStringAndSize(
+      buffer + tag_length, prefix_length);
+  *data = PyString_FromStringAndSize(
+      buffer + tag_length + prefix_length, data_length);
+
+  if (!*encoded_tag || !*encoded_length || !*data) {
+    Py_XDECREF(*encoded_tag);
+    Py_XDECREF(*encoded_length);
+    Py_XDECREF(*data);
+    return 0;
+  }
+
+  *consumed = tag_length + prefix_length + data_length;
+  return 1;
+}
+
+
+// Append a (None, wire_format) entry to the list for name in repeated. Steals
+// the reference to wire_format. Returns 0 on error.
+static int append_repeated(PyObject *repeated, PyObject *name,
+                           PyObject *wire_format) {
+  PyObject *entries = PyDict_GetItem(repeated, name);
+  PyObject *entry = NULL;
+  int result = 0;
+
+  if (!entries) {
+    entries = PyList_New(0);
+    if (!entries || PyDict_SetItem(repeated, name, entries) < 0) {
+      Py_XDECREF(entries);
+      Py_DECREF(wire_format);
+      return 0;
+    }
+    Py_DECREF(entries);
+  }
+
+  Py_INCREF(Py_None);
+  entry = PyTuple_New(2);
+  if (!entry) {
+    Py_DECREF(Py_None);
+    Py_DECREF(wire_format);
+    return 0;
+  }
+  PyTuple_SET_ITEM(entry, 0, Py_None);
+  PyTuple_SET_ITEM(entry, 1, wire_format);
+
+  result = PyList_Append(entries, entry) == 0;
+  Py_DECREF(entry);
+  return result;
+}
+
+
+// Unpack the elements of a packed repeated field into repeated. Returns 0 on
+// error.
+static int append_packed(PyObject *repeated, PyObject *name,
+                         PyObject *element_tag, PyObject *packed) {
+  const char *buffer = PyString_AS_STRING(packed);
+  Py_ssize_t length = PyString_GET_SIZE(packed);
+  int wire_type;
+
+  if (!PyString_Check(element_tag) || PyString_GET_SIZE(element_tag) == 0) {
+    PyErr_SetString(PyExc_ValueError, "Invalid packed element tag.");
+    return 0;
+  }
+  wire_type = ((unsigned char)PyString_AS_STRING(element_tag)[0]) &
+      TAG_TYPE_MASK;
+
+  while (length > 0) {
+    Py_ssize_t element_length = 0;
+    unsigned PY_LONG_LONG value;
+    PyObject *wire_format = NULL;
+
+    switch (wire_type) {
+      case WIRETYPE_VARINT:
+        if (!varint_decode(&value, buffer, length, &element_length)) {
+          PyErr_SetString(PyExc_ValueError, "Invalid varint");
+          return 0;
+        }
+        break;
+
+      case WIRETYPE_FIXED64:
+        element_length = 8;
+        break;
+
+      case WIRETYPE_FIXED32:
+        element_length = 4;
+        break;
+
+      default:
+        PyErr_SetString(PyExc_ValueError, "Unexpected packed wire type.");
+        return 0;
+    }
+
+    if (element_length > length) {
+      PyErr_SetString(PyExc_ValueError, "Invalid packed field length.");
+      return 0;
+    }
+
+    wire_format = PyTuple_New(3);
+    if (!wire_format)
+      return 0;
+
+    Py_INCREF(element_tag);
+    PyTuple_SET_ITEM(wire_format, 0, element_tag);
+    PyTuple_SET_ITEM(wire_format, 1, PyString_FromStringAndSize(buffer, 0));
+    PyTuple_SET_ITEM(wire_format, 2,
+                     PyString_FromStringAndSize(buffer, element_length));
+
+    if (!PyTuple_GET_ITEM(wire_format, 1) ||
+        !PyTuple_GET_ITEM(wire_format, 2)) {
+      Py_DECREF(wire_format);
+      return 0;
+    }
+
+    if (!append_repeated(repeated, name, wire_format))
+      return 0;
+
+    buffer += element_length;
+    length -= element_length;
+  }
+
+  return 1;
+}
+
+
+PyObject *py_decode_with_plan(PyObject *self, PyObject *args,
+                              PyObject *kwargs) {
+  char *buffer;
+  Py_ssize_t buffer_len = 0;
+  Py_ssize_t length = 0;
+  Py_ssize_t index = 0;
+  Py_ssize_t count = 0;
+  PyObject *plan = NULL;
+  PyObject *raw_data = NULL;
+  PyObject *repeated = NULL;
+  static const char *kwlist[] = {"buffer", "plan", "raw_data", "index",
+                                 "length", NULL};
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s#O!O!|nn", (char **)kwlist,
+                                   &buffer, &buffer_len, &PyDict_Type, &plan,
+                                   &PyDict_Type, &raw_data, &index, &length))
+    return NULL;
+
+  if (index < 0 || length < 0 || index > buffer_len) {
+    PyErr_SetString(PyExc_ValueError, "Invalid parameters.");
+    return NULL;
+  }
+
+  // Like SplitBuffer() the length is the position to stop parsing at.
+  if (length == 0 || length > buffer_len)
+    length = buffer_len;
+
+  repeated = PyDict_New();
+  if (!repeated)
+    return NULL;
+
+  while (index < length) {
+    PyObject *encoded_tag = NULL;
+    PyObject *encoded_length = NULL;
+    PyObject *data = NULL;
+    PyObject *wire_format = NULL;
+    PyObject *entry = NULL;
+    Py_ssize_t consumed = 0;
+    long kind;
+
+    if (!read_field(buffer + index, length - index, &encoded_tag,
+                    &encoded_length, &data, &consumed))
+      goto error;
+
+    index += consumed;
+
+    // Borrowed reference.
+    entry = PyDict_GetItem(plan, encoded_tag);
+
+    if (entry && !(PyTuple_Check(entry) && PyTuple_GET_SIZE(entry) == 4)) {
+      PyErr_SetString(PyExc_ValueError, "Invalid decode plan entry.");
+      Py_DECREF(encoded_tag);
+      Py_DECREF(encoded_length);
+      Py_DECREF(data);
+      goto error;
+    }
+
+    kind = entry ? PyInt_AsLong(PyTuple_GET_ITEM(entry, 2)) : PLAN_SINGLE;
+    if (kind == -1 && PyErr_Occurred()) {
+      Py_DECREF(encoded_tag);
+      Py_DECREF(encoded_length);
+      Py_DECREF(data);
+      goto error;
+    }
+
+    if (entry && kind == PLAN_PACKED) {
+      int ok = append_packed(repeated, PyTuple_GET_ITEM(entry, 0),
+                             PyTuple_GET_ITEM(entry, 3), data);
+      Py_DECREF(encoded_tag);
+      Py_DECREF(encoded_length);
+      Py_DECREF(data);
+      if (!ok)
+        goto error;
+      continue;
+    }
+
+    // Steals the references.
+    wire_format = PyTuple_New(3);
+    if (!wire_format) {
+      Py_DECREF(encoded_tag);
+      Py_DECREF(encoded_length);
+      Py_DECREF(data);
+      goto error;
+    }
+    PyTuple_SET_ITEM(wire_format, 0, encoded_tag);
+    PyTuple_SET_ITEM(wire_format, 1, encoded_length);
+    PyTuple_SET_ITEM(wire_format, 2, data);
+
+    if (entry && kind == PLAN_REPEATED) {
+      if (!append_repeated(repeated, PyTuple_GET_ITEM(entry, 0), wire_format))
+        goto error;
+
+    } else {
+      // Unknown fields are stored under a unique integer key, known fields
+      // under their name.
+      PyObject *key = NULL;
+      PyObject *value = NULL;
+      int result;
+
+      if (entry) {
+        key = PyTuple_GET_ITEM(entry, 0);
+        Py_INCREF(key);
+        value = Py_BuildValue("(OOO)", Py_None, wire_format,
+                              PyTuple_GET_ITEM(entry, 1));
+      } else {
+        key = PyInt_FromSsize_t(count++);
+        value = Py_BuildValue("(OOO)", Py_None, wire_format, Py_None);
+      }
+      Py_DECREF(wire_format);
+
+      if (!key || !value) {
+        Py_XDECREF(key);
+        Py_XDECREF(value);
+        goto error;
+      }
+
+      result = PyDict_SetItem(raw_data, key, value);
+      Py_DECREF(key);
+      Py_DECREF(value);
+      if (result < 0)
+        goto error;
+    }
+  }
+
+  return repeated;
+
+error:
+  Py_DECREF(repeated);
+  return NULL;
+}
+
+
+// Interned method names used by the serializer.
+static PyObject *is_dirty_name = NULL;
+static PyObject *convert_to_wire_format_name = NULL;
+static PyObject *tobytes_name = NULL;
+
+
+// Returns the wire format of a raw data entry as a new reference. This calls
+// back into the type descriptor only if the entry has no valid wire format.
+static PyObject *get_wire_format(PyObject *entry) {
+  PyObject *python_format;
+  PyObject *wire_format;
+  PyObject *type_descriptor;
+  int convert;
+
+  if (!PyTuple_Check(entry) || PyTuple_GET_SIZE(entry) != 3) {
+    PyErr_SetString(PyExc_TypeError, "Raw data entries must be 3-tuples.");
+    return NULL;
+  }
+
+  python_format = PyTuple_GET_ITEM(entry, 0);
+  wire_format = PyTuple_GET_ITEM(entry, 1);
+  type_descriptor = PyTuple_GET_ITEM(entry, 2);
+
+  convert = wire_format == Py_None;
+
+  // A python format which was modified since decoding must be re-encoded.
+  if (!convert && python_format != Py_None) {
+    int truth = PyObject_IsTrue(python_format);
+    if (truth < 0)
+      return NULL;
+
+    if (truth) {
+      PyObject *dirty = PyObject_CallMethodObjArgs(
+          type_descriptor, is_dirty_name, python_format, NULL);
+      if (!dirty)
+        return NULL;
+
+      convert = PyObject_IsTrue(dirty);
+      Py_DECREF(dirty);
+      if (convert < 0)
+        return NULL;
+    }
+  }
+
+  if (convert) {
+    return PyObject_CallMethodObjArgs(
+        type_descriptor, convert_to_wire_format_name, python_format, NULL);
+  }
+
+  Py_INCREF(wire_format);
+  return wire_format;
+}
+
+
+PyObject *py_serialize_entries(PyObject *self, PyObject *entries) {
+  PyObject *iterator = NULL;
+  PyObject *parts = NULL;
+  PyObject *entry = NULL;
+  PyObject *result = NULL;
+  Py_ssize_t total_length = 0;
+  Py_ssize_t i;
+  char *output;
+
+  iterator = PyObject_GetIter(entries);
+  if (!iterator)
+    return NULL;
+
+  parts = PyList_New(0);
+  if (!parts)
+    goto error;
+
+  // First collect all the encoded parts so we can allocate the output once.
+  while ((entry = PyIter_Next(iterator))) {
+    PyObject *wire_format = get_wire_format(entry);
+    PyObject *fast = NULL;
+    Py_ssize_t j;
+
+    Py_DECREF(entry);
+    if (!wire_format)
+      goto error;
+
+    fast = PySequence_Fast(wire_format, "Wire format must be a sequence.");
+    Py_DECREF(wire_format);
+    if (!fast)
+      goto error;
+
+    for (j = 0; j < PySequence_Fast_GET_SIZE(fast); j++) {
+      PyObject *part = PySequence_Fast_GET_ITEM(fast, j);
+
+      // Data decoded from a memoryview is only copied when it is written out.
+      if (PyMemoryView_Check(part)) {
+        part = PyObject_CallMethodObjArgs(part, tobytes_name, NULL);
+        if (!part) {
+          Py_DECREF(fast);
+          goto error;
+        }
+      } else {
+        Py_INCREF(part);
+      }
+
+      if (!PyString_Check(part)) {
+        PyErr_SetString(PyExc_TypeError, "Wire format parts must be strings.");
+        Py_DECREF(part);
+        Py_DECREF(fast);
+        goto error;
+      }
+
+      total_length += PyString_GET_SIZE(part);
+      if (PyList_Append(parts, part) < 0) {
+        Py_DECREF(part);
+        Py_DECREF(fast);
+        goto error;
+      }
+      Py_DECREF(part);
+    }
+    Py_DECREF(fast);
+  }
+
+  if (PyErr_Occurred())
+    goto error;
+
+  result = PyString_FromStringAndSize(NULL, total_length);
+  if (!result)
+    goto error;
+
+  output = PyString_AS_STRING(result);
+  for (i = 0; i < PyList_GET_SIZE(parts); i++) {
+    PyObject *part = PyList_GET_ITEM(parts, i);
+    Py_ssize_t part_length = PyString_GET_SIZE(part);
+
+    memcpy(output, PyString_AS_STRING(part), part_length);
+    output += part_length;
+  }
+
+  Py_DECREF(parts);
+  Py_DECREF(iterator);
+  return result;
+
+error:
+  Py_XDECREF(parts);
+  Py_DECREF(iterator);
+  return NULL;
+}
+
+
 /* Retrieves the semantic protobuf version
  * Returns a Python object if successful or NULL on error
  */
@@ -340,11 +809,28 @@ static PyMethodDef _semantic_methods[] = {
      METH_VARARGS | METH_KEYWORDS,
      "Split a buffer into tags and wire format data."},
 
+    {"decode_with_plan",
+     (PyCFunction)py_decode_with_plan,
+     METH_VARARGS | METH_KEYWORDS,
+     "Decode a buffer into a raw data dict following a decode plan."},
+
+    {"serialize_entries",
+     (PyCFunction)py_serialize_entries,
+     METH_O,
+     "Serialize raw data entries into a wire format buffer."},
+
     {NULL}  /* Sentinel */
 };
 
 
 PyMODINIT_FUNC init_semantic(void) {
+  is_dirty_name = PyString_InternFromString("IsDirty");
+  convert_to_wire_format_name = PyString_InternFromString(
+      "ConvertToWireFormat");
+  tobytes_name = PyString_InternFromString("tobytes");
+  if (!is_dirty_name || !convert_to_wire_format_name || !tobytes_name)
+    return;
+
   /* create module */
   Py_InitModule3("_semantic", _semantic_methods,
                  "Semantic Protobuf accelerator.");
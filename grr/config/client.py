@@ -226,6 +226,17 @@ config_lib.DEFINE_integer(
     "Network.api", 3, "The version of the network protocol the client "
     "uses.")
 
+config_lib.DEFINE_string(
+    "Network.compression", "ZCOMPRESSION",
+    "The PackedMessageList.CompressionType used for message bundles. It is "
+    "only used if the receiving end supports it, otherwise bundles are sent "
+    "uncompressed.")
+
+config_lib.DEFINE_integer(
+    "Network.compression_level", 6,
+    "The zlib compression level for message bundles. 1 is several times "
+    "faster than the default 6 at a slightly lower compression ratio.")
+
 # Installer options.
 config_lib.DEFINE_string(
     name="Installer.logfile",
@@ -24,6 +24,46 @@ config_lib.DEFINE_bool(
     "Database.useForReads.approvals", False,
     "Use relational database for reading approvals information.")
 
+config_lib.DEFINE_integer(
+    "Datastore.mutation_pool_max_records", 0,
+    "Number of pending mutations after which a mutation pool is flushed "
+    "automatically. 0 means no limit.")
+
+config_lib.DEFINE_integer(
+    "Datastore.mutation_pool_max_bytes", 0,
+    "Estimated size in bytes of pending writes after which a mutation pool "
+    "is flushed automatically. 0 means no limit.")
+
+config_lib.DEFINE_float(
+    "Datastore.mutation_pool_flush_interval", 0,
+    "Maximum time in seconds pending mutations are kept in a mutation pool "
+    "before a background thread flushes them. 0 disables background "
+    "flushing.")
+
+config_lib.DEFINE_integer(
+    "Datastore.read_cache_size", 0,
+    "Number of subjects kept in the process local read cache in front of "
+    "the data store. 0 disables the cache.")
+
+config_lib.DEFINE_float(
+    "Datastore.read_cache_max_age", 5,
+    "Maximum age in seconds of cached data store reads. This bounds how "
+    "long writes made by other processes may go unnoticed.")
+
+config_lib.DEFINE_list(
+    "Datastore.read_cache_subjects", [r"aff4:/C\.[0-9a-fA-F]\{16\}$",
+                                      r"aff4:/foreman$"],
+    "Regular expressions matching the subjects whose reads may be cached.")
+
+config_lib.DEFINE_integer(
+    "Datastore.scan_page_size", 1000,
+    "Number of subjects initially read per page when scanning attributes. "
+    "The page size adapts to the size of the values read.")
+
+config_lib.DEFINE_integer(
+    "Datastore.scan_max_page_bytes", 16 * 1024 * 1024,
+    "Approximate maximum size in bytes of a single page of scan results.")
+
 DATASTORE_PATHING = [
     r"%{(?P<path>files/hash/generic/sha256/...).*}",
     r"%{(?P<path>files/hash/generic/sha1/...).*}",
@@ -137,6 +177,18 @@ config_lib.DEFINE_integer(
     10,
     help="Maximum number of retries (happens in case a query fails).")
 
+config_lib.DEFINE_integer(
+    "Mysql.multi_resolve_batch_size",
+    200,
+    help=("Number of subjects MultiResolvePrefix reads with a single "
+          "query."))
+
+config_lib.DEFINE_integer(
+    "Mysql.multi_resolve_parallelism",
+    4,
+    help=("Maximum number of MultiResolvePrefix batches read concurrently. "
+          "This is capped by Mysql.conn_pool_max."))
+
 # CloudBigTable data store.
 config_lib.DEFINE_string(
     "CloudBigtable.project_id",
@@ -33,10 +33,45 @@ config_lib.DEFINE_integer(
 config_lib.DEFINE_integer("Threadpool.size", 50,
                           "Number of threads in the shared thread pool.")
 
+config_lib.DEFINE_float(
+    "Threadpool.max_queueing_time", 1.0,
+    "The worker's thread pool grows when tasks wait longer than this many "
+    "seconds on average while its threads are mostly blocked on I/O. 0 "
+    "disables this and the pool only grows when its queue is full.")
+
 config_lib.DEFINE_integer(
     "Worker.queue_shards", 5, "Queue notifications will be sharded across "
     "this number of datastore subjects.")
 
+config_lib.DEFINE_integer(
+    "Worker.flow_batch_size", 50,
+    "Number of flows a worker locks and reads the completed requests of in "
+    "a single data store round trip. 1 processes flows one by one.")
+
+config_lib.DEFINE_string(
+    "Worker.notification_bus_class", "NotificationBus",
+    "The notification bus used to wake up workers when new notifications "
+    "are written. The default bus delivers nothing, so workers poll. "
+    "UnixSocketNotificationBus wakes up workers running on the same machine "
+    "as the writer, LocalNotificationBus only works within one process.")
+
+config_lib.DEFINE_string(
+    "Worker.notification_bus_path",
+    "%(Config.prefix)/var/run/grr/notification_bus",
+    "Directory holding the sockets of UnixSocketNotificationBus subscribers.")
+
+config_lib.DEFINE_integer(
+    "Worker.process_pool_size", 0,
+    "Number of processes the worker runs artifact parsers and checks in, so "
+    "that they do not hold the GIL while other flows are processed. 0 runs "
+    "them in the worker threads.")
+
+config_lib.DEFINE_integer(
+    "Worker.flow_state_offload_size", 64 * 1024,
+    "Flow state fields larger than this many bytes are stored in their own "
+    "data store attributes. They are only written when they change and only "
+    "read when the flow uses them.")
+
 config_lib.DEFINE_list(
     "Frontend.well_known_flows", ["TransferStore", "Stats"],
     "Allow these well known flows to run directly on the "
@@ -93,6 +128,17 @@ config_lib.DEFINE_string("Frontend.bind_address", "::",
 
 config_lib.DEFINE_integer("Frontend.bind_port", 8080, "The port to bind.")
 
+config_lib.DEFINE_bool(
+    "Frontend.event_loop", False,
+    "Serve clients from a single event loop thread instead of a thread per "
+    "connection, so that many more clients can be connected at once.")
+
+config_lib.DEFINE_integer(
+    "Frontend.event_loop_threads", 50,
+    "Number of threads handling the requests received by the event loop. "
+    "While all of them are busy and as many requests are waiting, no new "
+    "connections are accepted and further requests are answered with 503.")
+
 config_lib.DEFINE_integer(
     "Frontend.port_max", None,
     "If set and Frontend.bind_port is in use, attempt to "
@@ -103,6 +149,57 @@ config_lib.DEFINE_integer(
     "Frontend.max_queue_size", 500,
     "Maximum number of messages to queue for the client.")
 
+config_lib.DEFINE_integer(
+    "Frontend.empty_queue_cache_size", 0,
+    "Number of client task queues the frontend remembers as empty, so polls "
+    "from these clients do not read the data store. Tasks scheduled for such "
+    "a client are only picked up on the next sync of the cache, up to a "
+    "second later. 0 disables the cache.")
+
+config_lib.DEFINE_integer(
+    "Frontend.remote_cipher_cache_size", 50000,
+    "Number of clients the frontend keeps the cipher for messages sent to "
+    "them, so that it does not have to do RSA operations for every poll.")
+
+config_lib.DEFINE_semantic_value(
+    rdfvalue.Duration,
+    "Frontend.remote_cipher_max_age",
+    default="1d",
+    description="The cipher for messages sent to a client is replaced with a "
+    "new one after this time.")
+
+config_lib.DEFINE_float(
+    "Frontend.ping_update_interval", 0,
+    "Seconds between writes of the ping time, clock and ip of clients that "
+    "sent messages. Only the newest values of every client are written, so "
+    "the stored values lag behind by up to this long. 0 writes them for "
+    "every client poll right away.")
+
+config_lib.DEFINE_integer(
+    "Frontend.process_pool_size", 0,
+    "Number of processes the frontend decrypts and decompresses large "
+    "message bundles in, so that they do not hold the GIL while other client "
+    "polls are handled. 0 decodes them in the request threads.")
+
+config_lib.DEFINE_integer(
+    "Frontend.process_pool_min_bundle_size", 256 * 1024,
+    "Encrypted message bundles of at least this many bytes are decoded in "
+    "the frontend process pool, smaller ones are not worth the round trip.")
+
+config_lib.DEFINE_float(
+    "Frontend.queue_write_window", 0,
+    "Seconds the frontend waits for more client messages to arrive before "
+    "writing them to the flow queues, so that messages received at the same "
+    "time are written together. 0 writes the messages of every client poll "
+    "right away.")
+
+config_lib.DEFINE_float(
+    "Frontend.task_lease_window", 0,
+    "Seconds the frontend waits for more clients to poll before leasing "
+    "tasks from their queues, so that the task queues of clients polling at "
+    "the same time are leased together. 0 leases the tasks of every client "
+    "poll right away.")
+
 config_lib.DEFINE_integer(
     "Frontend.max_retransmission_time", 10,
     "Maximum number of times we are allowed to "
@@ -133,6 +230,16 @@ config_lib.DEFINE_string("Server.ip_resolver_class", "IPResolver",
 config_lib.DEFINE_string("Server.email_alerter_class", "SMTPEmailAlerter",
                          "The email alerter class to use.")
 
+config_lib.DEFINE_float(
+    "Tracing.sample_rate", 0.0,
+    "Fraction of flows whose processing is traced through the frontend, "
+    "queue manager, worker and flow runner. Traces are served as JSON on "
+    "/traces by the stats server. 0 disables tracing.")
+
+config_lib.DEFINE_integer(
+    "Tracing.max_spans", 10000,
+    "Number of finished tracing spans each process keeps in memory.")
+
 config_lib.DEFINE_string(
     "Rekall.profile_repository",
     "https://github.com/google/rekall-profiles/raw/master",
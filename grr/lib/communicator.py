@@ -6,6 +6,7 @@ import time
 import zlib
 
 
+from grr import config
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import stats
@@ -14,6 +15,8 @@ from grr.lib import utils
 
 from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import protodict as rdf_protodict
+from grr.lib.rdfvalues import structs as rdf_structs
 
 
 class CommunicatorInit(registry.InitHook):
@@ -30,6 +33,8 @@ class CommunicatorInit(registry.InitHook):
 
     stats.STATS.RegisterCounterMetric(
         "grr_encrypted_cipher_cache", fields=[("type", str)])
+    stats.STATS.RegisterCounterMetric(
+        "grr_remote_cipher_cache", fields=[("type", str)])
 
 
 class Error(stats.CountingExceptionMixin, Exception):
@@ -256,6 +261,110 @@ class ReceivedCipher(Cipher):
       return True
 
 
+class MessageListCompressor(object):
+  """A compression scheme for the message data of a PackedMessageList.
+
+  Compressors are registered by their PackedMessageList.CompressionType. A
+  compressor is only used for bundles sent to endpoints speaking at least its
+  min_api_version, so new schemes can be added without breaking older
+  endpoints.
+  """
+  __metaclass__ = registry.MetaclassRegistry
+  __abstract = True  # pylint: disable=g-bad-name
+
+  compression_type = None
+  min_api_version = 3
+
+  def Compress(self, data):
+    raise NotImplementedError()
+
+  def Decompress(self, data):
+    raise NotImplementedError()
+
+  @classmethod
+  def GetCompressor(cls, compression_type):
+    """Returns the compressor for compression_type.
+
+    Args:
+      compression_type: A PackedMessageList.CompressionType.
+
+    Returns:
+      A MessageListCompressor instance.
+
+    Raises:
+      DecodingError: If the compression type is not supported.
+    """
+    for compressor_cls in cls.classes.itervalues():
+      if compressor_cls.compression_type == compression_type:
+        return compressor_cls()
+    raise DecodingError("Compression scheme not supported")
+
+
+class NoCompression(MessageListCompressor):
+  """Sends the message data as is."""
+
+  compression_type = rdf_flows.PackedMessageList.CompressionType.UNCOMPRESSED
+
+  def Compress(self, data):
+    return data
+
+  def Decompress(self, data):
+    return data
+
+
+class ZlibCompression(MessageListCompressor):
+  """Compresses the message data with zlib.
+
+  The compression level is taken from Network.compression_level. Low levels
+  are several times faster than the zlib default and need no support from the
+  receiving end, any level is decompressed the same way.
+  """
+
+  compression_type = rdf_flows.PackedMessageList.CompressionType.ZCOMPRESSION
+
+  def Compress(self, data):
+    return zlib.compress(data, config.CONFIG["Network.compression_level"])
+
+  def Decompress(self, data):
+    try:
+      return zlib.decompress(data)
+    except zlib.error as e:
+      raise DecodingError("Failed to decompress: %s" % e)
+
+
+def DecryptMessageList(cipher_properties, encrypted, packet_iv):
+  """Decrypts and decompresses a message bundle.
+
+  This is the CPU heavy part of decoding a bundle. It only depends on its
+  arguments, so it can be run in another process.
+
+  Args:
+    cipher_properties: The CipherProperties the bundle was encrypted with.
+    encrypted: The encrypted PackedMessageList.
+    packet_iv: The IV the bundle was encrypted with.
+
+  Returns:
+    A tuple of the PackedMessageList, without its message data, and the
+    MessageList it held.
+
+  Raises:
+    DecryptionError: If the bundle can not be decrypted.
+    DecodingError: If the decrypted bundle can not be decoded.
+  """
+  key = rdf_crypto.EncryptionKey(cipher_properties.key)
+  iv = rdf_crypto.EncryptionKey(packet_iv)
+  plain = rdf_crypto.AES128CBCCipher(key, iv).Decrypt(encrypted)
+  try:
+    packed_message_list = rdf_flows.PackedMessageList.FromSerializedString(
+        plain)
+  except rdfvalue.DecodeError as e:
+    raise DecryptionError(str(e))
+
+  message_list = Communicator.DecompressMessageList(packed_message_list)
+  packed_message_list.message_list = None
+  return packed_message_list, message_list
+
+
 class Communicator(object):
   """A class responsible for encoding and decoding comms."""
   server_name = None
@@ -274,19 +383,55 @@ class Communicator(object):
     # A cache for encrypted ciphers
     self.encrypted_cipher_cache = utils.FastStore(max_size=50000)
 
+    # Ciphers for encrypting messages to remote endpoints, see
+    # _GetRemoteCipher(). Subclasses may set these up to enable caching.
+    self.remote_cipher_cache = None
+    self.remote_cipher_max_age = None
+
+  # Bundles carrying at least this fraction of their data in compressed
+  # DataBlobs, e.g. the file chunks sent by TransferBuffer, are not compressed
+  # again.
+  COMPRESSED_BLOB_RATIO = 0.5
+
+  @classmethod
+  def _IsMostlyCompressedBlobs(cls, message_list, data_size):
+    """Checks if compressing the serialized message_list is pointless."""
+    blob_size = 0
+    for message in message_list.job:
+      if message.args_rdf_name != rdf_protodict.DataBlob.__name__:
+        continue
+      blob = message.payload
+      if (blob.compression !=
+          rdf_protodict.DataBlob.CompressionType.UNCOMPRESSED):
+        blob_size += len(blob.data)
+
+    return blob_size >= data_size * cls.COMPRESSED_BLOB_RATIO
+
   @classmethod
-  def EncodeMessageList(cls, message_list, packed_message_list):
-    """Encode the MessageList into the packed_message_list rdfvalue."""
+  def EncodeMessageList(cls, message_list, packed_message_list, api_version=3):
+    """Encode the MessageList into the packed_message_list rdfvalue.
+
+    Args:
+      message_list: The MessageList to encode.
+      packed_message_list: The PackedMessageList to fill in.
+      api_version: The api version of the receiving end, only compression
+        schemes it supports are used.
+    """
     # By default uncompress
     uncompressed_data = message_list.SerializeToString()
     packed_message_list.message_list = uncompressed_data
 
-    compressed_data = zlib.compress(uncompressed_data)
+    compressor = MessageListCompressor.GetCompressor(
+        config.CONFIG["Network.compression"])
+    if (compressor.min_api_version > api_version or
+        cls._IsMostlyCompressedBlobs(message_list, len(uncompressed_data))):
+      return
+
+    compressed_data = compressor.Compress(uncompressed_data)
 
     # Only compress if it buys us something.
     if len(compressed_data) < len(uncompressed_data):
-      packed_message_list.compression = (
-          rdf_flows.PackedMessageList.CompressionType.ZCOMPRESSION)
+      packed_message_list.compression = compressor.compression_type
       packed_message_list.message_list = compressed_data
 
   def _ClearServerCipherCache(self):
@@ -307,6 +452,40 @@ class Communicator(object):
     self.server_cipher_age = rdfvalue.RDFDatetime.Now()
     return self.server_cipher
 
+  def _GetRemoteCipher(self, destination):
+    """Returns the cipher for messages to the given destination.
+
+    Setting up a cipher takes an RSA signature and an RSA encryption. If
+    remote_cipher_cache is set, the cipher for a destination is reused until
+    it is remote_cipher_max_age old. The remote endpoint caches the ciphers it
+    receives as well, so it does not have to decrypt them again either.
+
+    Args:
+      destination: The CN of the remote system.
+
+    Returns:
+      A Cipher.
+    """
+    if self.remote_cipher_cache is not None:
+      try:
+        cipher, cipher_age = self.remote_cipher_cache.Get(str(destination))
+        if (cipher_age + self.remote_cipher_max_age >
+            rdfvalue.RDFDatetime.Now()):
+          stats.STATS.IncrementCounter(
+              "grr_remote_cipher_cache", fields=["hits"])
+          return cipher
+      except KeyError:
+        pass
+      stats.STATS.IncrementCounter("grr_remote_cipher_cache", fields=["misses"])
+
+    remote_public_key = self._GetRemotePublicKey(destination)
+    cipher = Cipher(self.common_name, self.private_key, remote_public_key)
+
+    if self.remote_cipher_cache is not None:
+      self.remote_cipher_cache.Put(
+          str(destination), (cipher, rdfvalue.RDFDatetime.Now()))
+    return cipher
+
   def EncodeMessages(self,
                      message_list,
                      result,
@@ -351,15 +530,15 @@ class Communicator(object):
       # it's the only cipher it ever uses.
       cipher = self._GetServerCipher()
     else:
-      remote_public_key = self._GetRemotePublicKey(destination)
-      cipher = Cipher(self.common_name, self.private_key, remote_public_key)
+      cipher = self._GetRemoteCipher(destination)
 
     # Make a nonce for this transaction
     if timestamp is None:
       self.timestamp = timestamp = long(time.time() * 1000000)
 
     packed_message_list = rdf_flows.PackedMessageList(timestamp=timestamp)
-    self.EncodeMessageList(message_list, packed_message_list)
+    self.EncodeMessageList(
+        message_list, packed_message_list, api_version=api_version)
 
     result.encrypted_cipher_metadata = cipher.encrypted_cipher_metadata
 
@@ -421,26 +600,25 @@ class Communicator(object):
     Raises:
       DecodingError: If decompression fails.
     """
-    compression = packed_message_list.compression
-    if compression == rdf_flows.PackedMessageList.CompressionType.UNCOMPRESSED:
-      data = packed_message_list.message_list
-
-    elif (compression ==
-          rdf_flows.PackedMessageList.CompressionType.ZCOMPRESSION):
-      try:
-        data = zlib.decompress(packed_message_list.message_list)
-      except zlib.error as e:
-        raise DecodingError("Failed to decompress: %s" % e)
-    else:
-      raise DecodingError("Compression scheme not supported")
+    compressor = MessageListCompressor.GetCompressor(
+        packed_message_list.compression)
+    data = compressor.Decompress(packed_message_list.message_list)
 
     try:
-      result = rdf_flows.MessageList.FromSerializedString(data)
+      # The messages of large bundles are only copied out of the bundle when
+      # they are accessed.
+      result = rdf_flows.MessageList.FromSerializedString(
+          rdf_structs.ZeroCopyBuffer(data))
     except rdfvalue.DecodeError:
       raise DecodingError("RDFValue parsing failed.")
 
     return result
 
+  def _DecryptMessageList(self, cipher, response_comms):
+    """Runs DecryptMessageList() on the bundle in response_comms."""
+    return DecryptMessageList(cipher.cipher, response_comms.encrypted,
+                              response_comms.packet_iv)
+
   def DecodeMessages(self, response_comms):
     """Extract and verify server message.
 
@@ -488,14 +666,8 @@ class Communicator(object):
         remote_public_key = None
 
     # Decrypt the message with the per packet IV.
-    plain = cipher.Decrypt(response_comms.encrypted, response_comms.packet_iv)
-    try:
-      packed_message_list = rdf_flows.PackedMessageList.FromSerializedString(
-          plain)
-    except rdfvalue.DecodeError as e:
-      raise DecryptionError(str(e))
-
-    message_list = self.DecompressMessageList(packed_message_list)
+    packed_message_list, message_list = self._DecryptMessageList(
+        cipher, response_comms)
 
     # Are these messages authenticated?
     # pyformat: disable
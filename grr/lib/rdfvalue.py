@@ -837,9 +837,37 @@ class ByteSize(RDFInteger):
     self._value = int(value * multiplier)
 
 
+# Maximum number of entries kept in each of the RDFURN caches below. A cache is
+# simply emptied when it grows beyond this size.
+URN_CACHE_SIZE = 100000
+
+# Maps unparsed URN strings to their normalized paths.
+_URN_PATH_CACHE = {}
+
+# Maps (path, stem) tuples to the path resulting from RDFURN.Add().
+_URN_JOIN_CACHE = {}
+
+# Maps paths to the tuple of their components.
+_URN_SPLIT_CACHE = {}
+
+
+def _CacheURNValue(cache, key, value):
+  """Stores value in one of the bounded RDFURN caches."""
+  if len(cache) >= URN_CACHE_SIZE:
+    cache.clear()
+
+  cache[key] = value
+  return value
+
+
 @functools.total_ordering
 class RDFURN(RDFValue):
-  """An object to abstract URL manipulation."""
+  """An object to abstract URL manipulation.
+
+  AFF4 code constructs the same URNs over and over, so normalized paths and
+  their components are cached. Identical URNs also end up sharing a single
+  path string.
+  """
 
   data_store_type = "string"
 
@@ -861,6 +889,12 @@ class RDFURN(RDFValue):
     # RDFURNs that way is a bit slow since it would try to normalize
     # the path again which is not needed - it comes from another
     # RDFURN so it is already in the correct format.
+    #
+    # The age is converted to an RDFDatetime lazily by the age property, which
+    # saves creating one for every URN that never has its age read.
+    if age is None:
+      age = 0
+
     if isinstance(initializer, RDFURN):
       # Make a direct copy of the other object
       self._string_urn = initializer.Path()
@@ -877,11 +911,24 @@ class RDFURN(RDFValue):
     Args:
       initializer: url string
     """
+    cacheable = (initializer.__class__ is str or
+                 initializer.__class__ is unicode)
+    if cacheable:
+      path = _URN_PATH_CACHE.get(initializer)
+      if path is not None:
+        self._string_urn = path
+        return
+
     # Strip off the aff4: prefix if necessary.
-    if initializer.startswith("aff4:/"):
-      initializer = initializer[5:]
+    path = initializer
+    if path.startswith("aff4:/"):
+      path = path[5:]
+
+    path = utils.NormalizePath(path)
+    if cacheable:
+      _CacheURNValue(_URN_PATH_CACHE, initializer, path)
 
-    self._string_urn = utils.NormalizePath(initializer)
+    self._string_urn = path
 
   def SerializeToString(self):
     return str(self)
@@ -913,8 +960,14 @@ class RDFURN(RDFValue):
     if not isinstance(path, basestring):
       raise ValueError("Only strings should be added to a URN.")
 
+    key = (self._string_urn, path)
+    joined_path = _URN_JOIN_CACHE.get(key)
+    if joined_path is None:
+      joined_path = _CacheURNValue(_URN_JOIN_CACHE, key,
+                                   utils.JoinPath(self._string_urn, path))
+
     result = self.Copy(age)
-    result.Update(path=utils.JoinPath(self._string_urn, path))
+    result.Update(path=joined_path)
 
     return result
 
@@ -989,7 +1042,13 @@ class RDFURN(RDFValue):
       return result
 
     else:
-      return filter(None, self._string_urn.split("/"))
+      components = _URN_SPLIT_CACHE.get(self._string_urn)
+      if components is None:
+        components = _CacheURNValue(
+            _URN_SPLIT_CACHE, self._string_urn,
+            tuple(filter(None, self._string_urn.split("/"))))
+
+      return list(components)
 
   def RelativeName(self, volume):
     """Given a volume URN return the relative URN as a unicode string.
@@ -247,6 +247,30 @@ class RDFURNTest(test_base.RDFValueTestMixin, test_lib.GRRBaseTest):
     self.assertTrue(s != rdfvalue.RDFURN(s2))
     self.assertFalse(s == rdfvalue.RDFURN(s2))
 
+  def testParsedPathsAreShared(self):
+    urn1 = rdfvalue.RDFURN("aff4:/C.1234567890123456//flows/./W:1")
+    urn2 = rdfvalue.RDFURN("aff4:/C.1234567890123456//flows/./W:1")
+    self.assertEqual(urn1.Path(), "/C.1234567890123456/flows/W:1")
+    self.assertIs(urn1.Path(), urn2.Path())
+
+    self.assertIs(urn1.Add("foo").Path(), urn2.Add("foo").Path())
+
+    # Split() results can be modified without affecting other URNs.
+    components = urn1.Split()
+    components.append("bar")
+    self.assertEqual(urn2.Split(), ["C.1234567890123456", "flows", "W:1"])
+
+  def testURNCachesAreBounded(self):
+    with utils.Stubber(rdfvalue, "URN_CACHE_SIZE", 10):
+      for i in range(100):
+        self.assertEqual(
+            rdfvalue.RDFURN("aff4:/foo/%d" % i).Add("bar").Split(),
+            ["foo", str(i), "bar"])
+
+      self.assertLessEqual(len(rdfvalue._URN_PATH_CACHE), 10)
+      self.assertLessEqual(len(rdfvalue._URN_JOIN_CACHE), 10)
+      self.assertLessEqual(len(rdfvalue._URN_SPLIT_CACHE), 10)
+
   def testHashing(self):
 
     m = {}
@@ -4,7 +4,10 @@
 
 from grr.lib import flags
 from grr.lib import type_info
+from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import protodict as rdf_protodict
 from grr.lib.rdfvalues import structs as rdf_structs
 from grr_response_proto import jobs_pb2
 from grr_response_proto import knowledge_base_pb2
@@ -258,6 +261,36 @@ class RDFValueBenchmark(benchmark_test_lib.AverageMicroBenchmarks):
     self.TimeIt(RDFStructDecode)
     self.TimeIt(ProtoDecode)
 
+  def testDecodeFromMemoryview(self):
+    """Compares decoding strings and memoryviews of GrrMessage bundles.
+
+    Memoryviews avoid copying the nested messages, but they are split in pure
+    python. Views only win once the messages reach about 64KB, which is what
+    structs.ZERO_COPY_MIN_SIZE is based on.
+    """
+    for payload_size in [100, 1024, 16 * 1024, 64 * 1024, 1024 * 1024]:
+      message = rdf_flows.GrrMessage(
+          session_id="aff4:/C.0000000000000001/flows/F:123456",
+          request_id=1,
+          payload=rdf_protodict.DataBlob(data="x" * payload_size))
+      data = rdf_flows.MessageList(job=[message] * 50).SerializeToString()
+
+      def DecodeString():
+        for message in rdf_flows.MessageList.FromSerializedString(data).job:
+          self.assertEqual(message.request_id, 1)
+
+      def DecodeView():
+        for message in rdf_flows.MessageList.FromSerializedString(
+            rdf_structs.ZeroCopyBuffer(data)).job:
+          self.assertEqual(message.request_id, 1)
+
+      self.TimeIt(DecodeString, name="String %d" % payload_size, repetitions=50)
+      self.TimeIt(
+          DecodeView, name="ZeroCopyBuffer %d" % payload_size, repetitions=50)
+      with utils.Stubber(rdf_structs, "ZERO_COPY_MIN_SIZE", 0):
+        self.TimeIt(
+            DecodeView, name="Always view %d" % payload_size, repetitions=50)
+
   def testEncode(self):
     """Comparing encoding speed of a typical protobuf."""
     s = jobs_pb2.GrrMessage(
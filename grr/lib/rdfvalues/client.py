@@ -50,7 +50,9 @@ class ClientURN(rdfvalue.RDFURN):
   CLIENT_ID_RE = re.compile(r"^(aff4:)?/?(?P<clientid>(c|C)\.[0-9a-fA-F]{16})$")
 
   def __init__(self, initializer=None, age=None):
-    if isinstance(initializer, rdfvalue.RDFURN):
+    # Copies of another ClientURN are already known to be valid.
+    if (initializer.__class__ is not ClientURN and
+        isinstance(initializer, rdfvalue.RDFURN)):
       if not self.Validate(initializer.Path()):
         raise type_info.TypeValueError("Client urn malformed: %s" % initializer)
     super(ClientURN, self).__init__(initializer=initializer, age=age)
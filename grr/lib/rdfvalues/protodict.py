@@ -272,6 +272,13 @@ class Dict(rdf_structs.RDFProtoStruct):
     self._values[key] = KeyValue(
         k=DataBlob().SetValue(key), v=DataBlob().SetValue(value))
 
+  def SetSerializedItem(self, key, serialized_value):
+    """Sets a value given as a serialized DataBlob without decoding it."""
+    self.dat.dirty = True
+    self._values[key] = KeyValue(
+        k=DataBlob().SetValue(key),
+        v=DataBlob.FromSerializedString(serialized_value))
+
   def __iter__(self):
     for x in self._values.itervalues():
       yield x.k.GetValue()
@@ -165,6 +165,15 @@ class DictTest(test_base.RDFProtoTestMixin, test_lib.GRRBaseTest):
     sample = rdf_protodict.Dict(a="true")
     self.assertEqual(sample["a"], "true")
 
+  def testSetSerializedItem(self):
+    sample = rdf_protodict.Dict()
+    sample.SetSerializedItem(
+        "a", rdf_protodict.DataBlob().SetValue([1, 2]).SerializeToString())
+
+    self.assertEqual(sample["a"], [1, 2])
+    parsed = rdf_protodict.Dict.FromSerializedString(sample.SerializeToString())
+    self.assertEqual(parsed.ToDict(), {"a": [1, 2]})
+
   def testOverwriting(self):
     req = rdf_client.Iterator(client_state=rdf_protodict.Dict({"A": 1}))
     # There should be one element now.
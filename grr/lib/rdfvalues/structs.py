@@ -3,14 +3,18 @@
 
 import base64
 import copy
+import copy_reg
 import struct
 
 
 # pylint: disable=g-import-not-at-top
 try:
-  from grr.accelerated import _semantic
+  from grr import _semantic
 except ImportError:
-  _semantic = None
+  try:
+    from grr.accelerated import _semantic
+  except ImportError:
+    _semantic = None
 
 from google.protobuf import any_pb2
 from google.protobuf import wrappers_pb2
@@ -192,6 +196,52 @@ def SplitBuffer(buff, index=0, length=None):
       raise rdfvalue.DecodeError("Unexpected Tag.")
 
 
+def SplitBufferView(view, index=0, length=None):
+  """Parses a memoryview as a protobuf without copying length delimited data.
+
+  This is the zero copy counterpart of SplitBuffer(). Tags, lengths and scalar
+  fields are returned as strings, but the data of length delimited fields is
+  returned as a memoryview into the original buffer. It is only copied when
+  the field is actually accessed.
+
+  Args:
+    view: A memoryview of the buffer to parse.
+    index: The position to start parsing.
+    length: Optional length to parse until.
+
+  Yields:
+    Splits the buffer into tuples of (encoded_tag, encoded_length,
+    wire_format), where wire_format may be a memoryview.
+  """
+  buffer_len = length or len(view)
+  while index < buffer_len:
+    encoded_tag, data_index = ReadTag(view, index)
+    encoded_tag = encoded_tag.tobytes()
+
+    tag_type = ORD_MAP[encoded_tag[0]] & TAG_TYPE_MASK
+    if tag_type == WIRETYPE_VARINT:
+      _, new_index = _PythonVarintReader(view, data_index)
+      yield (encoded_tag, "", view[data_index:new_index].tobytes())
+      index = new_index
+
+    elif tag_type == WIRETYPE_FIXED64:
+      yield (encoded_tag, "", view[data_index:data_index + 8].tobytes())
+      index = 8 + data_index
+
+    elif tag_type == WIRETYPE_FIXED32:
+      yield (encoded_tag, "", view[data_index:data_index + 4].tobytes())
+      index = 4 + data_index
+
+    elif tag_type == WIRETYPE_LENGTH_DELIMITED:
+      length, start = _PythonVarintReader(view, data_index)
+      yield (encoded_tag, view[data_index:start].tobytes(),
+             view[start:start + length])
+      index = start + length
+
+    else:
+      raise rdfvalue.DecodeError("Unexpected Tag.")
+
+
 def SerializeEntries(entries):
   """Serializes given triplets of python and wire values and a descriptor."""
   output = []
@@ -203,23 +253,81 @@ def SerializeEntries(entries):
 
     output.extend(wire_format)
 
+    # Data decoded from a memoryview is only copied when it is written out.
+    if wire_format[2].__class__ is memoryview:
+      output[-1] = wire_format[2].tobytes()
+
   return "".join(output)
 
 
-def ReadIntoObject(buff, index, value_obj, length=0):
-  """Reads all tags until the next end group and store in the value_obj."""
-  raw_data = value_obj.GetRawData()
-  count = 0
+# Kinds of entries in a decode plan. A decode plan is precompiled for each
+# RDFStruct class and maps an encoded tag to a tuple of
+# (field_name, type_descriptor, kind, element_tag).
+PLAN_SINGLE = 0
+PLAN_REPEATED = 1
+# A repeated scalar field which was serialized using the packed encoding. The
+# element_tag is the encoded tag each unpacked element is stored under.
+PLAN_PACKED = 2
+
+
+def SplitPackedBuffer(buff, wire_type):
+  """Splits the payload of a packed repeated field into its encoded elements."""
+  result = []
+  index = 0
+  buffer_len = len(buff)
+  if wire_type == WIRETYPE_VARINT:
+    while index < buffer_len:
+      _, new_index = VarintReader(buff, index)
+      result.append(buff[index:new_index])
+      index = new_index
 
-  # Split the buffer into tags and wire_format representations, then collect
-  # these into the raw data cache.
-  for (encoded_tag, encoded_length, encoded_field) in SplitBuffer(
-      buff, index=index, length=length):
+  elif wire_type == WIRETYPE_FIXED32 or wire_type == WIRETYPE_FIXED64:
+    size = 4 if wire_type == WIRETYPE_FIXED32 else 8
+    if buffer_len % size:
+      raise rdfvalue.DecodeError("Invalid packed field length.")
+
+    while index < buffer_len:
+      result.append(buff[index:index + size])
+      index += size
+
+  else:
+    raise rdfvalue.DecodeError("Unexpected packed wire type.")
+
+  return result
+
+
+# This function is HOT.
+def DecodeWithPlan(buff, plan, raw_data, index=0, length=0):
+  """Decodes the buffer into raw_data following a precompiled decode plan.
+
+  Args:
+    buff: The buffer to parse.
+    plan: A dict mapping encoded tags to decode plan entries.
+    raw_data: The raw data dict of the object to decode into.
+    index: The position to start parsing.
+    length: Optional length to parse until.
+
+  Returns:
+    A dict mapping the names of repeated fields to lists of their
+    (python_format, wire_format) entries in the order they were read.
+  """
+  return _DecodeWireFormats(
+      SplitBuffer(buff, index=index, length=length), plan, raw_data)
+
+
+def DecodeViewWithPlan(view, plan, raw_data, index=0, length=0):
+  """Like DecodeWithPlan() but keeps length delimited data as memoryviews."""
+  return _DecodeWireFormats(
+      SplitBufferView(view, index=index, length=length), plan, raw_data)
 
-    type_info_obj = value_obj.type_infos_by_encoded_tag.get(encoded_tag)
 
-    # Internal format to store parsed fields.
-    wire_format = (encoded_tag, encoded_length, encoded_field)
+def _DecodeWireFormats(wire_formats, plan, raw_data):
+  """Stores the split wire formats into raw_data following the plan."""
+  repeated = {}
+  count = 0
+
+  for wire_format in wire_formats:
+    entry = plan.get(wire_format[0])
 
     # If the tag is not found we need to skip it. Skipped fields are
     # inaccessible to this actual object, because they have no type info
@@ -227,35 +335,99 @@ def ReadIntoObject(buff, index, value_obj, length=0):
     # representation because they will be re-serialized back. This way
     # programs which simply read protobufs and write them back do not need to
     # know all the fields, some of which were defined in a later version of
-    # the application. In order to avoid having to worry about repeated fields
-    # here, we just insert them into the raw data dict with a key which should
-    # be unique.
-    if type_info_obj is None:
-      # Record an unknown field. The key is unique and ensures we do not collide
-      # the dict on repeated fields of the encoded tag. Note that this field is
-      # not really accessible using Get() and does not have a python format
-      # representation. It will be written back using the same wire format it
-      # was read with, therefore does not require a type descriptor at all.
+    # the application. The key is unique and ensures we do not collide the
+    # dict on repeated fields of the encoded tag.
+    if entry is None:
       raw_data[count] = (None, wire_format, None)
-
       count += 1
+      continue
 
-    # Repeated fields are handled especially.
-    elif type_info_obj.__class__ is ProtoList:
-      value_obj.Get(type_info_obj.name).wrapped_list.append((None, wire_format))
+    name, type_descriptor, kind, element_tag = entry
+    if kind == PLAN_SINGLE:
+      # Set the python_format as None so it gets converted lazily on access.
+      raw_data[name] = (None, wire_format, type_descriptor)
+
+    elif kind == PLAN_REPEATED:
+      repeated.setdefault(name, []).append((None, wire_format))
 
     else:
-      # Set the python_format as None so it gets converted lazily on access.
-      raw_data[type_info_obj.name] = (None, wire_format, type_info_obj)
+      packed = wire_format[2]
+      if packed.__class__ is memoryview:
+        packed = packed.tobytes()
+
+      for element in SplitPackedBuffer(packed,
+                                       ORD_MAP[element_tag[0]] & TAG_TYPE_MASK):
+        repeated.setdefault(name, []).append((None, (element_tag, "", element)))
+
+  return repeated
+
+
+# Decoding a memoryview avoids copying length delimited fields but is done in
+# pure python, while strings are split by the accelerator. Views only pay off
+# for buffers of at least this many bytes, smaller ones are copied and decoded
+# as strings. See testDecodeFromMemoryview in benchmark_test.py.
+ZERO_COPY_MIN_SIZE = 64 * 1024
+
+
+def ZeroCopyBuffer(data):
+  """Returns data as a memoryview if it is large enough to benefit from it."""
+  if len(data) >= ZERO_COPY_MIN_SIZE:
+    return memoryview(data)
+  return data
+
+
+def ReadIntoObject(buff, index, value_obj, length=0):
+  """Reads all tags until the next end group and store in the value_obj.
+
+  If buff is a memoryview of at least ZERO_COPY_MIN_SIZE bytes, nested
+  messages and other length delimited fields keep referencing the original
+  buffer and are only copied and decoded when they are accessed. Note that
+  such fields keep the whole buffer alive.
+
+  Args:
+    buff: The buffer (a string or a memoryview) to parse.
+    index: The position to start parsing.
+    value_obj: The RDFStruct to read into.
+    length: Optional length to parse until.
+  """
+  raw_data = value_obj.GetRawData()
+
+  if buff.__class__ is memoryview:
+    end = length or len(buff)
+    if end - index < ZERO_COPY_MIN_SIZE:
+      buff, index, length = buff[index:end].tobytes(), 0, 0
+
+  # Split the buffer into tags and wire_format representations, then collect
+  # these into the raw data cache.
+  if buff.__class__ is memoryview:
+    repeated = DecodeViewWithPlan(
+        buff, value_obj.decode_plan, raw_data, index=index, length=length)
+  else:
+    repeated = DecodeWithPlan(
+        buff, value_obj.decode_plan, raw_data, index=index, length=length)
+
+  # Repeated fields are handled especially: they are merged into the
+  # RepeatedFieldHelper the object already holds for them.
+  for name, entries in repeated.iteritems():
+    value_obj.Get(name).wrapped_list.extend(entries)
 
   value_obj.SetRawData(raw_data)
 
 
+# The accelerator only accepts strings, so memoryviews are always decoded with
+# the python varint reader.
+_PythonVarintReader = VarintReader
+
+# Wire format views are read only so copies may simply share their data.
+copy_reg.pickle(memoryview, lambda view: (memoryview, (view.tobytes(),)))
+
 # pylint: disable=invalid-name
 if _semantic:
   VarintEncode = _semantic.varint_encode
   VarintReader = _semantic.varint_decode
   SplitBuffer = _semantic.split_buffer
+  DecodeWithPlan = _semantic.decode_with_plan
+  SerializeEntries = _semantic.serialize_entries
 # pylint: enable=invalid-name
 
 
@@ -459,8 +631,12 @@ class ProtoString(ProtoType):
 
   def ConvertFromWireFormat(self, value, container=None):
     """Internally strings are utf8 encoded."""
+    data = value[2]
+    if data.__class__ is memoryview:
+      data = data.tobytes()
+
     try:
-      return unicode(value[2], "utf8")
+      return unicode(data, "utf8")
     except UnicodeError:
       raise rdfvalue.DecodeError("Unicode decoding error")
 
@@ -508,6 +684,9 @@ class ProtoBinary(ProtoType):
     return value
 
   def ConvertFromWireFormat(self, value, container=None):
+    if value[2].__class__ is memoryview:
+      return value[2].tobytes()
+
     return value[2]
 
   def ConvertToWireFormat(self, value):
@@ -962,7 +1141,11 @@ class ProtoDynamicEmbedded(ProtoType):
 
   def ConvertFromWireFormat(self, value, container=None):
     """The wire format is simply a string."""
-    return self._type(container).FromSerializedString(value[2])
+    data = value[2]
+    if data.__class__ is memoryview:
+      data = data.tobytes()
+
+    return self._type(container).FromSerializedString(data)
 
   def ConvertToWireFormat(self, value):
     """Encode the nested protobuf into wire format."""
@@ -1299,6 +1482,7 @@ class ProtoList(ProtoType):
     self.late_bound = False
     self.delegate = field_desc
     self.wire_type = self.delegate.wire_type
+    self.CalculateTags()
     self.owner.AddDescriptor(self)
 
 
@@ -1486,6 +1670,10 @@ class RDFStructMetaclass(rdfvalue.RDFValueMetaclass):
     cls.type_infos_by_field_number = {}
     cls.type_infos_by_encoded_tag = {}
 
+    # The precompiled decode plan for this class, populated as field
+    # descriptors are added.
+    cls.decode_plan = {}
+
     # Build the class by parsing an existing protobuf class.
     if cls.protobuf is not None:
       proto2.DefineFromProtobuf(cls, cls.protobuf)
@@ -2207,6 +2395,7 @@ class RDFProtoStruct(RDFStruct):
     # We store an index of the type info by tag values to speed up parsing.
     cls.type_infos_by_field_number[field_desc.field_number] = field_desc
     cls.type_infos_by_encoded_tag[field_desc.encoded_tag] = field_desc
+    cls._AddToDecodePlan(field_desc)
 
     cls.type_infos.Append(field_desc)
     cls.late_bound_type_infos.pop(field_desc.name, None)
@@ -2221,6 +2410,26 @@ class RDFProtoStruct(RDFStruct):
                    lambda self, x: self._Set(x, field_desc), None,
                    field_desc.description))
 
+  @classmethod
+  def _AddToDecodePlan(cls, field_desc):
+    """Compiles the decoding of this field into the class decode plan."""
+    if field_desc.__class__ is not ProtoList:
+      cls.decode_plan[field_desc.encoded_tag] = (field_desc.name, field_desc,
+                                                 PLAN_SINGLE, None)
+      return
+
+    cls.decode_plan[field_desc.encoded_tag] = (field_desc.name, field_desc,
+                                               PLAN_REPEATED, None)
+
+    # Repeated scalars may also arrive packed into a single length delimited
+    # field, e.g. when serialized by the standard protobuf library.
+    element_tag = field_desc.delegate.encoded_tag
+    if field_desc.delegate.wire_type != WIRETYPE_LENGTH_DELIMITED:
+      packed_tag = VarintEncode(field_desc.field_number << TAG_TYPE_BITS |
+                                WIRETYPE_LENGTH_DELIMITED)
+      cls.decode_plan[packed_tag] = (field_desc.name, field_desc, PLAN_PACKED,
+                                     element_tag)
+
   def UnionCast(self):
     union_field = getattr(self, self.union_field)
     cast_field_name = str(union_field).lower()
@@ -2,12 +2,15 @@
 # -*- mode: python; encoding: utf-8 -*-
 """Test RDFStruct implementations."""
 
+import copy
+
 from google.protobuf import descriptor_pool
 from google.protobuf import message_factory
 
 from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib import type_info
+from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import paths as rdf_paths
@@ -71,6 +74,17 @@ TestStruct.AddDescriptor(
             name="repeat_nested", field_number=5, nested=TestStruct)),)
 
 
+class RepeatedIntegerTest(structs.RDFProtoStruct):
+  """A protobuf with a repeated scalar field."""
+  type_description = type_info.TypeDescriptorSet(
+      structs.ProtoList(
+          structs.ProtoUnsignedInteger(
+              name="values", field_number=1, description="Some integers.")),
+      structs.ProtoString(
+          name="name", field_number=2, description="A string value."),
+  )
+
+
 class PartialTest1(structs.RDFProtoStruct):
   """This is a protobuf with fewer fields than TestStruct."""
   type_description = type_info.TypeDescriptorSet(
@@ -339,6 +353,70 @@ class RDFStructsTest(test_base.RDFValueTestMixin, test_lib.GRRBaseTest):
     self.assertEqual(len(sliced), 2)
     self.assertEqual(sliced[0].foobar, "Nest3")
 
+  def testDecodePlan(self):
+    plan = TestStruct.decode_plan
+    int_desc = TestStruct.type_infos["int"]
+    self.assertEqual(plan[int_desc.encoded_tag],
+                     ("int", int_desc, structs.PLAN_SINGLE, None))
+
+    repeated_desc = TestStruct.type_infos["repeat_nested"]
+    self.assertEqual(plan[repeated_desc.encoded_tag][2], structs.PLAN_REPEATED)
+
+  def testPackedRepeatedFieldsAreDecoded(self):
+    packed = "".join(structs.VarintEncode(x) for x in [1, 300, 5])
+    data = "".join([
+        structs.VarintEncode(1 << 3 | structs.WIRETYPE_LENGTH_DELIMITED),
+        structs.VarintEncode(len(packed)), packed,
+        RepeatedIntegerTest(values=[7], name="foo").SerializeToString()
+    ])
+
+    tested = RepeatedIntegerTest.FromSerializedString(data)
+    self.assertEqual(list(tested.values), [1, 300, 5, 7])
+    self.assertEqual(tested.name, "foo")
+
+    # Packed fields are written back unpacked.
+    reparsed = RepeatedIntegerTest.FromSerializedString(
+        tested.SerializeToString())
+    self.assertEqual(list(reparsed.values), [1, 300, 5, 7])
+
+  def testMemoryViewDecoding(self):
+    tested = TestStruct(foobar=u"hello \u2603", int=5)
+    tested.nested.foobar = "nested"
+    tested.repeated = ["foo", "bar"]
+    for i in range(3):
+      tested.repeat_nested.Append(foobar="Nest%s" % i)
+    data = tested.SerializeToString()
+
+    # Views of small buffers are decoded as strings by the accelerator.
+    self.assertEqual(structs.ZeroCopyBuffer(data), data)
+    small_view_tested = TestStruct.FromSerializedString(memoryview(data))
+    wire_format = small_view_tested.GetRawData()["nested"][1]
+    self.assertEqual(wire_format[2].__class__, str)
+    self.assertEqual(small_view_tested, tested)
+
+    with utils.Stubber(structs, "ZERO_COPY_MIN_SIZE", 0):
+      view = structs.ZeroCopyBuffer(data)
+      self.assertEqual(view.__class__, memoryview)
+      view_tested = TestStruct.FromSerializedString(view)
+      self.assertEqual(view_tested, TestStruct.FromSerializedString(data))
+
+      # Nested messages are kept as views until they are accessed.
+      wire_format = view_tested.GetRawData()["nested"][1]
+      self.assertEqual(wire_format[2].__class__, memoryview)
+
+      self.assertEqual(view_tested.foobar, u"hello \u2603")
+      self.assertEqual(view_tested.nested.foobar, "nested")
+      self.assertEqual(view_tested.repeat_nested[2].foobar, "Nest2")
+      self.assertEqual(list(view_tested.repeated), ["foo", "bar"])
+
+      # Serializing and copying materializes the views.
+      self.assertEqual(
+          TestStruct.FromSerializedString(memoryview(data)).SerializeToString(),
+          data)
+      self.assertEqual(
+          copy.deepcopy(TestStruct.FromSerializedString(memoryview(data))),
+          tested)
+
   def testUnknownFields(self):
     """Test that unknown fields are preserved across decode/encode cycle."""
     tested = TestStruct(foobar="hello", int=5)
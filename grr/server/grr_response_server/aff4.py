@@ -555,6 +555,52 @@ class Factory(object):
         follow_symlinks=False,
         transaction=transaction)
 
+  def MultiOpenWithLock(self, urns, token=None, age=NEWEST_TIME,
+                        lease_time=100):
+    """Opens and locks many urns at once.
+
+    All locks are taken with a single MultiDBSubjectLock call and all objects
+    are read with a single MultiResolvePrefix call. Urns which are locked by
+    someone else are skipped rather than waited for.
+
+    Just like the objects returned by OpenWithLock, the returned objects
+    release their locks when used in a 'with ...' statement.
+
+    Args:
+      urns: The urns to open.
+      token: The Security Token to use for opening these items.
+      age: The age policy used to build the objects.
+      lease_time: Maximum time the objects stay locked.
+
+    Yields:
+      AFF4 objects opened in "rw" mode for the urns that could be locked.
+    """
+    urns = [rdfvalue.RDFURN(urn) for urn in urns]
+    locks = data_store.DB.MultiDBSubjectLock(urns, lease_time=lease_time)
+    if not locks:
+      return
+
+    locks = dict((utils.SmartUnicode(urn), lock) for urn, lock in locks.items())
+    local_cache = dict((urn, []) for urn in locks)
+    local_cache.update(self.GetAttributes(locks, age=age))
+
+    for urn, lock in locks.iteritems():
+      try:
+        obj = self.Open(
+            urn,
+            mode="rw",
+            token=token,
+            local_cache={urn: local_cache[urn]},
+            age=age,
+            follow_symlinks=False,
+            transaction=lock)
+      except Exception:  # pylint: disable=broad-except
+        logging.exception("Unable to open %s.", urn)
+        lock.Release()
+        continue
+
+      yield obj
+
   def _AcquireLock(self,
                    urn,
                    blocking=None,
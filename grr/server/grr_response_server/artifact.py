@@ -18,6 +18,7 @@ from grr.server.grr_response_server import artifact_registry
 from grr.server.grr_response_server import artifact_utils
 from grr.server.grr_response_server import data_store
 from grr.server.grr_response_server import flow
+from grr.server.grr_response_server import process_pool
 
 
 def GetArtifactKnowledgeBase(client_obj, allow_uninitialized=False):
@@ -347,6 +348,10 @@ class KnowledgeBaseInitializationFlow(flow.GRRFlow):
 def ApplyParserToResponses(processor_obj, responses, source, flow_obj, token):
   """Parse responses using the specified processor and the right args.
 
+  Parsers which only work on the responses themselves run in the worker's
+  process pool if there is one. File parsers need the file contents from the
+  data store and always run in the calling thread.
+
   Args:
     processor_obj: A Processor object that inherits from Parser.
     responses: A list of, or single response depending on the processors
@@ -369,64 +374,92 @@ def ApplyParserToResponses(processor_obj, responses, source, flow_obj, token):
     else:
       result_iterator = responses
 
-  else:
-    # We have some processors to run.
+  elif isinstance(processor_obj, parsers.FileParser):
+    state = flow_obj.state
     if processor_obj.process_together:
-      # We are processing things in a group which requires specialized
-      # handling by the parser. This is used when multiple responses need to
-      # be combined to parse successfully. E.g parsing passwd and shadow files
-      # together.
-      parse_method = processor_obj.ParseMultiple
+      # TODO(amoser): This is very brittle, one day we should come
+      # up with a better API here.
+      urns = [r.AFF4Path(flow_obj.client_id) for r in responses]
+      file_objects = list(aff4.FACTORY.MultiOpen(urns, token=token))
+      file_objects.sort(key=lambda file_object: file_object.urn)
+      stats = sorted(responses, key=lambda r: r.pathspec.path)
+      result_iterator = processor_obj.ParseMultiple(stats, file_objects,
+                                                    state.knowledge_base)
     else:
-      parse_method = processor_obj.Parse
-
-    state = flow_obj.state
-    if isinstance(processor_obj, parsers.CommandParser):
-      # Command processor only supports one response at a time.
-      response = responses
-      result_iterator = parse_method(
-          cmd=response.request.cmd,
-          args=response.request.args,
-          stdout=response.stdout,
-          stderr=response.stderr,
-          return_val=response.exit_status,
-          time_taken=response.time_used,
-          knowledge_base=state.knowledge_base)
-
-    elif isinstance(processor_obj, parsers.WMIQueryParser):
-      query = source["attributes"]["query"]
-      result_iterator = parse_method(query, responses, state.knowledge_base)
-
-    elif isinstance(processor_obj, parsers.FileParser):
-      if processor_obj.process_together:
-        # TODO(amoser): This is very brittle, one day we should come
-        # up with a better API here.
-        urns = [r.AFF4Path(flow_obj.client_id) for r in responses]
-        file_objects = list(aff4.FACTORY.MultiOpen(urns, token=token))
-        file_objects.sort(key=lambda file_object: file_object.urn)
-        stats = sorted(responses, key=lambda r: r.pathspec.path)
-        result_iterator = parse_method(stats, file_objects,
-                                       state.knowledge_base)
-      else:
-        fd = aff4.FACTORY.Open(
-            responses.AFF4Path(flow_obj.client_id), token=token)
-        result_iterator = parse_method(responses, fd, state.knowledge_base)
+      fd = aff4.FACTORY.Open(
+          responses.AFF4Path(flow_obj.client_id), token=token)
+      result_iterator = processor_obj.Parse(responses, fd,
+                                            state.knowledge_base)
 
-    elif isinstance(processor_obj,
-                    (parsers.RegistryParser, parsers.RekallPluginParser,
-                     parsers.RegistryValueParser, parsers.GenericResponseParser,
-                     parsers.GrepParser)):
-      result_iterator = parse_method(responses, state.knowledge_base)
+  else:
+    path_type = None
+    if isinstance(processor_obj, parsers.ArtifactFilesParser):
+      path_type = flow_obj.GetPathType()
 
-    elif isinstance(processor_obj, (parsers.ArtifactFilesParser)):
-      result_iterator = parse_method(responses, state.knowledge_base,
-                                     flow_obj.GetPathType())
+    result_iterator = process_pool.Run(
+        ParseResponses, processor_obj.__class__.__name__, responses, source,
+        flow_obj.state.knowledge_base, path_type)
 
-    else:
-      raise RuntimeError("Unsupported parser detected %s" % processor_obj)
   return result_iterator
 
 
+def ParseResponses(processor_name, responses, source, knowledge_base,
+                   path_type):
+  """Runs a parser which does not need data store access over responses.
+
+  Args:
+    processor_name: The name of the Parser class.
+    responses: A list of, or single response depending on the processors
+       process_together setting.
+    source: The source responsible for producing the responses.
+    knowledge_base: The client's knowledge base.
+    path_type: The path type of the collection, for ArtifactFilesParsers.
+
+  Raises:
+    RuntimeError: On bad parser.
+
+  Returns:
+    An iterator of the processor responses.
+  """
+  processor_obj = parsers.Parser.classes[processor_name]()
+
+  if processor_obj.process_together:
+    # We are processing things in a group which requires specialized
+    # handling by the parser. This is used when multiple responses need to
+    # be combined to parse successfully. E.g parsing passwd and shadow files
+    # together.
+    parse_method = processor_obj.ParseMultiple
+  else:
+    parse_method = processor_obj.Parse
+
+  if isinstance(processor_obj, parsers.CommandParser):
+    # Command processor only supports one response at a time.
+    response = responses
+    return parse_method(
+        cmd=response.request.cmd,
+        args=response.request.args,
+        stdout=response.stdout,
+        stderr=response.stderr,
+        return_val=response.exit_status,
+        time_taken=response.time_used,
+        knowledge_base=knowledge_base)
+
+  elif isinstance(processor_obj, parsers.WMIQueryParser):
+    query = source["attributes"]["query"]
+    return parse_method(query, responses, knowledge_base)
+
+  elif isinstance(processor_obj,
+                  (parsers.RegistryParser, parsers.RekallPluginParser,
+                   parsers.RegistryValueParser, parsers.GenericResponseParser,
+                   parsers.GrepParser)):
+    return parse_method(responses, knowledge_base)
+
+  elif isinstance(processor_obj, (parsers.ArtifactFilesParser)):
+    return parse_method(responses, knowledge_base, path_type)
+
+  raise RuntimeError("Unsupported parser detected %s" % processor_obj)
+
+
 ARTIFACT_STORE_ROOT_URN = aff4.ROOT_URN.Add("artifact_store")
 
 
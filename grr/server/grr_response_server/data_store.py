@@ -40,9 +40,12 @@ import collections
 import logging
 import os
 import random
+import re
 import socket
 import sys
+import threading
 import time
+import weakref
 
 import psutil
 
@@ -53,9 +56,11 @@ from grr.lib import registry
 from grr.lib import stats
 from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import structs as rdf_structs
 from grr.server.grr_response_server import access_control
 from grr.server.grr_response_server import blob_store
 from grr.server.grr_response_server import db
+from grr.server.grr_response_server import notification_bus
 from grr.server.grr_response_server import stats_values
 from grr.server.grr_response_server.databases import registry_init
 
@@ -151,29 +156,164 @@ Record = collections.namedtuple(
     "Record", ["queue_id", "timestamp", "suffix", "subpath", "value"])
 
 
+class MutationPoolFlusher(utils.InterruptableThread):
+  """A thread which flushes mutation pools that have pending writes too long.
+
+  A single flusher thread is shared by all mutation pools which were created
+  with a flush interval. Pools are tracked through weak references so a pool
+  which is dropped without being flushed is not kept alive by the flusher.
+  """
+
+  def __init__(self, sleep_time=0.5):
+    super(MutationPoolFlusher, self).__init__(
+        name="MutationPool flusher thread", sleep_time=sleep_time)
+    self.pools = weakref.WeakSet()
+    self.lock = threading.Lock()
+
+  def Register(self, pool):
+    with self.lock:
+      self.pools.add(pool)
+
+  def Iterate(self):
+    with self.lock:
+      pools = list(self.pools)
+
+    now = time.time()
+    for pool in pools:
+      try:
+        pool.FlushIfExpired(now)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception("Error flushing mutation pool: %s", e)
+
+
+_MUTATION_POOL_FLUSHER = None
+_MUTATION_POOL_FLUSHER_LOCK = threading.Lock()
+
+
+def _RegisterWithMutationPoolFlusher(pool):
+  """Registers a pool for time based flushing, starting the flusher."""
+  global _MUTATION_POOL_FLUSHER
+
+  with _MUTATION_POOL_FLUSHER_LOCK:
+    if _MUTATION_POOL_FLUSHER is None:
+      _MUTATION_POOL_FLUSHER = MutationPoolFlusher()
+      _MUTATION_POOL_FLUSHER.start()
+
+  _MUTATION_POOL_FLUSHER.Register(pool)
+
+
+def _EstimateValuesSize(values):
+  """Returns a rough estimate of the bytes needed to store values."""
+  size = 0
+  for attribute, attribute_values in values.iteritems():
+    size += len(attribute)
+    if not isinstance(attribute_values, (list, tuple)):
+      attribute_values = [attribute_values]
+    for value in attribute_values:
+      if isinstance(value, (list, tuple)):
+        value = value[0]
+      if isinstance(value, basestring):
+        size += len(value)
+      else:
+        # Numbers and RDFValues are not serialized before the write, so we
+        # just account a fixed overhead for them.
+        size += 16
+  return size
+
+
 class MutationPool(object):
   """A mutation pool.
 
   This is a pool to group a number of mutations together and apply
   them at the same time. Note that there are no guarantees about the
-  atomicity of the mutations. Currently, no mutation will be applied
-  before Flush() is called on the pool. If datastore errors occur
-  during application, some mutations might be applied while others are
-  not.
+  atomicity of the mutations. Mutations are applied when Flush() is
+  called on the pool or when the pool grows past max_records pending
+  records or max_bytes (estimated) pending bytes. Pools created with a
+  flush_interval are additionally flushed by a background thread once
+  their oldest pending mutation is older than the interval. If datastore
+  errors occur during application, some mutations might be applied while
+  others are not.
+
+  Within a single flush, deletions are applied before sets. Automatic
+  flushing is off by default since it changes which mutations end up in
+  the same flush and therefore whether a deletion queued after a set wins.
+
+  Set requests for the same subject are coalesced into a single MultiSet
+  call when flushing if they all share the same timestamp and replace
+  semantics.
   """
 
-  def __init__(self):
+  # Defaults for the flush limits, read from the config once by DataStoreInit
+  # so creating a pool does not need any config lookups.
+  default_max_records = 0
+  default_max_bytes = 0
+  default_flush_interval = 0
+
+  def __init__(self, max_records=None, max_bytes=None, flush_interval=None):
+    """Constructor.
+
+    Args:
+      max_records: Number of pending records which triggers a flush. Defaults
+          to Datastore.mutation_pool_max_records, 0 disables the limit.
+      max_bytes: Estimated pending bytes which trigger a flush. Defaults
+          to Datastore.mutation_pool_max_bytes, 0 disables the limit.
+      flush_interval: Seconds pending mutations may wait before a background
+          thread flushes them. Defaults to
+          Datastore.mutation_pool_flush_interval, 0 disables background
+          flushing.
+    """
     self.delete_subject_requests = []
     self.set_requests = []
     self.delete_attributes_requests = []
 
     self.new_notifications = []
+    self.changed_queues = set()
+
+    if max_records is None:
+      max_records = self.default_max_records
+    if max_bytes is None:
+      max_bytes = self.default_max_bytes
+    if flush_interval is None:
+      flush_interval = self.default_flush_interval
+
+    self.max_records = max_records
+    self.max_bytes = max_bytes
+    self.flush_interval = flush_interval
+
+    self.pending_bytes = 0
+    self.oldest_mutation_time = None
+
+    # Per pool metrics.
+    self.flush_count = 0
+    self.auto_flush_count = 0
+    self.coalesced_count = 0
+    self.written_records = 0
+
+    self.lock = threading.RLock()
+
+    if self.flush_interval:
+      _RegisterWithMutationPoolFlusher(self)
+
+  def _MutationAdded(self, size=0):
+    """Updates the pool accounting and flushes if a limit was reached."""
+    if self.oldest_mutation_time is None:
+      self.oldest_mutation_time = time.time()
+    self.pending_bytes += size
+
+    if self.max_records and self.Size() >= self.max_records:
+      self._Flush(trigger="records")
+    elif self.max_bytes and self.pending_bytes >= self.max_bytes:
+      self._Flush(trigger="bytes")
 
   def DeleteSubjects(self, subjects):
-    self.delete_subject_requests.extend(subjects)
+    with self.lock:
+      self.delete_subject_requests.extend(subjects)
+      self._MutationAdded()
 
   def DeleteSubject(self, subject):
-    self.delete_subject_requests.append(subject)
+    with self.lock:
+      self.delete_subject_requests.append(subject)
+      self._MutationAdded()
 
   def MultiSet(self,
                subject,
@@ -181,24 +321,103 @@ class MutationPool(object):
                timestamp=None,
                replace=True,
                to_delete=None):
-    self.set_requests.append((subject, values, timestamp, replace, to_delete))
+    with self.lock:
+      self.set_requests.append((subject, values, timestamp, replace,
+                                to_delete))
+      self._MutationAdded(size=_EstimateValuesSize(values))
 
   def Set(self, subject, attribute, value, timestamp=None, replace=True):
     self.MultiSet(
         subject, {attribute: [value]}, timestamp=timestamp, replace=replace)
 
   def DeleteAttributes(self, subject, attributes, start=None, end=None):
-    self.delete_attributes_requests.append((subject, attributes, start, end))
+    with self.lock:
+      self.delete_attributes_requests.append((subject, attributes, start, end))
+      self._MutationAdded()
+
+  def _CoalesceSetRequests(self, set_requests):
+    """Merges set requests which write to the same subject.
+
+    Requests are only merged if all requests for a subject use the same
+    timestamp and replace flag and none of them deletes attributes. For
+    replace=True the last value written to an attribute wins, otherwise all
+    values are kept.
+
+    Args:
+      set_requests: A list of (subject, values, timestamp, replace, to_delete)
+          tuples.
+
+    Returns:
+      A list of set requests with the same effect as set_requests.
+    """
+    by_subject = collections.OrderedDict()
+    for req in set_requests:
+      by_subject.setdefault(req[0], []).append(req)
+
+    if len(by_subject) == len(set_requests):
+      return set_requests
+
+    result = []
+    for subject, requests in by_subject.iteritems():
+      _, _, timestamp, replace, _ = requests[0]
+      if len(requests) == 1 or any(
+          to_delete or req_timestamp != timestamp or req_replace != replace or
+          any(not isinstance(v, (list, tuple)) for v in values.itervalues())
+          for _, values, req_timestamp, req_replace, to_delete in requests):
+        result.extend(requests)
+        continue
+
+      merged = {}
+      for _, values, _, _, _ in requests:
+        for attribute, attribute_values in values.iteritems():
+          if replace:
+            merged[attribute] = list(attribute_values)
+          else:
+            merged.setdefault(attribute, []).extend(attribute_values)
+
+      result.append((subject, merged, timestamp, replace, None))
+      self.coalesced_count += len(requests) - 1
+
+    return result
 
   def Flush(self):
     """Flushing actually applies all the operations in the pool."""
-    DB.DeleteSubjects(self.delete_subject_requests, sync=False)
+    with self.lock:
+      self._Flush(trigger="explicit")
+
+  def FlushIfExpired(self, now=None):
+    """Flushes the pool if pending mutations are older than flush_interval."""
+    if not self.flush_interval:
+      return
 
-    for req in self.delete_attributes_requests:
+    with self.lock:
+      if self.oldest_mutation_time is None:
+        return
+      if (now or time.time()) - self.oldest_mutation_time >= self.flush_interval:
+        self._Flush(trigger="interval")
+
+  def _Flush(self, trigger="explicit"):
+    """Applies all pending operations, must be called with the lock held."""
+    delete_subject_requests = self.delete_subject_requests
+    delete_attributes_requests = self.delete_attributes_requests
+    set_requests = self.set_requests
+    new_notifications = self.new_notifications
+    changed_queues = self.changed_queues
+
+    coalesced_before = self.coalesced_count
+    set_requests = self._CoalesceSetRequests(set_requests)
+    coalesced = self.coalesced_count - coalesced_before
+    if coalesced:
+      stats.STATS.IncrementCounter(
+          "datastore_mutation_pool_coalesced_writes", delta=coalesced)
+
+    DB.DeleteSubjects(delete_subject_requests, sync=False)
+
+    for req in delete_attributes_requests:
       subject, attributes, start, end = req
       DB.DeleteAttributes(subject, attributes, start=start, end=end, sync=False)
 
-    for req in self.set_requests:
+    for req in set_requests:
       subject, values, timestamp, replace, to_delete = req
       DB.MultiSet(
           subject,
@@ -208,17 +427,34 @@ class MutationPool(object):
           to_delete=to_delete,
           sync=False)
 
-    if (self.delete_subject_requests or self.delete_attributes_requests or
-        self.set_requests):
+    records = (len(delete_subject_requests) + len(delete_attributes_requests) +
+               len(set_requests))
+    if records:
       DB.Flush()
+      self.written_records += records
 
-    for queue, notifications in self.new_notifications:
+    for queue, notifications in new_notifications:
       DB.CreateNotifications(queue, notifications)
-    self.new_notifications = []
+
+    # The tasks are written by now, so frontends which learn about the
+    # change from the log will find them.
+    if changed_queues:
+      DB.QueueRecordChanges(changed_queues)
 
     self.delete_subject_requests = []
     self.set_requests = []
     self.delete_attributes_requests = []
+    self.new_notifications = []
+    self.changed_queues = set()
+    self.pending_bytes = 0
+    self.oldest_mutation_time = None
+
+    if records or new_notifications:
+      self.flush_count += 1
+      if trigger != "explicit":
+        self.auto_flush_count += 1
+      stats.STATS.IncrementCounter(
+          "datastore_mutation_pool_flushes", fields=[trigger])
 
   def __enter__(self):
     return self
@@ -232,7 +468,10 @@ class MutationPool(object):
 
   # Notification handling
   def CreateNotifications(self, queue, notifications):
-    self.new_notifications.append((queue, notifications))
+    with self.lock:
+      self.new_notifications.append((queue, notifications))
+      if self.oldest_mutation_time is None:
+        self.oldest_mutation_time = time.time()
 
   def CollectionAddItem(self,
                         collection_id,
@@ -378,6 +617,8 @@ class MutationPool(object):
         to_schedule[DataStore.QueueTaskIdToColumn(
             task.task_id)] = [task.SerializeToString()]
       self.MultiSet(queue, to_schedule, timestamp=timestamp)
+      with self.lock:
+        self.changed_queues.add(queue)
 
   def QueueQueryAndOwn(self, queue, lease_seconds, limit, timestamp):
     """Returns a list of Tasks leased for a certain time.
@@ -407,12 +648,75 @@ class MutationPool(object):
       logging.warning("Datastore exception: %s", e)
       return []
 
+  def QueueMultiQueryAndOwn(self, queues, lease_seconds, limit, timestamp):
+    """Leases tasks from many queues at once.
+
+    The queues which hold tasks at all are found by reading a single task
+    from each queue, only those are locked and leased from. Queues which are
+    locked by someone else are skipped, just like QueueQueryAndOwn does.
+
+    Args:
+      queues: The queues to query from.
+      lease_seconds: The tasks will be leased for this long.
+      limit: Number of tasks to lease from each queue.
+      timestamp: Range of times for consideration.
+    Returns:
+      A dict mapping queues to lists of leased GrrMessage() objects. Queues
+      without any tasks, not even leased or future ones, are missing.
+    """
+    queues_by_subject = dict((utils.SmartUnicode(q), q) for q in queues)
+    # Leased and future tasks count as well, only the tasks of the locked
+    # queues are read in full.
+    pending = [
+        queue for queue in queues
+        if DB.ResolvePrefix(
+            queue,
+            DataStore.QUEUE_TASK_PREDICATE_PREFIX,
+            timestamp=DataStore.ALL_TIMESTAMPS,
+            limit=1)
+    ]
+
+    result = dict((queue, []) for queue in pending)
+    try:
+      locks = DB.MultiDBSubjectLock(pending, lease_time=lease_seconds)
+    except Error as e:
+      logging.warning("Datastore exception: %s", e)
+      return result
+
+    try:
+      # Reread the tasks now that we own the queues.
+      for subject, values in DB.MultiResolvePrefix(
+          locks.keys(),
+          DataStore.QUEUE_TASK_PREDICATE_PREFIX,
+          timestamp=(0, timestamp or rdfvalue.RDFDatetime.Now())):
+        queue = queues_by_subject[utils.SmartUnicode(subject)]
+        values.sort(key=lambda value: value[0])
+        result[queue] = self._LeaseTasks(
+            queue, values, lease_seconds=lease_seconds, limit=limit)
+      # The leases have to be written before anybody else can lock the
+      # queues again.
+      self.Flush()
+    finally:
+      for lock in locks.itervalues():
+        lock.Release()
+
+    return result
+
   def _QueueQueryAndOwn(self,
                         subject,
                         lease_seconds=100,
                         limit=1,
                         timestamp=None):
     """Business logic helper for QueueQueryAndOwn()."""
+    values = DB.ResolvePrefix(
+        subject,
+        DataStore.QUEUE_TASK_PREDICATE_PREFIX,
+        timestamp=(0, timestamp or rdfvalue.RDFDatetime.Now()))
+    return self._LeaseTasks(
+        subject, values, lease_seconds=lease_seconds, limit=limit)
+
+  def _LeaseTasks(self, subject, values, lease_seconds=100, limit=1):
+    """Leases up to limit of the tasks read from a locked queue."""
     tasks = []
 
     lease = long(lease_seconds * 1e6)
@@ -420,10 +724,7 @@ class MutationPool(object):
     # Only grab attributes with timestamps in the past.
     delete_attrs = set()
     serialized_tasks_dict = {}
-    for predicate, task, timestamp in DB.ResolvePrefix(
-        subject,
-        DataStore.QUEUE_TASK_PREDICATE_PREFIX,
-        timestamp=(0, timestamp or rdfvalue.RDFDatetime.Now())):
+    for predicate, task, timestamp in values:
       task = rdf_flows.GrrMessage.FromSerializedString(task)
       task.eta = timestamp
       task.last_lease = "%s@%s:%d" % (psutil.Process().name(),
@@ -535,6 +836,37 @@ class MutationPool(object):
         subject, [DataStore.AFF4_INDEX_DIR_TEMPLATE % utils.SmartStr(child)])
 
 
+class ScanPager(object):
+  """Picks page sizes for scans which read their results page by page.
+
+  Pages start at Datastore.scan_page_size records. The page size doubles
+  while full pages stay well below Datastore.scan_max_page_bytes and halves
+  when a page exceeds it, so scans over large values keep a bounded amount of
+  memory while scans over small values need few queries.
+  """
+
+  MIN_PAGE_SIZE = 10
+  MAX_PAGE_SIZE = 100000
+
+  def __init__(self, page_size=None, max_page_bytes=None):
+    self.page_size = page_size or config.CONFIG["Datastore.scan_page_size"]
+    self.max_page_bytes = (max_page_bytes or
+                           config.CONFIG["Datastore.scan_max_page_bytes"])
+
+  def Limit(self, remaining=None):
+    """Returns the number of records to read for the next page."""
+    if remaining:
+      return min(self.page_size, remaining)
+    return self.page_size
+
+  def Update(self, page_bytes):
+    """Adjusts the page size after a full page of page_bytes was read."""
+    if page_bytes > self.max_page_bytes:
+      self.page_size = max(self.MIN_PAGE_SIZE, self.page_size // 2)
+    elif page_bytes < self.max_page_bytes // 4:
+      self.page_size = min(self.MAX_PAGE_SIZE, self.page_size * 2)
+
+
 class DataStore(object):
   """Abstract database access."""
 
@@ -549,6 +881,13 @@ class DataStore(object):
   NOTIFY_PREDICATE_PREFIX = "notify:"
   NOTIFY_PREDICATE_TEMPLATE = NOTIFY_PREDICATE_PREFIX + "%s"
 
+  # Notifications are stored in one subject per priority and due time bucket
+  # of this many microseconds. The queue shard indexes the buckets, so
+  # readers only visit buckets which hold ready notifications.
+  NOTIFY_BUCKET_SIZE = 60 * 1000000
+  NOTIFY_BUCKET_PREFIX = "notify_bucket:"
+  NOTIFY_BUCKET_TEMPLATE = NOTIFY_BUCKET_PREFIX + "%d:%d"
+
   FLOW_REQUEST_PREFIX = "flow:request:"
   FLOW_REQUEST_TEMPLATE = FLOW_REQUEST_PREFIX + "%08X"
 
@@ -711,6 +1050,28 @@ class DataStore(object):
         A lock object.
     """
 
+  def MultiDBSubjectLock(self, subjects, lease_time=None):
+    """Locks many subjects at once, skipping the ones that are locked already.
+
+    Unlike DBSubjectLock this never raises DBSubjectLockError, subjects which
+    could not be locked are simply missing from the result. Data stores which
+    can take many locks in a single round trip should override this.
+
+    Args:
+      subjects: A list of subjects to lock.
+      lease_time: The minimum amount of time the locks should remain alive.
+
+    Returns:
+      A dict mapping the subjects that were locked to their lock objects.
+    """
+    locks = {}
+    for subject in subjects:
+      try:
+        locks[subject] = self.DBSubjectLock(subject, lease_time=lease_time)
+      except DBSubjectLockError:
+        pass
+    return locks
+
   @abc.abstractmethod
   def MultiSet(self,
                subject,
@@ -942,6 +1303,9 @@ class DataStore(object):
     Yields: Pairs (subject, result_dict) where result_dict maps attribute to
       (timestamp, value) pairs.
 
+    Data stores may read the results in pages, so large scans don't need to
+    hold all results in memory. A scan can be resumed by passing the last
+    subject yielded as after_urn.
     """
 
   def ScanAttribute(self,
@@ -985,52 +1349,179 @@ class DataStore(object):
   def GetMutationPool(self):
     return self.mutation_pool_cls()
 
+  def _NotificationBucketSubject(self, queue_shard, priority, bucket):
+    return rdfvalue.RDFURN(queue_shard).Add("notifications").Add(
+        str(priority)).Add(str(bucket))
+
+  def _NotificationBucket(self, timestamp):
+    return int(timestamp) // self.NOTIFY_BUCKET_SIZE
+
   def CreateNotifications(self, queue_shard, notifications):
-    values = {}
+    buckets = {}
+    now = rdfvalue.RDFDatetime.Now()
     for notification in notifications:
+      timestamp = notification.timestamp
+      if timestamp is None:
+        timestamp = now
+      key = (int(notification.priority), self._NotificationBucket(timestamp))
+      values = buckets.setdefault(key, {})
       values[self.NOTIFY_PREDICATE_TEMPLATE % notification.session_id] = [
-          (notification.SerializeToString(), notification.timestamp)
+          (notification.SerializeToString(), timestamp)
+      ]
+
+    index = {}
+    for (priority, bucket), values in buckets.iteritems():
+      self.MultiSet(
+          self._NotificationBucketSubject(queue_shard, priority, bucket),
+          values,
+          replace=False,
+          sync=True)
+      # Index entries are timestamped with the start of their bucket, so
+      # readers can select the ready buckets by timestamp.
+      index[self.NOTIFY_BUCKET_TEMPLATE % (priority, bucket)] = [
+          (bucket, bucket * self.NOTIFY_BUCKET_SIZE)
       ]
-    self.MultiSet(queue_shard, values, replace=False, sync=True)
+
+    # The index is written last, so readers never find a bucket before the
+    # notifications in it.
+    self.MultiSet(queue_shard, index, replace=True, sync=True)
+    # Only wake up workers once the notifications can actually be read.
+    notification_bus.Publish(queue_shard)
+
+  def _ParseNotificationBucket(self, predicate):
+    priority, bucket = predicate[len(self.NOTIFY_BUCKET_PREFIX):].split(":")
+    return int(priority), int(bucket)
 
   def DeleteNotifications(self, queue_shards, session_ids, start, end):
     attributes = [
         self.NOTIFY_PREDICATE_TEMPLATE % session_id
         for session_id in session_ids
     ]
+
+    # Only buckets overlapping [start, end] can hold these notifications.
+    first_bucket_start = max(0, int(start) - self.NOTIFY_BUCKET_SIZE + 1)
+    subjects = list(queue_shards)
+    for queue_shard, index in self.MultiResolvePrefix(
+        queue_shards,
+        self.NOTIFY_BUCKET_PREFIX,
+        timestamp=(first_bucket_start, int(end))):
+      for predicate, _, _ in index:
+        priority, bucket = self._ParseNotificationBucket(predicate)
+        subjects.append(
+            self._NotificationBucketSubject(queue_shard, priority, bucket))
+
     self.MultiDeleteAttributes(
-        queue_shards, attributes, start=start, end=end, sync=True)
+        subjects, attributes, start=start, end=end, sync=True)
 
   def GetNotifications(self, queue_shard, end, limit=10000):
-    for predicate, serialized_notification, ts in self.ResolvePrefix(
+    """Yields ready notifications, highest priority and oldest first.
+
+    Args:
+      queue_shard: The queue shard to read notifications from.
+      end: Only notifications due at or before this time are returned.
+      limit: The maximum number of notifications to return.
+
+    Yields:
+      rdf_flows.GrrNotification objects.
+    """
+    # Notifications stored directly on the shard were written before
+    # notifications were bucketed.
+    count = 0
+    for predicate, value, ts in self.ResolvePrefix(
         queue_shard,
         self.NOTIFY_PREDICATE_PREFIX,
         timestamp=(0, end),
         limit=limit):
-      try:
-        # Parse the notification.
-        notification = rdf_flows.GrrNotification.FromSerializedString(
-            serialized_notification)
-      except Exception:  # pylint: disable=broad-except
-        logging.exception(
-            "Can't unserialize notification, deleting it: "
-            "predicate=%s, ts=%d", predicate, ts)
-        self.DeleteAttributes(
-            queue_shard,
-            [predicate],
-            # Make the time range narrow, but be sure to include the needed
-            # notification.
-            start=ts,
-            end=ts,
-            sync=True)
-        continue
+      notification = self._ParseNotification(queue_shard, predicate, value, ts)
+      if notification:
+        count += 1
+        yield notification
+
+    # The index is read in predicate order, so it can't be limited without
+    # missing high priority or overdue buckets. Readers drop drained buckets
+    # from it, so it only holds the buckets with ready notifications, the
+    # bucket which is due now and the ones emptied since the last read.
+    buckets = [
+        self._ParseNotificationBucket(predicate)
+        for predicate, _, _ in self.ResolvePrefix(
+            queue_shard, self.NOTIFY_BUCKET_PREFIX, timestamp=(0, end))
+    ]
+
+    for priority, bucket in sorted(buckets, key=lambda b: (-b[0], b[1])):
+      if count >= limit:
+        return
+
+      subject = self._NotificationBucketSubject(queue_shard, priority, bucket)
+      found = False
+      for predicate, value, ts in self.ResolvePrefix(
+          subject,
+          self.NOTIFY_PREDICATE_PREFIX,
+          timestamp=(0, end),
+          limit=limit - count):
+        found = True
+        notification = self._ParseNotification(subject, predicate, value, ts)
+        if notification:
+          count += 1
+          yield notification
+
+      # Notifications due after end may still be waiting in the last bucket.
+      if not found and (bucket + 1) * self.NOTIFY_BUCKET_SIZE <= end:
+        self._DropNotificationBucket(queue_shard, priority, bucket)
+
+  def _DropNotificationBucket(self, queue_shard, priority, bucket):
+    """Removes an empty bucket from the index of a queue shard.
+
+    Requeued notifications keep their original due time, so writers can add
+    to a bucket at any age. CreateNotifications writes a bucket before its
+    index entry, so a bucket which is still empty after its index entry was
+    deleted will get a fresh index entry from any later writer. If a writer
+    got in before that, the index entry is restored.
 
-      # Strip the prefix from the predicate to get the session_id.
-      session_id = predicate[len(self.NOTIFY_PREDICATE_PREFIX):]
-      notification.session_id = session_id
-      notification.timestamp = ts
+    Args:
+      queue_shard: The queue shard the bucket belongs to.
+      priority: The priority of the bucket.
+      bucket: The bucket number.
+    """
+    index_predicate = self.NOTIFY_BUCKET_TEMPLATE % (priority, bucket)
+    self.DeleteAttributes(queue_shard, [index_predicate], sync=True)
 
-      yield notification
+    subject = self._NotificationBucketSubject(queue_shard, priority, bucket)
+    if self.ResolvePrefix(subject, self.NOTIFY_PREDICATE_PREFIX, limit=1):
+      self.MultiSet(
+          queue_shard, {
+              index_predicate: [(bucket, bucket * self.NOTIFY_BUCKET_SIZE)]
+          },
+          replace=True,
+          sync=True)
+    # The bucket subject itself is left alone, deleting it could drop a
+    # notification written concurrently.
+
+  def _ParseNotification(self, subject, predicate, serialized_notification,
+                         ts):
+    """Parses a stored notification, deleting it if it is corrupt."""
+    try:
+      # Parse the notification.
+      notification = rdf_flows.GrrNotification.FromSerializedString(
+          serialized_notification)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception(
+          "Can't unserialize notification, deleting it: "
+          "predicate=%s, ts=%d", predicate, ts)
+      self.DeleteAttributes(
+          subject,
+          [predicate],
+          # Make the time range narrow, but be sure to include the needed
+          # notification.
+          start=ts,
+          end=ts,
+          sync=True)
+      return None
+
+    # Strip the prefix from the predicate to get the session_id.
+    session_id = predicate[len(self.NOTIFY_PREDICATE_PREFIX):]
+    notification.session_id = session_id
+    notification.timestamp = ts
+    return notification
 
   def GetFlowResponseSubject(self, session_id, request_id):
     """The subject used to carry all the responses for a specific request_id."""
@@ -1067,7 +1558,8 @@ class DataStore(object):
       request = rdf_flows.RequestState.FromSerializedString(request_data)
       responses = []
       for _, serialized, timestamp in response_data.get(urn, []):
-        msg = rdf_flows.GrrMessage.FromSerializedString(serialized)
+        msg = rdf_flows.GrrMessage.FromSerializedString(
+            rdf_structs.ZeroCopyBuffer(serialized))
         msg.timestamp = timestamp
         responses.append(msg)
 
@@ -1076,14 +1568,53 @@ class DataStore(object):
   def ReadCompletedRequests(self, session_id, timestamp=None, limit=None):
     """Fetches all the requests with a status message queued for them."""
     subject = session_id.Add("state")
-    requests = {}
-    status = {}
-
-    for predicate, serialized, _ in self.ResolvePrefix(
+    values = self.ResolvePrefix(
         subject, [self.FLOW_REQUEST_PREFIX, self.FLOW_STATUS_PREFIX],
         limit=limit,
+        timestamp=timestamp)
+    return self._CompletedRequests(values)
+
+  def MultiReadCompletedRequests(self, session_ids, timestamps):
+    """Fetches the completed requests of many flows in one operation.
+
+    Args:
+      session_ids: The session ids of the flows to read.
+      timestamps: A dict mapping each session id to the (start, end) time
+        range to read for it, as ReadCompletedRequests' timestamp argument.
+
+    Returns:
+      A dict mapping session ids to lists of (request, status) tuples, the
+      same ReadCompletedRequests yields for the session.
+    """
+    subjects = {}
+    for session_id in session_ids:
+      subjects[utils.SmartUnicode(session_id.Add("state"))] = session_id
+
+    ranges = {}
+    for session_id in session_ids:
+      start, end = timestamps[session_id]
+      ranges[session_id] = (int(start), int(end))
+    timestamp = (min(start for start, _ in ranges.itervalues()),
+                 max(end for _, end in ranges.itervalues()))
+
+    result = dict((session_id, []) for session_id in session_ids)
+    for subject, values in self.MultiResolvePrefix(
+        subjects, [self.FLOW_REQUEST_PREFIX, self.FLOW_STATUS_PREFIX],
         timestamp=timestamp):
+      session_id = subjects[utils.SmartUnicode(subject)]
+      # All flows were read with the widest range, narrow it down again.
+      start, end = ranges[session_id]
+      values = [v for v in values if start <= v[2] <= end]
+      result[session_id] = list(self._CompletedRequests(values))
 
+    return result
+
+  def _CompletedRequests(self, values):
+    """Yields (request, status) tuples from a flow's state attributes."""
+    requests = {}
+    status = {}
+
+    for predicate, serialized, _ in values:
       parts = predicate.split(":", 3)
       request_id = parts[2]
       if parts[1] == "status":
@@ -1135,7 +1666,8 @@ class DataStore(object):
     for response_urn, request in sorted(response_subjects.items()):
       responses = []
       for _, serialized, timestamp in response_data.get(response_urn, []):
-        msg = rdf_flows.GrrMessage.FromSerializedString(serialized)
+        msg = rdf_flows.GrrMessage.FromSerializedString(
+            rdf_structs.ZeroCopyBuffer(serialized))
         msg.timestamp = timestamp
         responses.append(msg)
 
@@ -1283,7 +1815,8 @@ class DataStore(object):
             self.FLOW_RESPONSE_PREFIX,
             limit=response_limit,
             timestamp=timestamp)):
-      msg = rdf_flows.GrrMessage.FromSerializedString(serialized)
+      msg = rdf_flows.GrrMessage.FromSerializedString(
+          rdf_structs.ZeroCopyBuffer(serialized))
       msg.timestamp = timestamp
       yield msg
 
@@ -1372,6 +1905,19 @@ class DataStore(object):
   QUEUE_TASK_PREDICATE_PREFIX = "task:"
   QUEUE_TASK_PREDICATE_TEMPLATE = QUEUE_TASK_PREDICATE_PREFIX + "%s"
 
+  # Queues which tasks get scheduled on are logged in one subject per bucket
+  # of this many microseconds. Frontends read the log to forget what they
+  # know about queues being empty.
+  QUEUE_CHANGES_URN = rdfvalue.RDFURN("aff4:/queue_changes")
+  QUEUE_CHANGES_PREFIX = "queue:"
+  # Every change log bucket holds its bucket number here, so expired buckets
+  # can be found by a scan.
+  QUEUE_CHANGES_BUCKET_ATTRIBUTE = "aff4:queue_changes_bucket"
+  QUEUE_CHANGES_BUCKET_SIZE = 10 * 1000000
+  # Buckets older than this are deleted, readers which fall further behind
+  # can not tell which queues changed.
+  QUEUE_CHANGES_RETENTION = 600 * 1000000
+
   STATS_STORE_PREFIX = "aff4:stats_store/"
 
   @classmethod
@@ -1442,6 +1988,70 @@ class DataStore(object):
       _, value, timestamp = v[0]
       yield (value, timestamp)
 
+  def _QueueChangesSubject(self, bucket):
+    return self.QUEUE_CHANGES_URN.Add(str(bucket))
+
+  def QueueRecordChanges(self, queues, timestamp=None):
+    """Logs that tasks were scheduled on the given queues."""
+    if timestamp is None:
+      timestamp = rdfvalue.RDFDatetime.Now()
+    timestamp = int(timestamp)
+
+    bucket = timestamp // self.QUEUE_CHANGES_BUCKET_SIZE
+    values = {self.QUEUE_CHANGES_BUCKET_ATTRIBUTE: [bucket]}
+    for queue in queues:
+      queue = utils.SmartUnicode(queue)
+      values[self.QUEUE_CHANGES_PREFIX + queue] = [(queue, timestamp)]
+
+    self.MultiSet(
+        self._QueueChangesSubject(bucket),
+        values,
+        replace=True,
+        sync=True)
+
+  def QueueReadChanges(self, start, end):
+    """Returns the queues which had tasks scheduled between start and end.
+
+    Args:
+      start: The start of the time range, in microseconds.
+      end: The end of the time range, in microseconds.
+
+    Returns:
+      A set of queue urns as unicode strings.
+    """
+    start, end = int(start), int(end)
+    subjects = [
+        self._QueueChangesSubject(bucket)
+        for bucket in xrange(start // self.QUEUE_CHANGES_BUCKET_SIZE,
+                             end // self.QUEUE_CHANGES_BUCKET_SIZE + 1)
+    ]
+
+    changed = set()
+    for _, values in self.MultiResolvePrefix(
+        subjects, self.QUEUE_CHANGES_PREFIX, timestamp=(start, end)):
+      for _, queue, _ in values:
+        changed.add(utils.SmartUnicode(queue))
+    return changed
+
+  def QueueExpireChanges(self, now=None):
+    """Deletes all change log buckets which fell out of retention."""
+    if now is None:
+      now = rdfvalue.RDFDatetime.Now()
+    first_kept = ((int(now) - self.QUEUE_CHANGES_RETENTION) //
+                  self.QUEUE_CHANGES_BUCKET_SIZE)
+
+    # Only the buckets within the retention window are kept, so the scan
+    # stays short no matter how long ago the last expiry ran.
+    expired = []
+    for subject, values in self.ScanAttributes(
+        self.QUEUE_CHANGES_URN, [self.QUEUE_CHANGES_BUCKET_ATTRIBUTE]):
+      _, bucket = values[self.QUEUE_CHANGES_BUCKET_ATTRIBUTE]
+      if int(bucket) < first_kept:
+        expired.append(subject)
+
+    if expired:
+      self.DeleteSubjects(expired, sync=True)
+
   def QueueQueryTasks(self, queue, limit=1):
     """Retrieves tasks from a queue without leasing them.
 
@@ -1657,6 +2267,316 @@ class DBSubjectLock(object):
       pass
 
 
+class ReadCachingDataStore(DataStore):
+  """A read-through cache in front of a DataStore.
+
+  Results of ResolvePrefix, ResolveMulti and MultiResolvePrefix for subjects
+  matching one of the configured regexes are kept in a process local LRU
+  cache for at most max_age seconds. Writes and locks issued through this
+  object invalidate the cached results for the subject once the write has
+  been applied, so readers in this process see their own writes. Writes made
+  by other processes become visible after at most max_age seconds.
+
+  Subjects written with sync=False are not cached until the next Flush since
+  the delegate may still hold their writes in a buffer.
+
+  Storage primitives are passed through to the wrapped data store, the
+  generic DataStore methods run on top of this object so their writes are
+  seen by the cache as well.
+  """
+
+  __abstract = True  # pylint: disable=g-bad-name
+
+  # Number of buckets used to detect writes racing with cache fills.
+  GENERATION_BUCKETS = 1024
+
+  # pylint: disable=super-init-not-called
+  def __init__(self, delegate, max_size=10000, max_age=5, subject_regexes=None):
+    # The delegate flushes itself, this object must not start another
+    # flusher thread so DataStore.__init__ is not called.
+    self.delegate = delegate
+    self.cache = utils.AgeBasedCache(max_size=max_size, max_age=max_age)
+    self.subject_regexes = [re.compile(r) for r in subject_regexes or []]
+    self.generations = [0] * self.GENERATION_BUCKETS
+    self.unsynced = set()
+
+  # pylint: enable=super-init-not-called
+
+  def __getattr__(self, name):
+    # Implementation specific helpers, e.g. the blobstore.
+    return getattr(self.delegate, name)
+
+  def _IsCacheable(self, subject):
+    for regex in self.subject_regexes:
+      if regex.match(subject):
+        return True
+    return False
+
+  def _Generation(self, subject):
+    return self.generations[hash(subject) % self.GENERATION_BUCKETS]
+
+  def _CacheGet(self, subject, key):
+    try:
+      result = self.cache.Get(subject)[key]
+      stats.STATS.IncrementCounter("datastore_read_cache_hits")
+      return result
+    except KeyError:
+      stats.STATS.IncrementCounter("datastore_read_cache_misses")
+      return None
+
+  def _CachePut(self, subject, key, result, generation):
+    """Stores a result unless the subject was written since generation."""
+    with self.cache.lock:
+      if self._Generation(subject) != generation or subject in self.unsynced:
+        return
+      try:
+        self.cache.Get(subject)[key] = result
+      except KeyError:
+        self.cache.Put(subject, {key: result})
+
+  def Invalidate(self, subject):
+    subject = utils.SmartUnicode(subject)
+    with self.cache.lock:
+      self.generations[hash(subject) % self.GENERATION_BUCKETS] += 1
+      self.cache.ExpireObject(subject)
+
+  def _Written(self, subjects, sync):
+    """Invalidates subjects after a write was passed to the delegate."""
+    with self.cache.lock:
+      for subject in subjects:
+        subject = utils.SmartUnicode(subject)
+        if not sync:
+          self.unsynced.add(subject)
+        self.Invalidate(subject)
+
+  def Flush(self):
+    with self.cache.lock:
+      unsynced, self.unsynced = self.unsynced, set()
+
+    try:
+      return self.delegate.Flush()
+    finally:
+      # Only the buffered subjects can have changed since they were last
+      # invalidated, the rest of the cache stays valid.
+      for subject in unsynced:
+        self.Invalidate(subject)
+
+  # Storage primitives of the delegate.
+
+  def Initialize(self):
+    return self.delegate.Initialize()
+
+  def ClearTestDB(self):
+    return self.delegate.ClearTestDB()
+
+  def DestroyTestDB(self):
+    return self.delegate.DestroyTestDB()
+
+  def Size(self):
+    return self.delegate.Size()
+
+  def ScanAttributes(self,
+                     subject_prefix,
+                     attributes,
+                     after_urn=None,
+                     max_records=None,
+                     relaxed_order=False):
+    return self.delegate.ScanAttributes(
+        subject_prefix,
+        attributes,
+        after_urn=after_urn,
+        max_records=max_records,
+        relaxed_order=relaxed_order)
+
+  # Reads.
+
+  def Resolve(self, subject, attribute):
+    for _, value, timestamp in self.ResolveMulti(
+        subject, [attribute], timestamp=DataStore.NEWEST_TIMESTAMP):
+      return value, timestamp
+
+    return (None, 0)
+
+  def ResolveMulti(self, subject, attributes, timestamp=None, limit=None):
+    unicode_subject = utils.SmartUnicode(subject)
+    if not self._IsCacheable(unicode_subject):
+      return self.delegate.ResolveMulti(
+          subject, attributes, timestamp=timestamp, limit=limit)
+
+    if isinstance(attributes, basestring):
+      attributes = [attributes]
+    key = ("ResolveMulti", tuple(attributes), timestamp, limit)
+    result = self._CacheGet(unicode_subject, key)
+    if result is None:
+      generation = self._Generation(unicode_subject)
+      result = tuple(
+          self.delegate.ResolveMulti(
+              subject, attributes, timestamp=timestamp, limit=limit))
+      self._CachePut(unicode_subject, key, result, generation)
+
+    return list(result)
+
+  def ResolvePrefix(self, subject, attribute_prefix, timestamp=None,
+                    limit=None):
+    unicode_subject = utils.SmartUnicode(subject)
+    if not self._IsCacheable(unicode_subject):
+      return self.delegate.ResolvePrefix(
+          subject, attribute_prefix, timestamp=timestamp, limit=limit)
+
+    if not isinstance(attribute_prefix, basestring):
+      attribute_prefix = tuple(attribute_prefix)
+    key = ("ResolvePrefix", attribute_prefix, timestamp, limit)
+    result = self._CacheGet(unicode_subject, key)
+    if result is None:
+      generation = self._Generation(unicode_subject)
+      result = tuple(
+          self.delegate.ResolvePrefix(
+              subject, attribute_prefix, timestamp=timestamp, limit=limit))
+      self._CachePut(unicode_subject, key, result, generation)
+
+    return list(result)
+
+  def ResolveRow(self, subject, **kw):
+    return self.ResolvePrefix(subject, "", **kw)
+
+  def MultiResolvePrefix(self,
+                         subjects,
+                         attribute_prefix,
+                         timestamp=None,
+                         limit=None):
+    # A total limit couples the results of all subjects so we can't serve
+    # them individually from the cache.
+    if limit:
+      return self.delegate.MultiResolvePrefix(
+          subjects, attribute_prefix, timestamp=timestamp, limit=limit)
+
+    if not isinstance(attribute_prefix, basestring):
+      attribute_prefix = tuple(attribute_prefix)
+    key = ("ResolvePrefix", attribute_prefix, timestamp, None)
+
+    results = []
+    to_read = []
+    generations = {}
+    for subject in subjects:
+      unicode_subject = utils.SmartUnicode(subject)
+      if not self._IsCacheable(unicode_subject):
+        to_read.append(subject)
+        continue
+
+      values = self._CacheGet(unicode_subject, key)
+      if values is None:
+        generations[unicode_subject] = self._Generation(unicode_subject)
+        to_read.append(subject)
+      elif values:
+        results.append((subject, list(values)))
+
+    if to_read:
+      read_subjects = set()
+      for subject, values in self.delegate.MultiResolvePrefix(
+          to_read, attribute_prefix, timestamp=timestamp):
+        unicode_subject = utils.SmartUnicode(subject)
+        read_subjects.add(unicode_subject)
+        if unicode_subject in generations:
+          values = sorted(values, key=lambda a: a[0])
+          self._CachePut(unicode_subject, key, tuple(values),
+                         generations[unicode_subject])
+        results.append((subject, values))
+
+      # Subjects without any values are cached as empty results too.
+      for unicode_subject, generation in generations.iteritems():
+        if unicode_subject not in read_subjects:
+          self._CachePut(unicode_subject, key, (), generation)
+
+    return iter(results)
+
+  # Writes and locks invalidate the cache.
+
+  def Set(self,
+          subject,
+          attribute,
+          value,
+          timestamp=None,
+          replace=True,
+          sync=True):
+    try:
+      self.delegate.Set(
+          subject,
+          attribute,
+          value,
+          timestamp=timestamp,
+          replace=replace,
+          sync=sync)
+    finally:
+      self._Written([subject], sync)
+
+  def MultiSet(self,
+               subject,
+               values,
+               timestamp=None,
+               replace=True,
+               sync=True,
+               to_delete=None):
+    try:
+      self.delegate.MultiSet(
+          subject,
+          values,
+          timestamp=timestamp,
+          replace=replace,
+          sync=sync,
+          to_delete=to_delete)
+    finally:
+      self._Written([subject], sync)
+
+  def DeleteAttributes(self,
+                       subject,
+                       attributes,
+                       start=None,
+                       end=None,
+                       sync=True):
+    try:
+      self.delegate.DeleteAttributes(
+          subject, attributes, start=start, end=end, sync=sync)
+    finally:
+      self._Written([subject], sync)
+
+  def MultiDeleteAttributes(self,
+                            subjects,
+                            attributes,
+                            start=None,
+                            end=None,
+                            sync=True):
+    subjects = list(subjects)
+    try:
+      self.delegate.MultiDeleteAttributes(
+          subjects, attributes, start=start, end=end, sync=sync)
+    finally:
+      self._Written(subjects, sync)
+
+  def DeleteSubject(self, subject, sync=False):
+    try:
+      self.delegate.DeleteSubject(subject, sync=sync)
+    finally:
+      self._Written([subject], sync)
+
+  def DeleteSubjects(self, subjects, sync=False):
+    subjects = list(subjects)
+    try:
+      self.delegate.DeleteSubjects(subjects, sync=sync)
+    finally:
+      self._Written(subjects, sync)
+
+  def DBSubjectLock(self, subject, lease_time=None):
+    # Reads under a lock must see the latest data.
+    self.Invalidate(subject)
+    return self.delegate.DBSubjectLock(subject, lease_time=lease_time)
+
+  def MultiDBSubjectLock(self, subjects, lease_time=None):
+    subjects = list(subjects)
+    for subject in subjects:
+      self.Invalidate(subject)
+    return self.delegate.MultiDBSubjectLock(subjects, lease_time=lease_time)
+
+
 class DataStoreInit(registry.InitHook):
   """Initialize the data store.
 
@@ -1686,8 +2606,21 @@ class DataStoreInit(registry.InitHook):
       self._ListStorageOptions()
       raise ValueError(msg)
 
+    MutationPool.default_max_records = config.CONFIG[
+        "Datastore.mutation_pool_max_records"]
+    MutationPool.default_max_bytes = config.CONFIG[
+        "Datastore.mutation_pool_max_bytes"]
+    MutationPool.default_flush_interval = config.CONFIG[
+        "Datastore.mutation_pool_flush_interval"]
+
     DB = cls()  # pylint: disable=g-bad-name
     DB.Initialize()
+    if config.CONFIG["Datastore.read_cache_size"]:
+      DB = ReadCachingDataStore(  # pylint: disable=g-bad-name
+          DB,
+          max_size=config.CONFIG["Datastore.read_cache_size"],
+          max_age=config.CONFIG["Datastore.read_cache_max_age"],
+          subject_regexes=config.CONFIG["Datastore.read_cache_subjects"])
     atexit.register(DB.Flush)
     monitor_port = config.CONFIG["Monitoring.http_port"]
     if monitor_port != 0:
@@ -1714,3 +2647,9 @@ class DataStoreInit(registry.InitHook):
     """Initialize some Varz."""
     stats.STATS.RegisterCounterMetric("grr_commit_failure")
     stats.STATS.RegisterCounterMetric("datastore_retries")
+    stats.STATS.RegisterCounterMetric(
+        "datastore_mutation_pool_flushes", fields=[("trigger", str)])
+    stats.STATS.RegisterCounterMetric(
+        "datastore_mutation_pool_coalesced_writes")
+    stats.STATS.RegisterCounterMetric("datastore_read_cache_hits")
+    stats.STATS.RegisterCounterMetric("datastore_read_cache_misses")
@@ -738,6 +738,35 @@ class DataStoreTestMixin(object):
             "aff4:/C", ["aff4:foo", "aff4:bar"], max_records=5))
     self.assertEqual(len(results), 5)
 
+  def testScanAttributesReadsInPages(self):
+    for i in range(25):
+      subject = "aff4:/paged/%02d" % i
+      data_store.DB.Set(subject, "aff4:foo", "foo %d" % i, timestamp=1000)
+      if i % 3:
+        data_store.DB.Set(subject, "aff4:bar", "bar %d" % i, timestamp=1000)
+
+    with test_lib.ConfigOverrider({"Datastore.scan_page_size": 4}):
+      results = list(
+          data_store.DB.ScanAttributes("aff4:/paged",
+                                       ["aff4:foo", "aff4:bar"]))
+      limited = list(
+          data_store.DB.ScanAttributes(
+              "aff4:/paged", ["aff4:foo", "aff4:bar"],
+              after_urn="aff4:/paged/05",
+              max_records=10))
+
+    self.assertEqual([s for s, _ in results],
+                     ["aff4:/paged/%02d" % i for i in range(25)])
+    for i, (_, values) in enumerate(results):
+      self.assertEqual(values["aff4:foo"], (1000, "foo %d" % i))
+      if i % 3:
+        self.assertEqual(values["aff4:bar"], (1000, "bar %d" % i))
+      else:
+        self.assertNotIn("aff4:bar", values)
+
+    self.assertEqual([s for s, _ in limited],
+                     ["aff4:/paged/%02d" % i for i in range(6, 16)])
+
   def testRDFDatetimeTimestamps(self):
 
     test_rows = self._MakeTimestampedRows()
@@ -860,6 +889,31 @@ class DataStoreTestMixin(object):
 
     t1.Release()
 
+  @DBSubjectLockTest
+  def testMultiDBSubjectLockSkipsLockedSubjects(self):
+    subjects = [u"aff4:/metadata:rowÎñţér%d" % i for i in range(3)]
+
+    t1 = data_store.DB.DBSubjectLock(subjects[1], lease_time=100)
+    locks = data_store.DB.MultiDBSubjectLock(subjects, lease_time=100)
+    self.assertEqual(sorted(locks), [subjects[0], subjects[2]])
+
+    # The subjects we got are really locked.
+    for subject in [subjects[0], subjects[2]]:
+      self.assertRaises(
+          data_store.DBSubjectLockError,
+          data_store.DB.DBSubjectLock,
+          subject,
+          lease_time=100)
+
+    for lock in locks.values():
+      lock.Release()
+    t1.Release()
+
+    locks = data_store.DB.MultiDBSubjectLock(subjects, lease_time=100)
+    self.assertEqual(sorted(locks), subjects)
+    for lock in locks.values():
+      lock.Release()
+
   @DBSubjectLockTest
   def testDBSubjectLockLease(self):
     # This needs to be current time or cloud bigtable server will reply with
@@ -1492,6 +1546,108 @@ class DataStoreTestMixin(object):
     stored, _ = data_store.DB.Resolve(self.test_row, predicate)
     self.assertIsNone(stored)
 
+  def testPoolAutoFlushesOnRecordLimit(self):
+    pool = data_store.MutationPool(max_records=3, max_bytes=0)
+
+    pool.Set(self.test_row + "1", "aff4:size", 1)
+    pool.Set(self.test_row + "2", "aff4:size", 2)
+    stored, _ = data_store.DB.Resolve(self.test_row + "1", "aff4:size")
+    self.assertIsNone(stored)
+
+    pool.Set(self.test_row + "3", "aff4:size", 3)
+    for i in range(1, 4):
+      stored, _ = data_store.DB.Resolve(self.test_row + str(i), "aff4:size")
+      self.assertEqual(stored, i)
+
+    self.assertEqual(pool.Size(), 0)
+    self.assertEqual(pool.auto_flush_count, 1)
+
+  def testPoolDoesNotAutoFlushByDefault(self):
+    pool = data_store.MutationPool()
+
+    for i in range(100):
+      pool.Set(self.test_row + str(i), "aff4:size", i)
+
+    self.assertEqual(pool.Size(), 100)
+    self.assertEqual(pool.auto_flush_count, 0)
+
+  def testPoolAutoFlushesOnByteLimit(self):
+    pool = data_store.MutationPool(max_records=0, max_bytes=100)
+
+    pool.Set(self.test_row, "aff4:stored", "x" * 10)
+    self.assertEqual(pool.Size(), 1)
+
+    pool.Set(self.test_row, "aff4:stored", "x" * 100)
+    self.assertEqual(pool.Size(), 0)
+    stored, _ = data_store.DB.Resolve(self.test_row, "aff4:stored")
+    self.assertEqual(stored, "x" * 100)
+
+  def testPoolCoalescesWritesToTheSameSubject(self):
+    pool = data_store.MutationPool(max_records=0, max_bytes=0)
+
+    pool.Set(self.test_row, "aff4:size", 1, timestamp=1000)
+    pool.Set(self.test_row, "aff4:stored", "hello", timestamp=1000)
+    pool.Set(self.test_row, "aff4:size", 2, timestamp=1000)
+    # Different timestamps for the same subject are not merged.
+    pool.Set(self.test_row + "X", "aff4:size", 3, timestamp=1000)
+    pool.Set(self.test_row + "X", "aff4:size", 4, timestamp=2000)
+
+    multi_set_calls = []
+    original_multi_set = data_store.DB.MultiSet
+
+    def MultiSetLogger(subject, values, **kwargs):
+      multi_set_calls.append(subject)
+      return original_multi_set(subject, values, **kwargs)
+
+    with mock.patch.object(data_store.DB, "MultiSet", MultiSetLogger):
+      pool.Flush()
+
+    self.assertEqual(len(multi_set_calls), 3)
+    self.assertEqual(pool.coalesced_count, 2)
+
+    stored, ts = data_store.DB.Resolve(self.test_row, "aff4:size")
+    self.assertEqual(stored, 2)
+    self.assertEqual(ts, 1000)
+    stored, _ = data_store.DB.Resolve(self.test_row, "aff4:stored")
+    self.assertEqual(stored, "hello")
+    stored, ts = data_store.DB.Resolve(self.test_row + "X", "aff4:size")
+    self.assertEqual(stored, 4)
+    self.assertEqual(ts, 2000)
+
+  def testPoolFlushesExpiredMutations(self):
+    pool = data_store.MutationPool(
+        max_records=0, max_bytes=0, flush_interval=10)
+    now = time.time()
+    with test_lib.FakeTime(now):
+      pool.Set(self.test_row, "aff4:size", 1)
+
+    pool.FlushIfExpired(now=now + 5)
+    stored, _ = data_store.DB.Resolve(self.test_row, "aff4:size")
+    self.assertIsNone(stored)
+
+    pool.FlushIfExpired(now=now + 10)
+    stored, _ = data_store.DB.Resolve(self.test_row, "aff4:size")
+    self.assertEqual(stored, 1)
+    self.assertEqual(pool.auto_flush_count, 1)
+
+  def testQueueExpireChangesDeletesAllExpiredBuckets(self):
+    bucket_size = data_store.DB.QUEUE_CHANGES_BUCKET_SIZE
+    retention = data_store.DB.QUEUE_CHANGES_RETENTION
+    now = 100 * retention
+
+    # Buckets which expired long ago, e.g. while no frontend was running.
+    for timestamp in [bucket_size, 50 * retention, now - retention - 1]:
+      data_store.DB.QueueRecordChanges(["aff4:/C.1/tasks"], timestamp=timestamp)
+    data_store.DB.QueueRecordChanges(["aff4:/C.2/tasks"], timestamp=now)
+
+    data_store.DB.QueueExpireChanges(now=now)
+
+    self.assertEqual(
+        data_store.DB.QueueReadChanges(0, now - retention), set())
+    self.assertEqual(
+        data_store.DB.QueueReadChanges(now - retention, now),
+        set([u"aff4:/C.2/tasks"]))
+
   def testQueueManager(self):
     session_id = rdfvalue.SessionID(flow_name="test")
     client_id = test_lib.TEST_CLIENT_ID
@@ -1588,6 +1744,129 @@ class DataStoreTestMixin(object):
         session_id.Queue())
     self.assertEqual(len(stored_notifications), 1)
 
+  def _CreateNotification(self, queue_shard, flow_name, timestamp, priority):
+    session_id = rdfvalue.SessionID(
+        queue=rdfvalue.RDFURN("aff4:/F"), flow_name=flow_name)
+    data_store.DB.CreateNotifications(queue_shard, [
+        rdf_flows.GrrNotification(
+            session_id=session_id, timestamp=timestamp, priority=priority)
+    ])
+    return session_id
+
+  def testNotificationsAreReadByPriorityAndDueTime(self):
+    queue_shard = rdfvalue.RDFURN("aff4:/F/3")
+    priorities = rdf_flows.GrrMessage.Priority
+    bucket_size = data_store.DB.NOTIFY_BUCKET_SIZE
+
+    self._CreateNotification(queue_shard, "low", bucket_size,
+                             priorities.LOW_PRIORITY)
+    self._CreateNotification(queue_shard, "late", 3 * bucket_size,
+                             priorities.HIGH_PRIORITY)
+    self._CreateNotification(queue_shard, "high", 2 * bucket_size,
+                             priorities.HIGH_PRIORITY)
+    self._CreateNotification(queue_shard, "early", 0, priorities.HIGH_PRIORITY)
+    self._CreateNotification(queue_shard, "future", 10 * bucket_size,
+                             priorities.HIGH_PRIORITY)
+
+    notifications = data_store.DB.GetNotifications(queue_shard,
+                                                   3 * bucket_size)
+    self.assertEqual([n.session_id.FlowName() for n in notifications],
+                     ["early", "high", "late", "low"])
+
+    notifications = data_store.DB.GetNotifications(
+        queue_shard, 3 * bucket_size, limit=2)
+    self.assertEqual([n.session_id.FlowName() for n in notifications],
+                     ["early", "high"])
+
+    # Notifications due later in a ready bucket are not returned.
+    notifications = data_store.DB.GetNotifications(queue_shard,
+                                                   3 * bucket_size - 1)
+    self.assertEqual([n.session_id.FlowName() for n in notifications],
+                     ["early", "high", "low"])
+
+  def testDeleteNotificationsFromBuckets(self):
+    queue_shard = rdfvalue.RDFURN("aff4:/F/3")
+    priority = rdf_flows.GrrMessage.Priority.MEDIUM_PRIORITY
+    bucket_size = data_store.DB.NOTIFY_BUCKET_SIZE
+
+    first = self._CreateNotification(queue_shard, "first", 10, priority)
+    second = self._CreateNotification(queue_shard, "second", 2 * bucket_size,
+                                      priority)
+
+    data_store.DB.DeleteNotifications([queue_shard], [first, second], 0,
+                                      bucket_size)
+
+    notifications = data_store.DB.GetNotifications(queue_shard,
+                                                   3 * bucket_size)
+    self.assertEqual([n.session_id for n in notifications], [second])
+
+  def testEmptyNotificationBucketsAreDropped(self):
+    queue_shard = rdfvalue.RDFURN("aff4:/F/3")
+    priority = rdf_flows.GrrMessage.Priority.MEDIUM_PRIORITY
+    now = rdfvalue.RDFDatetime.FromSecondsSinceEpoch(100000)
+    previous = now - rdfvalue.Duration("1m")
+    old = self._CreateNotification(queue_shard, "old", 10, priority)
+    last = self._CreateNotification(queue_shard, "last", previous, priority)
+    recent = self._CreateNotification(queue_shard, "recent", now, priority)
+    data_store.DB.DeleteNotifications([queue_shard], [old, last, recent], 0,
+                                      now)
+
+    with test_lib.FakeTime(now):
+      self.assertEqual(list(data_store.DB.GetNotifications(queue_shard, now)),
+                       [])
+
+    # Only the current bucket is kept, it may hold notifications due later.
+    buckets = data_store.DB.ResolvePrefix(queue_shard,
+                                          data_store.DB.NOTIFY_BUCKET_PREFIX)
+    self.assertEqual([predicate for predicate, _, _ in buckets], [
+        data_store.DB.NOTIFY_BUCKET_TEMPLATE %
+        (priority, int(now) // data_store.DB.NOTIFY_BUCKET_SIZE)
+    ])
+
+  def testRequeuesIntoDroppedBucketsAreKept(self):
+    queue_shard = rdfvalue.RDFURN("aff4:/F/3")
+    priority = rdf_flows.GrrMessage.Priority.MEDIUM_PRIORITY
+    now = rdfvalue.RDFDatetime.FromSecondsSinceEpoch(100000)
+    old = self._CreateNotification(queue_shard, "old", 10, priority)
+    data_store.DB.DeleteNotifications([queue_shard], [old], 0, now)
+
+    delete_attributes = data_store.DB.DeleteAttributes
+
+    def RequeueThenDelete(*args, **kwargs):
+      # A flow requeues its notification with the original due time while
+      # the empty bucket is dropped.
+      self._CreateNotification(queue_shard, "requeued", 10, priority)
+      return delete_attributes(*args, **kwargs)
+
+    with test_lib.FakeTime(now):
+      with mock.patch.object(
+          data_store.DB, "DeleteAttributes", side_effect=RequeueThenDelete):
+        self.assertEqual(
+            list(data_store.DB.GetNotifications(queue_shard, now)), [])
+
+      notifications = data_store.DB.GetNotifications(queue_shard, now)
+      self.assertEqual([n.session_id.FlowName() for n in notifications],
+                       ["requeued"])
+
+  def testUnbucketedNotificationsAreRead(self):
+    queue_shard = rdfvalue.RDFURN("aff4:/F/3")
+    session_id = rdfvalue.SessionID(
+        queue=rdfvalue.RDFURN("aff4:/F"), flow_name="old")
+    notification = rdf_flows.GrrNotification(session_id=session_id)
+    data_store.DB.MultiSet(
+        queue_shard, {
+            data_store.DB.NOTIFY_PREDICATE_TEMPLATE % session_id:
+                [(notification.SerializeToString(), 10)]
+        },
+        sync=True)
+
+    notifications = list(data_store.DB.GetNotifications(queue_shard, 100))
+    self.assertEqual([n.session_id for n in notifications], [session_id])
+
+    data_store.DB.DeleteNotifications([queue_shard], [session_id], 0, 100)
+    self.assertEqual(list(data_store.DB.GetNotifications(queue_shard, 100)),
+                     [])
+
 
 @pytest.mark.benchmark
 class DataStoreCSVBenchmarks(benchmark_test_lib.MicroBenchmarks):
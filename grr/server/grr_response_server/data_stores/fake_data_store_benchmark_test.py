@@ -4,6 +4,7 @@
 
 from grr.lib import flags
 from grr.server.grr_response_server import data_store_test
+from grr.server.grr_response_server import worker_benchmark_test
 from grr.test_lib import test_lib
 
 
@@ -11,6 +12,10 @@ class FakeDataStoreBenchmarks(data_store_test.DataStoreBenchmarks):
   """Benchmark the fake data store."""
 
 
+class FakeDataStoreWorkerBenchmarks(worker_benchmark_test.WorkerBenchmarks):
+  """Benchmark processing flows on the fake data store."""
+
+
 def main(args):
   test_lib.main(args)
 
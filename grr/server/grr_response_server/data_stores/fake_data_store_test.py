@@ -3,6 +3,10 @@
 
 
 from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import utils
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.server.grr_response_server import data_store
 from grr.server.grr_response_server import data_store_test
 from grr.test_lib import test_lib
 
@@ -15,6 +19,117 @@ class FakeDataStoreTest(data_store_test.DataStoreTestMixin,
     """The fake datastore doesn't strictly conform to the api but this is ok."""
 
 
+class ReadCachingFakeDataStoreTest(data_store_test.DataStoreTestMixin,
+                                   test_lib.GRRBaseTest):
+  """Test the fake data store behind a read cache caching all subjects."""
+
+  def setUp(self):
+    self.cache_stubber = utils.Stubber(
+        data_store, "DB",
+        data_store.ReadCachingDataStore(
+            data_store.DB, max_size=1000, max_age=600,
+            subject_regexes=[".*"]))
+    self.cache_stubber.Start()
+    super(ReadCachingFakeDataStoreTest, self).setUp()
+
+  def tearDown(self):
+    super(ReadCachingFakeDataStoreTest, self).tearDown()
+    self.cache_stubber.Stop()
+
+  def testApi(self):
+    """The fake datastore doesn't strictly conform to the api but this is ok."""
+
+  def testReadsAreServedFromCache(self):
+    data_store.DB.Set(self.test_row, "aff4:size", 1)
+    self.assertEqual(data_store.DB.Resolve(self.test_row, "aff4:size")[0], 1)
+
+    # Write behind the cache's back, the cached value is still returned.
+    data_store.DB.delegate.Set(self.test_row, "aff4:size", 2)
+    self.assertEqual(data_store.DB.Resolve(self.test_row, "aff4:size")[0], 1)
+
+    # Writes through the cache invalidate the subject.
+    data_store.DB.Set(self.test_row, "aff4:stored", "hello")
+    self.assertEqual(data_store.DB.Resolve(self.test_row, "aff4:size")[0], 2)
+
+  def testCachedReadsExpire(self):
+    with test_lib.FakeTime(1000):
+      data_store.DB.Set(self.test_row, "aff4:size", 1)
+      data_store.DB.ResolvePrefix(self.test_row, "aff4:")
+      data_store.DB.delegate.Set(self.test_row, "aff4:size", 2)
+
+    with test_lib.FakeTime(1000 + 599):
+      (_, value, _), = data_store.DB.ResolvePrefix(self.test_row, "aff4:")
+      self.assertEqual(value, 1)
+
+    with test_lib.FakeTime(1000 + 601):
+      (_, value, _), = data_store.DB.ResolvePrefix(self.test_row, "aff4:")
+      self.assertEqual(value, 2)
+
+  def testMultiResolvePrefixCachesEmptySubjects(self):
+    data_store.DB.Set(self.test_row, "aff4:size", 1)
+    subjects = [self.test_row, self.test_row + "X"]
+
+    self.assertEqual(
+        len(list(data_store.DB.MultiResolvePrefix(subjects, "aff4:"))), 1)
+
+    data_store.DB.delegate.Set(self.test_row + "X", "aff4:size", 1)
+    self.assertEqual(
+        len(list(data_store.DB.MultiResolvePrefix(subjects, "aff4:"))), 1)
+
+    data_store.DB.Invalidate(self.test_row + "X")
+    self.assertEqual(
+        len(list(data_store.DB.MultiResolvePrefix(subjects, "aff4:"))), 2)
+
+  def testFlushOnlyInvalidatesBufferedSubjects(self):
+    other_row = self.test_row + "X"
+    data_store.DB.Set(self.test_row, "aff4:size", 1)
+    data_store.DB.Set(other_row, "aff4:size", 1)
+    data_store.DB.ResolvePrefix(self.test_row, "aff4:")
+    data_store.DB.ResolvePrefix(other_row, "aff4:")
+
+    data_store.DB.delegate.Set(other_row, "aff4:size", 2)
+    with data_store.DB.GetMutationPool() as pool:
+      pool.Set(self.test_row, "aff4:size", 3)
+
+    (_, value, _), = data_store.DB.ResolvePrefix(self.test_row, "aff4:")
+    self.assertEqual(value, 3)
+    # The flush did not drop the cached result for the other subject.
+    (_, value, _), = data_store.DB.ResolvePrefix(other_row, "aff4:")
+    self.assertEqual(value, 1)
+
+  def testUnsyncedWritesAreNotCachedBeforeFlush(self):
+    data_store.DB.Set(self.test_row, "aff4:size", 1)
+    data_store.DB.Set(self.test_row, "aff4:size", 2, sync=False)
+
+    # Reading before the flush must not keep a result in the cache that
+    # predates the buffered write.
+    data_store.DB.ResolvePrefix(self.test_row, "aff4:")
+    data_store.DB.delegate.Set(self.test_row, "aff4:size", 3)
+    (_, value, _), = data_store.DB.ResolvePrefix(self.test_row, "aff4:")
+    self.assertEqual(value, 3)
+
+    data_store.DB.Flush()
+    data_store.DB.ResolvePrefix(self.test_row, "aff4:")
+    data_store.DB.delegate.Set(self.test_row, "aff4:size", 4)
+    (_, value, _), = data_store.DB.ResolvePrefix(self.test_row, "aff4:")
+    self.assertEqual(value, 3)
+
+  def testGenericWritesInvalidate(self):
+    queue_shard = rdfvalue.RDFURN("aff4:/W").Add("shard1")
+    now = rdfvalue.RDFDatetime.Now()
+    self.assertEqual(
+        list(data_store.DB.GetNotifications(queue_shard, now + 10)), [])
+
+    # CreateNotifications is implemented on top of the DataStore primitives,
+    # the cache still sees its writes.
+    data_store.DB.CreateNotifications(queue_shard, [
+        rdf_flows.GrrNotification(
+            session_id=rdfvalue.SessionID(flow_name="test"), timestamp=now)
+    ])
+    self.assertEqual(
+        len(list(data_store.DB.GetNotifications(queue_shard, now + 10))), 1)
+
+
 def main(args):
   test_lib.main(args)
 
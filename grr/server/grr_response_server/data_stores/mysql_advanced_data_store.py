@@ -2,6 +2,8 @@
 # -*- mode: python; encoding: utf-8 -*-
 """An implementation of a data store based on mysql."""
 
+import collections
+import hashlib
 import logging
 import os
 import Queue
@@ -19,11 +21,17 @@ from grr.lib import rdfvalue
 from grr.lib import utils
 from grr.server.grr_response_server import aff4
 from grr.server.grr_response_server import data_store
+from grr.server.grr_response_server import threadpool
 
 # We use INSERT IGNOREs which generate useless duplicate entry warnings.
 filterwarnings("ignore", category=MySQLdb.Warning, message=r"Duplicate entry.*")
 
 
+def _Hash(value):
+  """Returns the hex md5 of a subject or attribute, like md5() in MySQL."""
+  return hashlib.md5(utils.SmartStr(value)).hexdigest()
+
+
 # pylint: disable=nonstandard-exception
 class Error(data_store.Error):
   """Base class for all exceptions in this module."""
@@ -154,6 +162,10 @@ class MySQLAdvancedDataStore(data_store.DataStore):
   """A mysql based data store."""
 
   POOL = None
+  RESOLVE_POOL = None
+
+  # Approximate size of a row in an aff4 INSERT, excluding the value.
+  INSERT_ROW_OVERHEAD = 200
 
   def __init__(self, database_name=None):
     self.database_name = database_name or config.CONFIG["Mysql.database_name"]
@@ -171,6 +183,12 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     self.max_query_size = config.CONFIG["Mysql.max_query_size"]
     self.max_values_per_query = config.CONFIG["Mysql.max_values_per_query"]
     self.max_retries = config.CONFIG["Mysql.max_retries"]
+    self.resolve_batch_size = config.CONFIG["Mysql.multi_resolve_batch_size"]
+    # Each concurrent batch holds a pooled connection, so never run more
+    # batches than the pool may open.
+    self.resolve_parallelism = min(
+        config.CONFIG["Mysql.multi_resolve_parallelism"],
+        int(config.CONFIG["Mysql.conn_pool_max"]))
 
     super(MySQLAdvancedDataStore, self).__init__()
 
@@ -182,6 +200,16 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       logging.debug("Recreating Tables")
       self.RecreateTables()
 
+    # Bulk writes are sized so they fit into a single packet.
+    rows, _ = self.ExecuteQuery("SELECT @@max_allowed_packet AS max_packet")
+    max_packet = int(rows[0]["max_packet"])
+    if self.max_query_size > max_packet * 3 / 4:
+      logging.warning(
+          "Mysql.max_query_size (%d) is too big for max_allowed_packet (%d), "
+          "using %d instead.", self.max_query_size, max_packet,
+          max_packet * 3 / 4)
+      self.max_query_size = max_packet * 3 / 4
+
   @classmethod
   def SetupTestDB(cls):
     super(MySQLAdvancedDataStore, cls).SetupTestDB()
@@ -219,6 +247,53 @@ class MySQLAdvancedDataStore(data_store.DataStore):
   def DBSubjectLock(self, subject, lease_time=None):
     return MySQLDBSubjectLock(self, subject, lease_time=lease_time)
 
+  def MultiDBSubjectLock(self, subjects, lease_time=None):
+    """Locks many subjects with two queries instead of one per subject."""
+    if lease_time is None:
+      raise ValueError("Trying to lock without a lease time.")
+
+    by_hash = {}
+    for subject in subjects:
+      by_hash[_Hash(subject).upper()] = subject
+    if not by_hash:
+      return {}
+
+    lock_token = thread.get_ident()
+    expires = int((time.time() + lease_time) * 1e6)
+    now = int(time.time() * 1e6)
+
+    # Takes over rows that are not currently locked and leaves the others
+    # alone. MySQL evaluates the assignments from left to right, so
+    # lock_expiration has to be updated last.
+    query = ("INSERT INTO locks(subject_hash, lock_expiration, lock_owner) "
+             "VALUES " + ", ".join(["(unhex(%s), %s, %s)"] * len(by_hash)) +
+             " ON DUPLICATE KEY UPDATE "
+             "lock_owner=IF(lock_expiration > %s, lock_owner, "
+             "VALUES(lock_owner)), "
+             "lock_expiration=IF(lock_expiration > %s, lock_expiration, "
+             "VALUES(lock_expiration))")
+    args = []
+    for subject_hash in by_hash:
+      args.extend([subject_hash, expires, lock_token])
+    args.extend([now, now])
+    self.ExecuteQuery(query, args)
+
+    query = ("SELECT hex(subject_hash) AS subject_hash FROM locks "
+             "WHERE subject_hash IN (" + ", ".join(["unhex(%s)"] * len(by_hash))
+             + ") AND lock_owner=%s AND lock_expiration=%s")
+    args = list(by_hash) + [lock_token, expires]
+    rows, _ = self.ExecuteQuery(query, args)
+
+    locks = {}
+    for row in rows:
+      subject = by_hash[row["subject_hash"]]
+      locks[subject] = MySQLDBSubjectLock(
+          self,
+          subject,
+          lease_time=lease_time,
+          acquired=(lock_token, expires))
+    return locks
+
   def Size(self):
     query = ("SELECT table_schema, Sum(data_length + index_length) `size` "
              "FROM information_schema.tables "
@@ -279,6 +354,24 @@ class MySQLAdvancedDataStore(data_store.DataStore):
                          timestamp=None,
                          limit=None):
     """Result multiple subjects using one or more attribute regexps."""
+    # A total limit needs the subjects to be read in order, so we can't fan
+    # out in that case.
+    if limit:
+      return self._SerialMultiResolvePrefix(
+          subjects, attribute_prefix, timestamp=timestamp, limit=limit)
+
+    if isinstance(attribute_prefix, basestring):
+      attribute_prefix = [attribute_prefix]
+
+    return self._BatchedMultiResolvePrefix(
+        list(subjects), attribute_prefix, timestamp=timestamp)
+
+  def _SerialMultiResolvePrefix(self,
+                                subjects,
+                                attribute_prefix,
+                                timestamp=None,
+                                limit=None):
+    """Resolves subjects one by one, stopping once limit values were read."""
     result = {}
 
     for subject in subjects:
@@ -295,6 +388,92 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
     return result.iteritems()
 
+  def _GetResolvePool(self):
+    if MySQLAdvancedDataStore.RESOLVE_POOL is None:
+      pool = threadpool.ThreadPool.Factory(
+          "MySQLAdvancedResolve", 1, max_threads=self.resolve_parallelism)
+      pool.Start()
+      MySQLAdvancedDataStore.RESOLVE_POOL = pool
+    return MySQLAdvancedDataStore.RESOLVE_POOL
+
+  def _BatchedMultiResolvePrefix(self,
+                                 subjects,
+                                 attribute_prefixes,
+                                 timestamp=None):
+    """Resolves subjects in batches, running the batches concurrently.
+
+    Args:
+      subjects: A list of subjects.
+      attribute_prefixes: A list of attribute prefixes.
+      timestamp: A timestamp specification, see MultiResolvePrefix.
+
+    Yields:
+      (subject, values) tuples in the order in which batches complete.
+
+    Raises:
+      Error: If a batch could not be resolved.
+    """
+    batch_size = self.resolve_batch_size
+    batches = [
+        subjects[i:i + batch_size] for i in xrange(0, len(subjects), batch_size)
+    ]
+
+    if len(batches) <= 1 or self.resolve_parallelism <= 1:
+      for batch in batches:
+        for item in self._ResolvePrefixBatch(batch, attribute_prefixes,
+                                             timestamp):
+          yield item
+      return
+
+    results = Queue.Queue()
+
+    def ResolveBatch(batch):
+      try:
+        results.put((self._ResolvePrefixBatch(batch, attribute_prefixes,
+                                              timestamp), None))
+      except Exception as e:  # pylint: disable=broad-except
+        results.put((None, e))
+
+    pool = self._GetResolvePool()
+    for batch in batches:
+      # Tasks are run inline when the pool is busy, so this can't deadlock
+      # with other threads resolving at the same time.
+      pool.AddTask(ResolveBatch, (batch,), name="MultiResolvePrefix")
+
+    for _ in batches:
+      batch_results, error = results.get()
+      if error is not None:
+        raise error
+      for item in batch_results:
+        yield item
+
+  def _ResolvePrefixBatch(self, subjects, attribute_prefixes, timestamp):
+    """Resolves attribute prefixes for a batch of subjects in one query."""
+    subjects_by_hash = {}
+    for subject in subjects:
+      subject_hash = _Hash(subject).upper()
+      subjects_by_hash[subject_hash] = subject
+
+    query, args = self._BuildMultiPrefixQuery(
+        [utils.SmartUnicode(s) for s in subjects_by_hash.itervalues()],
+        attribute_prefixes, timestamp)
+    rows, _ = self.ExecuteQuery(query, args)
+
+    results = {}
+    for row in rows:
+      subject = subjects_by_hash[row["subject_hash"]]
+      attribute = row["attribute"]
+      value = self._Decode(attribute, row["value"])
+      results.setdefault(subject, []).append((attribute, value,
+                                              row["timestamp"]))
+
+    # Rows are in decreasing timestamp order, the stable sort keeps this
+    # order for values of the same attribute.
+    for values in results.itervalues():
+      values.sort(key=lambda x: x[0])
+
+    return results.items()
+
   def ResolvePrefix(self, subject, attribute_prefix, timestamp=None,
                     limit=None):
     """ResolvePrefix."""
@@ -324,6 +503,14 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       subject_prefix += "/"
     subject_prefix += "%"
 
+    # The limit has to be applied to the derived table as well, otherwise
+    # every page aggregates all subjects after after_urn.
+    subquery_limit = ""
+    limit_args = []
+    if limit:
+      subquery_limit = "ORDER BY subjects.subject LIMIT %s"
+      limit_args = [limit]
+
     query = """
     SELECT aff4.value, aff4.timestamp, subjects.subject
       FROM aff4
@@ -332,16 +519,17 @@ class MySQLAdvancedDataStore(data_store.DataStore):
             SELECT subject_hash, MAX(timestamp) timestamp
             FROM aff4
             JOIN subjects ON aff4.subject_hash=subjects.hash
-            WHERE aff4.attribute_hash=unhex(md5(%s))
-                  AND subjects.subject like %s
-                  AND subjects.subject > %s
-            GROUP BY subject_hash
+            WHERE aff4.attribute_hash=unhex(md5(%%s))
+                  AND subjects.subject like %%s
+                  AND subjects.subject > %%s
+            GROUP BY subject_hash, subjects.subject
+            %s
             ) maxtime ON aff4.subject_hash=maxtime.subject_hash
                   AND aff4.timestamp=maxtime.timestamp
-      WHERE aff4.attribute_hash=unhex(md5(%s))
+      WHERE aff4.attribute_hash=unhex(md5(%%s))
       ORDER BY subjects.subject
-    """
-    args = [attribute, subject_prefix, after_urn, attribute]
+    """ % subquery_limit
+    args = [attribute, subject_prefix, after_urn] + limit_args + [attribute]
 
     if limit:
       query += " LIMIT %s"
@@ -363,28 +551,52 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     else:
       after_urn = ""
 
-    results = {}
-
-    for attribute in attributes:
-      attribute_results = self._ScanAttribute(
-          subject_prefix, attribute, after_urn=after_urn, limit=max_records)
-
-      for row in attribute_results:
-        subject = row["subject"]
-        timestamp = row["timestamp"]
-        value = self._Decode(attribute, row["value"])
-        if subject in results:
-          results[subject][attribute] = (timestamp, value)
-        else:
-          results[subject] = {attribute: (timestamp, value)}
-
+    pager = data_store.ScanPager()
     result_count = 0
-    for subject in sorted(results):
-      yield (subject, results[subject])
-      result_count += 1
-      if max_records and result_count >= max_records:
+    while True:
+      remaining = max_records and max_records - result_count
+      limit = pager.Limit(remaining)
+
+      results = {}
+      page_bytes = 0
+      # The last subject up to which all attributes have been read. None if
+      # all results have been read.
+      boundary = None
+      for attribute in attributes:
+        attribute_results = self._ScanAttribute(
+            subject_prefix, attribute, after_urn=after_urn, limit=limit)
+
+        for row in attribute_results:
+          subject = row["subject"]
+          timestamp = row["timestamp"]
+          value = self._Decode(attribute, row["value"])
+          page_bytes += len(row["value"] or "")
+          if subject in results:
+            results[subject][attribute] = (timestamp, value)
+          else:
+            results[subject] = {attribute: (timestamp, value)}
+
+        if len(attribute_results) >= limit:
+          last_subject = attribute_results[-1]["subject"]
+          if boundary is None or last_subject < boundary:
+            boundary = last_subject
+
+      for subject in sorted(results):
+        # Other attributes of subjects past the boundary will be read with
+        # the next page.
+        if boundary is not None and subject > boundary:
+          break
+        yield (subject, results[subject])
+        result_count += 1
+        if max_records and result_count >= max_records:
+          return
+
+      if boundary is None:
         return
 
+      after_urn = boundary
+      pager.Update(page_bytes)
+
   def MultiSet(self,
                subject,
                values,
@@ -420,13 +632,11 @@ class MySQLAdvancedDataStore(data_store.DataStore):
         attribute = utils.SmartUnicode(attribute)
         data = self._Encode(value)
 
-        # Replacing means to delete all versions of the attribute first.
+        # Replacing means to delete all versions of the attribute first. The
+        # deletes are batched, so this is cheaper than checking for existing
+        # rows first.
         if replace or attribute in to_delete:
-          existing = self._CountExistingRows(subject, attribute)
-          if existing:
-            to_replace.append([subject, attribute, data, entry_timestamp])
-          else:
-            to_insert.append([subject, attribute, data, entry_timestamp])
+          to_replace.append([subject, attribute, data, entry_timestamp])
           if attribute in to_delete:
             to_delete.remove(attribute)
 
@@ -451,14 +661,6 @@ class MySQLAdvancedDataStore(data_store.DataStore):
         with self.buffer_lock:
           self.to_insert.extend(to_insert)
 
-  def _CountExistingRows(self, subject, attribute):
-    query = ("SELECT count(*) AS total FROM aff4 "
-             "WHERE subject_hash=unhex(md5(%s)) "
-             "AND attribute_hash=unhex(md5(%s))")
-    args = [subject, attribute]
-    result, _ = self.ExecuteQuery(query, args)
-    return int(result[0]["total"])
-
   @utils.Synchronized
   def Flush(self):
     # TODO(amoser): There is a race condition here. The locking only
@@ -490,68 +692,130 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       self._ExecuteTransaction(transaction)
 
   def _BuildReplaces(self, values):
-    transaction = []
-    updates = {}
+    """Builds queries replacing all versions of the given attributes."""
+    updates = collections.OrderedDict()
+    for (subject, attribute, data, timestamp) in values:
+      updates[(subject, attribute)] = (data, timestamp)
+
     to_insert = []
+    for (subject, attribute), (data, timestamp) in updates.iteritems():
+      to_insert.append([subject, attribute, data, timestamp])
 
-    for (subject, attribute, data, timestamp) in values:
-      updates.setdefault(subject, {})[attribute] = [data, timestamp]
-
-    for subject in updates:
-      for attribute in updates[subject]:
-        data = updates[subject][attribute][0]
-        timestamp = updates[subject][attribute][1]
-        to_insert.append([subject, attribute, data, timestamp])
-        delete_q = self._BuildDelete(subject, attribute)[0]
-        transaction.append(delete_q)
+    transaction = self._BuildBulkDeletes(updates.keys())
     transaction.extend(self._BuildInserts(to_insert))
     return transaction
 
+  def _BuildBulkDeletes(self, subject_attributes):
+    """Builds queries deleting all versions of (subject, attribute) pairs.
+
+    Attributes are grouped by subject so that each query covers many pairs.
+
+    Args:
+      subject_attributes: A list of (subject, attribute) tuples.
+
+    Returns:
+      A list of query dicts.
+    """
+    by_subject = collections.OrderedDict()
+    for subject, attribute in subject_attributes:
+      by_subject.setdefault(subject, []).append(attribute)
+
+    result_queries = []
+    conditions = []
+    current_args = []
+    for subject, attributes in by_subject.iteritems():
+      conditions.append("(subject_hash=unhex(%s) AND attribute_hash IN (" +
+                        ", ".join(["unhex(%s)"] * len(attributes)) + "))")
+      current_args.append(_Hash(subject))
+      current_args.extend(_Hash(attribute) for attribute in attributes)
+
+      if len(current_args) > self.max_values_per_query:
+        result_queries.append(
+            dict(
+                query="DELETE FROM aff4 WHERE " + " OR ".join(conditions),
+                args=current_args))
+        conditions = []
+        current_args = []
+
+    if current_args:
+      result_queries.append(
+          dict(
+              query="DELETE FROM aff4 WHERE " + " OR ".join(conditions),
+              args=current_args))
+
+    return result_queries
+
   def _BuildAff4InsertQuery(self, args):
     return ("INSERT INTO aff4 (subject_hash, attribute_hash, "
             "timestamp, value) VALUES") + ", ".join([
-                "(unhex(md5(%s)), unhex(md5(%s)), "
+                "(unhex(%s), unhex(%s), "
                 "if(%s is NULL,floor(unix_timestamp(now(6))*1000000),%s), "
                 "unhex(%s))"
             ] * (len(args) / 5))
 
+  def _BuildLookupInserts(self, table, column, hashes):
+    """Builds queries adding (hash, name) rows to the subjects/attributes."""
+    result_queries = []
+    current_args = []
+    query = "INSERT IGNORE INTO %s (hash, %s) VALUES" % (table, column)
+    for name, name_hash in hashes.iteritems():
+      current_args.extend([name_hash, name])
+      if len(current_args) >= self.max_values_per_query * 2:
+        result_queries.append(
+            dict(
+                query=query + ", ".join(["(unhex(%s), %s)"] *
+                                        (len(current_args) / 2)),
+                args=current_args))
+        current_args = []
+
+    if current_args:
+      result_queries.append(
+          dict(
+              query=query + ", ".join(["(unhex(%s), %s)"] *
+                                      (len(current_args) / 2)),
+              args=current_args))
+
+    return result_queries
+
   def _BuildInserts(self, values):
-    subjects_q = {}
-    attributes_q = {}
+    """Builds multi row INSERT queries for the given rows.
 
-    subjects_q["query"] = "INSERT IGNORE INTO subjects (hash, subject) VALUES"
-    attributes_q["query"] = (
-        "INSERT IGNORE INTO attributes (hash, attribute) VALUES")
+    Subject and attribute hashes are computed once per name here instead of
+    once per row on the server. Queries are split so they stay below
+    max_query_size and max_values_per_query.
 
-    subjects_q["args"] = []
-    attributes_q["args"] = []
+    Args:
+      values: A list of [subject, attribute, value, timestamp] lists.
 
-    seen = {}
-    seen["subjects"] = []
-    seen["attributes"] = []
+    Returns:
+      A list of query dicts.
+    """
+    subject_hashes = collections.OrderedDict()
+    attribute_hashes = collections.OrderedDict()
 
     result_queries = []
     current_args = []
-    total_value_len = 0
+    total_query_len = 0
     max_args = self.max_values_per_query * 5
     for (subject, attribute, value, timestamp) in values:
-      if subject not in seen["subjects"]:
-        subjects_q["args"].extend([subject, subject])
-        seen["subjects"].append(subject)
-      if attribute not in seen["attributes"]:
-        attributes_q["args"].extend([attribute, attribute])
-        seen["attributes"].append(attribute)
-
-      current_args.extend([subject, attribute, timestamp, timestamp, value])
-      total_value_len += len(value)
-      if (total_value_len > self.max_query_size or
+      subject_hash = subject_hashes.get(subject)
+      if subject_hash is None:
+        subject_hash = subject_hashes[subject] = _Hash(subject)
+      attribute_hash = attribute_hashes.get(attribute)
+      if attribute_hash is None:
+        attribute_hash = attribute_hashes[attribute] = _Hash(attribute)
+
+      current_args.extend(
+          [subject_hash, attribute_hash, timestamp, timestamp, value])
+      total_query_len += len(value) + self.INSERT_ROW_OVERHEAD
+      if (total_query_len > self.max_query_size or
           len(current_args) > max_args):
         result_queries.append(
             dict(
                 query=self._BuildAff4InsertQuery(current_args),
                 args=current_args))
         current_args = []
-        total_value_len = 0
+        total_query_len = 0
 
     if current_args:
       result_queries.append(
@@ -559,11 +823,10 @@ class MySQLAdvancedDataStore(data_store.DataStore):
               query=self._BuildAff4InsertQuery(current_args),
               args=current_args))
 
-    subjects_q["query"] += ", ".join(["(unhex(md5(%s)), %s)"] *
-                                     (len(subjects_q["args"]) / 2))
-    attributes_q["query"] += ", ".join(["(unhex(md5(%s)), %s)"] *
-                                       (len(attributes_q["args"]) / 2))
-    result_queries.extend([attributes_q, subjects_q])
+    result_queries.extend(
+        self._BuildLookupInserts("attributes", "attribute", attribute_hashes))
+    result_queries.extend(
+        self._BuildLookupInserts("subjects", "subject", subject_hashes))
     return result_queries
 
   def _RetryWrapper(self, action_fn):
@@ -715,6 +978,45 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
     return (query, args)
 
+  def _BuildMultiPrefixQuery(self, subjects, attribute_prefixes,
+                             timestamp=None):
+    """Build a SELECT query resolving prefixes for many subjects at once."""
+    args = list(subjects)
+    criteria = "WHERE aff4.subject_hash IN (%s)" % ", ".join(
+        ["unhex(md5(%s))"] * len(subjects))
+
+    criteria += " AND (%s)" % " OR ".join(
+        ["attributes.attribute like %s"] * len(attribute_prefixes))
+    args.extend(prefix + "%" for prefix in attribute_prefixes)
+
+    # Limit to time range if specified
+    if isinstance(timestamp, (tuple, list)):
+      criteria += " AND aff4.timestamp >= %s AND aff4.timestamp <= %s"
+      args.append(int(timestamp[0]))
+      args.append(int(timestamp[1]))
+
+    fields = ("hex(aff4.subject_hash) subject_hash, attributes.attribute, "
+              "aff4.value, aff4.timestamp")
+    tables = "FROM aff4 JOIN attributes ON aff4.attribute_hash=attributes.hash"
+    sorting = ""
+
+    # Modify tables and sorting for timestamps.
+    if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
+      tables += (" JOIN (SELECT aff4.subject_hash, aff4.attribute_hash, "
+                 "MAX(aff4.timestamp) timestamp %s %s "
+                 "GROUP BY aff4.subject_hash, aff4.attribute_hash) maxtime ON "
+                 "aff4.subject_hash=maxtime.subject_hash AND "
+                 "aff4.attribute_hash=maxtime.attribute_hash AND "
+                 "aff4.timestamp=maxtime.timestamp") % (tables, criteria)
+      args += args
+    else:
+      # Always order results.
+      sorting = "ORDER BY aff4.timestamp DESC"
+
+    query = " ".join(["SELECT", fields, tables, criteria, sorting])
+
+    return (query, args)
+
   def _BuildDelete(self, subject, attribute=None, timestamp=None):
     """Build the DELETE query to be executed."""
     subjects_q = {
@@ -829,7 +1131,19 @@ class MySQLDBSubjectLock(data_store.DBSubjectLock):
   A lock is considered expired after a certain time.
   """
 
+  def __init__(self, data_store, subject, lease_time=None, acquired=None):
+    # Locks taken in bulk by MultiDBSubjectLock are passed in as a
+    # (lock_token, expires) tuple and need no query of their own.
+    self.acquired = acquired
+    super(MySQLDBSubjectLock, self).__init__(
+        data_store, subject, lease_time=lease_time)
+
   def _Acquire(self, lease_time):
+    if self.acquired:
+      self.lock_token, self.expires = self.acquired
+      self.locked = True
+      return
+
     self.lock_token = thread.get_ident()
     self.expires = int((time.time() + lease_time) * 1e6)
 
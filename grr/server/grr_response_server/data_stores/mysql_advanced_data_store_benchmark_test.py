@@ -5,6 +5,7 @@
 from grr.lib import flags
 from grr.server.grr_response_server import data_store_test
 from grr.server.grr_response_server.data_stores import mysql_advanced_data_store_test
+from grr.server.grr_response_server import worker_benchmark_test
 from grr.test_lib import test_lib
 
 
@@ -20,6 +21,12 @@ class MysqlAdvancedDataStoreCSVBenchmarks(
   """Benchmark the mysql data store abstraction."""
 
 
+class MysqlAdvancedDataStoreWorkerBenchmarks(
+    mysql_advanced_data_store_test.MysqlAdvancedTestMixin,
+    worker_benchmark_test.WorkerBenchmarks):
+  """Benchmark processing flows on the mysql data store."""
+
+
 def main(args):
   test_lib.main(args)
 
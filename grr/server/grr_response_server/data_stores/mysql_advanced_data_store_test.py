@@ -2,6 +2,7 @@
 """Tests the mysql data store."""
 
 from grr.lib import flags
+from grr.lib import utils
 from grr.server.grr_response_server import data_store
 from grr.server.grr_response_server import data_store_test
 from grr.server.grr_response_server.data_stores import mysql_advanced_data_store
@@ -35,6 +36,55 @@ class MysqlAdvancedDataStoreTest(data_store_test.DataStoreTestMixin,
         (int(version_major) == 5 and int(version_minor) <= 5)):
       self.fail("GRR needs MySQL >= 5.6")
 
+  def testMultiResolvePrefixInParallelBatches(self):
+    subjects = ["aff4:/C.%016X" % i for i in range(25)]
+    for i, subject in enumerate(subjects):
+      data_store.DB.MultiSet(subject, {
+          "metadata:hostname": ["host%d" % i],
+          "metadata:os": [("old", 1000), ("new", 2000)]
+      }, replace=False)
+    data_store.DB.Flush()
+
+    with utils.MultiStubber((data_store.DB, "resolve_batch_size", 4),
+                            (data_store.DB, "resolve_parallelism", 3)):
+      results = dict(
+          data_store.DB.MultiResolvePrefix(subjects + ["aff4:/missing"],
+                                           "metadata:"))
+      all_results = dict(
+          data_store.DB.MultiResolvePrefix(
+              subjects, "metadata:os",
+              timestamp=data_store.DB.ALL_TIMESTAMPS))
+
+    self.assertEqual(sorted(results), subjects)
+    for i, subject in enumerate(subjects):
+      self.assertEqual([(a, v) for a, v, _ in results[subject]],
+                       [("metadata:hostname", "host%d" % i),
+                        ("metadata:os", "new")])
+      self.assertEqual([(v, ts) for _, v, ts in all_results[subject]],
+                       [("new", 2000), ("old", 1000)])
+
+  def testBulkReplaces(self):
+    subjects = ["aff4:/bulk/%d" % i for i in range(100)]
+    with data_store.DB.GetMutationPool() as pool:
+      for subject in subjects:
+        pool.MultiSet(subject, {"metadata:value": ["first"]})
+        pool.MultiSet(subject, {"metadata:value": ["second"]})
+        pool.MultiSet(
+            subject, {"metadata:other": ["a", "b"]}, replace=False)
+
+    with data_store.DB.GetMutationPool() as pool:
+      for subject in subjects[:50]:
+        pool.MultiSet(subject, {"metadata:value": ["third"]})
+
+    for i, subject in enumerate(subjects):
+      values = data_store.DB.ResolvePrefix(
+          subject, "metadata:value", timestamp=data_store.DB.ALL_TIMESTAMPS)
+      self.assertEqual([v for _, v, _ in values],
+                       ["third" if i < 50 else "second"])
+      values = data_store.DB.ResolvePrefix(
+          subject, "metadata:other", timestamp=data_store.DB.ALL_TIMESTAMPS)
+      self.assertEqual(sorted(v for _, v, _ in values), ["a", "b"])
+
 
 def main(args):
   test_lib.main(args)
@@ -5,6 +5,7 @@ SQLite database files are created by taking the root of each AFF4 object.
 """
 
 
+import heapq
 import itertools
 import logging
 import os
@@ -34,6 +35,12 @@ SQLITE_CACHED_STATEMENTS = 20
 SQLITE_PAGE_SIZE = 1024
 
 
+def _ValueSize(value):
+  if isinstance(value, (basestring, buffer)):
+    return len(value)
+  return 8
+
+
 class SqliteConnectionCache(utils.FastStore):
   """A local cache of SQLite connection objects."""
 
@@ -809,6 +816,56 @@ class SqliteDataStore(data_store.DataStore):
     if current_results:
       yield (current_subject, current_results)
 
+  def _ScanConnection(self, sqlite_connection, subject_prefix, attributes,
+                      after_urn, max_records):
+    """Yields the raw scan results of one connection, reading page by page.
+
+    The connection is only locked while a page is read, so other threads can
+    use it while the results are consumed.
+
+    Args:
+      sqlite_connection: The SqliteConnection to scan.
+      subject_prefix: Subject prefix to scan.
+      attributes: A list of attributes to scan.
+      after_urn: Only scan subjects after this urn.
+      max_records: The maximum number of subjects to scan.
+
+    Yields:
+      (subject, attribute, timestamp, value) tuples ordered by subject.
+    """
+    pager = data_store.ScanPager()
+    subject_count = 0
+    while True:
+      limit = pager.Limit(max_records and max_records - subject_count)
+      with sqlite_connection:
+        page = list(
+            sqlite_connection.ScanAttributes(
+                subject_prefix,
+                attributes,
+                after_urn=after_urn,
+                max_records=limit))
+
+      # A short page means we have read everything.
+      if len(page) < limit * len(attributes):
+        for record in page:
+          yield record
+        return
+
+      # The last subject might not be complete, it is read again with the
+      # next page unless it is the only subject in the page.
+      last_subject = page[-1][0]
+      complete = [r for r in page if r[0] != last_subject] or page
+      for record in complete:
+        yield record
+
+      subjects = set(r[0] for r in complete)
+      subject_count += len(subjects)
+      if max_records and subject_count >= max_records:
+        return
+
+      after_urn = complete[-1][0]
+      pager.Update(sum(_ValueSize(r[3]) for r in page))
+
   def ScanAttributes(self,
                      subject_prefix,
                      attributes,
@@ -818,49 +875,18 @@ class SqliteDataStore(data_store.DataStore):
     subject_prefix = self._CleanSubjectPrefix(subject_prefix)
     after_urn = self._CleanAfterURN(after_urn, subject_prefix)
 
-    connection_iter = self.cache.GetPrefix(subject_prefix)
+    scans = [
+        self._ScanConnection(sqlite_connection, subject_prefix, attributes,
+                             after_urn, max_records)
+        for sqlite_connection in self.cache.GetPrefix(subject_prefix)
+    ]
     if relaxed_order:
-      for sqlite_connection in connection_iter:
-        with sqlite_connection:
-          for r in self._GroupSubjects(
-              list(
-                  sqlite_connection.ScanAttributes(
-                      subject_prefix,
-                      attributes,
-                      after_urn=after_urn,
-                      max_records=max_records)), max_records):
-            yield r
-      return
-    first_connections = []
-    try:
-      first_connections.append(connection_iter.next())
-      first_connections.append(connection_iter.next())
-    except StopIteration:
-      pass
-    if not first_connections:
-      return
-    if len(first_connections) == 1:
-      with first_connections[0] as sqlite_connection:
-        for r in self._GroupSubjects(
-            list(
-                sqlite_connection.ScanAttributes(
-                    subject_prefix,
-                    attributes,
-                    after_urn=after_urn,
-                    max_records=max_records)), max_records):
-          yield r
-      return
-    raw_results = []
-    for sqlite_connection in itertools.chain(first_connections,
-                                             connection_iter):
-      for record in sqlite_connection.ScanAttributes(
-          subject_prefix,
-          attributes,
-          after_urn=after_urn,
-          max_records=max_records):
-        raw_results.append(record)
-    for r in self._GroupSubjects(
-        sorted(raw_results, key=lambda x: x[0]), max_records):
+      records = itertools.chain(*scans)
+    else:
+      # Each scan is ordered by subject so they can be merged lazily.
+      records = heapq.merge(*scans)
+
+    for r in self._GroupSubjects(records, max_records):
       yield r
 
   def ResolveMulti(self, subject, attributes, timestamp=None, limit=None):
@@ -5,6 +5,7 @@
 from grr.lib import flags
 from grr.server.grr_response_server import data_store_test
 from grr.server.grr_response_server.data_stores import sqlite_data_store_test
+from grr.server.grr_response_server import worker_benchmark_test
 
 from grr.test_lib import test_lib
 
@@ -19,6 +20,11 @@ class SqliteDataStoreCSVBenchmarks(sqlite_data_store_test.SqliteTestMixin,
   """Benchmark the SQLite data store abstraction."""
 
 
+class SqliteDataStoreWorkerBenchmarks(sqlite_data_store_test.SqliteTestMixin,
+                                      worker_benchmark_test.WorkerBenchmarks):
+  """Benchmark processing flows on the SQLite data store."""
+
+
 def main(args):
   test_lib.main(args)
 
@@ -90,6 +90,65 @@ def _ResponseToApprovalsWithGrants(response):
     yield cur_approval_request
 
 
+# Queries are mostly built from a few templates. The finished query strings
+# are cached here so they are not rebuilt on every call. IN clauses are padded
+# to a power of two number of values, so lists of arbitrary length map onto a
+# small number of distinct statements, both here and in the server's
+# statement digests.
+_QUERY_CACHE = {}
+
+
+def _InClauseSize(count):
+  """Returns the number of placeholders used for an IN clause of count."""
+  size = 1
+  while size < count:
+    size *= 2
+  return size
+
+
+def _PadInValues(values):
+  """Pads values to _InClauseSize() entries by repeating the last value."""
+  values = list(values)
+  if values:
+    values.extend([values[-1]] * (_InClauseSize(len(values)) - len(values)))
+  return values
+
+
+def _FormatQuery(template, *in_sizes):
+  """Returns template with each {} replaced by in_size placeholders.
+
+  Args:
+    template: A query template containing one {} per IN clause.
+    *in_sizes: The number of values of each IN clause, as returned by
+      _PadInValues().
+
+  Returns:
+    The query string.
+  """
+  key = (template,) + in_sizes
+  query = _QUERY_CACHE.get(key)
+  if query is None:
+    query = template.format(*[", ".join(["%s"] * n) for n in in_sizes])
+    _QUERY_CACHE[key] = query
+  return query
+
+
+def _UpsertQuery(table, columns):
+  """Returns an INSERT query updating all but the first column on conflict."""
+  key = ("upsert", table) + tuple(columns)
+  query = _QUERY_CACHE.get(key)
+  if query is None:
+    query = "INSERT INTO {table} ({cols}) VALUES ({vals})".format(
+        table=table,
+        cols=", ".join(columns),
+        vals=", ".join(["%s"] * len(columns)))
+    if len(columns) > 1:
+      query += " ON DUPLICATE KEY UPDATE " + ", ".join(
+          ["{c} = VALUES ({c})".format(c=col) for col in columns[1:]])
+    _QUERY_CACHE[key] = query
+  return query
+
+
 # Maximum retry count:
 _MAX_RETRY_COUNT = 5
 
@@ -338,24 +397,17 @@ class MysqlDB(db_module.Database):
       columns.append("last_foreman")
       values.append(_RDFDatetimeToMysqlString(last_foreman))
 
-    query = ("INSERT INTO clients ({cols}) VALUES ({vals}) "
-             "ON DUPLICATE KEY UPDATE {updates}").format(
-                 cols=", ".join(columns),
-                 vals=", ".join(["%s"] * len(columns)),
-                 updates=", ".join([
-                     "{c} = VALUES ({c})".format(c=col) for col in columns[1:]
-                 ]))
-    cursor.execute(query, values)
+    cursor.execute(_UpsertQuery("clients", columns), values)
 
   @WithTransaction(readonly=True)
   def MultiReadClientMetadata(self, client_ids, cursor=None):
     """Reads ClientMetadata records for a list of clients."""
-    ids = [_ClientIDToInt(client_id) for client_id in client_ids]
-    query = ("SELECT client_id, fleetspeak_enabled, certificate, last_ping, "
-             "last_clock, last_ip, last_foreman, first_seen, "
-             "last_crash_timestamp, last_startup_timestamp FROM "
-             "clients WHERE client_id IN ({})").format(", ".join(
-                 ["%s"] * len(ids)))
+    ids = _PadInValues(_ClientIDToInt(client_id) for client_id in client_ids)
+    query = _FormatQuery(
+        "SELECT client_id, fleetspeak_enabled, certificate, last_ping, "
+        "last_clock, last_ip, last_foreman, first_seen, "
+        "last_crash_timestamp, last_startup_timestamp FROM "
+        "clients WHERE client_id IN ({})", len(ids))
     ret = {}
     cursor.execute(query, ids)
     while True:
@@ -408,8 +460,8 @@ class MysqlDB(db_module.Database):
   @WithTransaction(readonly=True)
   def MultiReadClientSnapshot(self, client_ids, cursor=None):
     """Reads the latest client snapshots for a list of clients."""
-    int_ids = [_ClientIDToInt(cid) for cid in client_ids]
-    query = (
+    int_ids = _PadInValues(_ClientIDToInt(cid) for cid in client_ids)
+    query = _FormatQuery(
         "SELECT h.client_id, h.client_snapshot, h.timestamp, s.startup_info "
         "FROM clients as c, client_snapshot_history as h, "
         "client_startup_history as s "
@@ -417,7 +469,7 @@ class MysqlDB(db_module.Database):
         "AND s.client_id = c.client_id "
         "AND h.timestamp = c.last_client_timestamp "
         "AND s.timestamp = c.last_startup_timestamp "
-        "AND c.client_id IN ({})").format(", ".join(["%s"] * len(client_ids)))
+        "AND c.client_id IN ({})", len(int_ids))
     ret = {cid: None for cid in client_ids}
     cursor.execute(query, int_ids)
     while True:
@@ -648,11 +700,11 @@ class MysqlDB(db_module.Database):
         "LEFT JOIN client_startup_history as s_last ON ( "
         "c.client_id = s_last.client_id "
         "AND s_last.timestamp = c.last_startup_timestamp) "
-        "LEFT JOIN client_labels AS l ON (c.client_id = l.client_id) ")
-
-    query += "WHERE c.client_id IN (%s) " % ", ".join(["%s"] * len(client_ids))
+        "LEFT JOIN client_labels AS l ON (c.client_id = l.client_id) "
+        "WHERE c.client_id IN ({}) ")
 
-    values = [_ClientIDToInt(cid) for cid in client_ids]
+    values = _PadInValues(_ClientIDToInt(cid) for cid in client_ids)
+    query = _FormatQuery(query, len(values))
     if min_last_ping is not None:
       query += "AND c.last_ping >= %s"
       values.append(_RDFDatetimeToMysqlString(min_last_ping))
@@ -703,9 +755,10 @@ class MysqlDB(db_module.Database):
     for kw in keyword_mapping.values():
       result[kw] = []
 
-    query = ("SELECT DISTINCT keyword, client_id FROM client_keywords WHERE "
-             "keyword IN ({})".format(",".join(["%s"] * len(keyword_mapping))))
-    args = keyword_mapping.keys()
+    args = _PadInValues(keyword_mapping.keys())
+    query = _FormatQuery(
+        "SELECT DISTINCT keyword, client_id FROM client_keywords WHERE "
+        "keyword IN ({})", len(args))
     if start_time:
       query += " AND timestamp >= %s"
       args.append(_RDFDatetimeToMysqlString(start_time))
@@ -732,11 +785,11 @@ class MysqlDB(db_module.Database):
   def MultiReadClientLabels(self, client_ids, cursor=None):
     """Reads the user labels for a list of clients."""
 
-    int_ids = [_ClientIDToInt(cid) for cid in client_ids]
-    query = ("SELECT client_id, owner, label "
-             "FROM client_labels "
-             "WHERE client_id IN ({})").format(", ".join(
-                 ["%s"] * len(client_ids)))
+    int_ids = _PadInValues(_ClientIDToInt(cid) for cid in client_ids)
+    query = _FormatQuery(
+        "SELECT client_id, owner, label "
+        "FROM client_labels "
+        "WHERE client_id IN ({})", len(int_ids))
 
     ret = {client_id: [] for client_id in client_ids}
     cursor.execute(query, int_ids)
@@ -752,11 +805,12 @@ class MysqlDB(db_module.Database):
   def RemoveClientLabels(self, client_id, owner, labels, cursor=None):
     """Removes a list of user labels from a given client."""
 
-    query = ("DELETE FROM client_labels "
-             "WHERE client_id=%s AND owner=%s "
-             "AND label IN ({})").format(", ".join(["%s"] * len(labels)))
-    args = [_ClientIDToInt(client_id), owner]
-    args += [utils.SmartStr(l) for l in labels]
+    labels = _PadInValues(utils.SmartStr(l) for l in labels)
+    query = _FormatQuery(
+        "DELETE FROM client_labels "
+        "WHERE client_id=%s AND owner=%s "
+        "AND label IN ({})", len(labels))
+    args = [_ClientIDToInt(client_id), owner] + labels
     cursor.execute(query, args)
 
   @WithTransaction(readonly=True)
@@ -846,15 +900,7 @@ class MysqlDB(db_module.Database):
       columns.append("user_type")
       values.append(int(user_type))
 
-    query = "INSERT INTO grr_users ({cols}) VALUES ({vals})".format(
-        cols=", ".join(columns), vals=", ".join(["%s"] * len(columns)))
-
-    if len(values) > 1:
-      updates = ", ".join(
-          ["{c} = VALUES ({c})".format(c=col) for col in columns[1:]])
-      query += "ON DUPLICATE KEY UPDATE " + updates
-
-    cursor.execute(query, values)
+    cursor.execute(_UpsertQuery("grr_users", columns), values)
 
   def _RowToGRRUser(self, row):
     username, password, ui_mode, canary_mode, user_type = row
@@ -1086,13 +1132,12 @@ class MysqlDB(db_module.Database):
                               cursor=None):
     """Updates existing user notification objects."""
 
-    query = ("UPDATE user_notification n "
-             "SET n.notification_state = %s "
-             "WHERE n.username = %s AND n.timestamp IN ({})").format(", ".join(
-                 ["%s"] * len(timestamps)))
+    timestamps = _PadInValues(
+        _RDFDatetimeToMysqlString(t) for t in timestamps)
+    query = _FormatQuery(
+        "UPDATE user_notification n "
+        "SET n.notification_state = %s "
+        "WHERE n.username = %s AND n.timestamp IN ({})", len(timestamps))
 
-    args = [
-        int(state),
-        username,
-    ] + [_RDFDatetimeToMysqlString(t) for t in timestamps]
+    args = [int(state), username] + timestamps
     cursor.execute(query, args)
@@ -75,6 +75,25 @@ class TestMysqlDB(stats_test_lib.StatsTestMixin,
             MySQLdb.OperationalError(
                 1637, "Too many active concurrent transactions")))
 
+  def testInClausePadding(self):
+    self.assertEqual(mysql._PadInValues([]), [])
+    self.assertEqual(mysql._PadInValues([1]), [1])
+    self.assertEqual(mysql._PadInValues([1, 2, 3]), [1, 2, 3, 3])
+    self.assertEqual(len(mysql._PadInValues(range(17))), 32)
+
+    query = mysql._FormatQuery("SELECT a FROM t WHERE b IN ({})", 4)
+    self.assertEqual(query, "SELECT a FROM t WHERE b IN (%s, %s, %s, %s)")
+    self.assertIs(
+        mysql._FormatQuery("SELECT a FROM t WHERE b IN ({})", 4), query)
+
+  def testUpsertQuery(self):
+    self.assertEqual(
+        mysql._UpsertQuery("t", ["a", "b"]),
+        "INSERT INTO t (a, b) VALUES (%s, %s) "
+        "ON DUPLICATE KEY UPDATE b = VALUES (b)")
+    self.assertEqual(
+        mysql._UpsertQuery("t", ["a"]), "INSERT INTO t (a) VALUES (%s)")
+
   def AddUser(self, connection, user, passwd):
     cursor = connection.cursor()
     cursor.execute("INSERT INTO grr_users (username, password) VALUES (%s, %s)",
@@ -43,10 +43,12 @@ self.runner_args: The flow runners args. This is an instance of
 """
 
 import functools
+import hashlib
 import logging
 import operator
 
 
+from grr import config
 from grr.lib import queues
 from grr.lib import rdfvalue
 from grr.lib import registry
@@ -319,6 +321,86 @@ class AttributedDict(dict):
     self.__dict__ = self
 
 
+class _OffloadedStateField(object):
+  """Stands in for a flow state field that was not read from the store yet."""
+
+  def __init__(self, digest, loader):
+    self.digest = digest
+    self.loader = loader
+
+
+class FlowState(dict):
+  """The state of a GRRFlow.
+
+  Fields can be accessed as attributes. Large fields are kept outside of the
+  flow object in the data store and are only read when they are first used.
+  """
+
+  def __getattr__(self, name):
+    try:
+      return self[name]
+    except KeyError:
+      raise AttributeError(name)
+
+  def __setattr__(self, name, value):
+    self[name] = value
+
+  def __delattr__(self, name):
+    try:
+      del self[name]
+    except KeyError:
+      raise AttributeError(name)
+
+  def __getitem__(self, name):
+    value = dict.__getitem__(self, name)
+    if isinstance(value, _OffloadedStateField):
+      value = value.loader()
+      dict.__setitem__(self, name, value)
+    return value
+
+  def get(self, name, default=None):
+    if name in self:
+      return self[name]
+    return default
+
+  def pop(self, name, *default):
+    if name in self:
+      value = self[name]
+      del self[name]
+      return value
+    return dict.pop(self, name, *default)
+
+  def setdefault(self, name, default=None):
+    if name not in self:
+      self[name] = default
+    return self[name]
+
+  def iteritems(self):
+    for name in self.keys():
+      yield name, self[name]
+
+  def itervalues(self):
+    for name in self.keys():
+      yield self[name]
+
+  def items(self):
+    return list(self.iteritems())
+
+  def values(self):
+    return list(self.itervalues())
+
+  def copy(self):
+    return FlowState(self.iteritems())
+
+  def ToDict(self):
+    """Returns all fields as a plain dict, reading the offloaded ones."""
+    return dict(self.iteritems())
+
+  def RawItems(self):
+    """Yields the fields without reading offloaded ones from the store."""
+    return dict.iteritems(self)
+
+
 class PendingFlowTermination(rdf_structs.RDFProtoStruct):
   """Descriptor of a pending flow termination."""
   protobuf = jobs_pb2.PendingFlowTermination
@@ -748,6 +830,14 @@ class GRRFlow(FlowBase):
         versioned=False,
         creates_new_object_version=False)
 
+    FLOW_STATE_OFFLOADED = aff4.Attribute(
+        "aff4:flow_state_offloaded",
+        rdf_protodict.Dict,
+        "The digests of the state fields stored outside of the flow object.",
+        "FlowStateOffloaded",
+        versioned=False,
+        creates_new_object_version=False)
+
     FLOW_ARGS = aff4.Attribute(
         "aff4:flow_args",
         rdf_protodict.EmbeddedRDFValue,
@@ -805,27 +895,120 @@ class GRRFlow(FlowBase):
   # is killed when the client crashes.
   handles_crashes = False
 
+  # Prefix of the data store attributes holding offloaded state fields. Each
+  # version of a field is stored under its name and digest.
+  STATE_FIELD_PREFIX = "flow_state:"
+  STATE_FIELD_TEMPLATE = STATE_FIELD_PREFIX + "%s:%s"
+
   def Initialize(self):
     """The initialization method."""
     super(GRRFlow, self).Initialize()
 
+    # Digests of the attributes and state fields as last read or written, so
+    # that only changed ones are written again.
+    self._attribute_digests = {}
+    self._state_digests = {}
+    # The digests the offloaded fields are stored under, as referenced by
+    # FLOW_STATE_OFFLOADED.
+    self._offloaded_keys = {}
+    # Attributes and inline state fields as read by a flow opened for
+    # writing. Their digests are only computed when the flow is written.
+    self._read_attributes = {}
+    self._read_state_blobs = {}
+
     if "r" in self.mode:
-      state = self.Get(self.Schema.FLOW_STATE_DICT)
       self.context = self.Get(self.Schema.FLOW_CONTEXT)
       self.runner_args = self.Get(self.Schema.FLOW_RUNNER_ARGS)
       args = self.Get(self.Schema.FLOW_ARGS)
       if args:
         self.args = args.payload
 
-      if state:
-        self.state = AttributedDict(state.ToDict())
-      else:
-        self.state = AttributedDict()
+      if "w" in self.mode:
+        for attribute, value in [(self.Schema.FLOW_ARGS, args),
+                                 (self.Schema.FLOW_RUNNER_ARGS,
+                                  self.runner_args)]:
+          if value is not None:
+            # The runner args are modified in place, keep what was read.
+            self._read_attributes[attribute] = value.Copy()
+
+      self._ReadState()
 
       self.Load()
 
     if self.state is None:
-      self.state = AttributedDict()
+      self.state = FlowState()
+
+  def _Digest(self, serialized):
+    return hashlib.sha256(serialized).hexdigest()
+
+  def _SerializeStateField(self, value):
+    return rdf_protodict.DataBlob().SetValue(value).SerializeToString()
+
+  def _DecodeStateField(self, data_blob):
+    value = data_blob.GetValue()
+    try:
+      # Unpack nested AttributedDicts like Dict.ToDict() does.
+      return value.ToDict()
+    except AttributeError:
+      return value
+
+  def _ReadState(self):
+    """Reads the small state fields and the digests of the offloaded ones."""
+    self.state = FlowState()
+
+    state = self.Get(self.Schema.FLOW_STATE_DICT)
+    if state:
+      for key_value in state.dat:
+        name = key_value.k.GetValue()
+        value = self._DecodeStateField(key_value.v)
+        dict.__setitem__(self.state, name, value)
+        if "w" in self.mode:
+          self._read_state_blobs[name] = key_value.v
+
+    offloaded = self.Get(self.Schema.FLOW_STATE_OFFLOADED)
+    if offloaded:
+      for name, digest in offloaded.Items():
+        dict.__setitem__(self.state, name,
+                         _OffloadedStateField(
+                             digest,
+                             functools.partial(self._ReadStateField, name,
+                                               digest)))
+        self._state_digests[name] = (digest, True)
+        self._offloaded_keys[name] = digest
+
+  def _ReadStateField(self, name, digest):
+    """Reads an offloaded state field from the data store."""
+    serialized, _ = data_store.DB.Resolve(
+        self.urn, self.STATE_FIELD_TEMPLATE % (name, digest))
+    if serialized is None and "w" not in self.mode:
+      # The flow was written since it was opened and the version of the field
+      # it referred to was replaced. Read only views get the newest one.
+      versions = data_store.DB.ResolvePrefix(
+          self.urn, self.STATE_FIELD_TEMPLATE % (name, ""))
+      if versions:
+        serialized = max(versions, key=lambda version: version[2])[1]
+    if serialized is None:
+      raise FlowError("State field %s of %s is missing." % (name, self.urn))
+
+    value = self._DecodeStateField(
+        rdf_protodict.DataBlob.FromSerializedString(serialized))
+    if "w" in self.mode:
+      # Serializing the decoded value again might give different bytes, e.g.
+      # for dicts. This is the baseline to detect changes against.
+      self._state_digests[name] = (
+          self._Digest(self._SerializeStateField(value)), True)
+    return value
+
+  def _DigestReadValues(self):
+    """Computes the digests of the attributes and fields as they were read."""
+    for attribute, value in self._read_attributes.iteritems():
+      self._attribute_digests[attribute] = self._Digest(
+          value.SerializeToString())
+    for name, data_blob in self._read_state_blobs.iteritems():
+      self._state_digests[name] = (self._Digest(data_blob.SerializeToString()),
+                                   False)
+    self._read_attributes = {}
+    self._read_state_blobs = {}
 
   def CreateRunner(self, **kw):
     """Make a new runner."""
@@ -861,14 +1044,109 @@ class GRRFlow(FlowBase):
     if self.context is None:
       raise IOError("Trying to write a flow without context: %s." % self.urn)
 
+  def _SetIfChanged(self, attribute, value):
+    """Sets an attribute, unless it is unchanged since it was last written."""
+    value = attribute(value)
+    digest = self._Digest(value.SerializeToString())
+    if self._attribute_digests.get(attribute) != digest:
+      self.Set(value)
+      self._attribute_digests[attribute] = digest
+
+  def _WriteStateFields(self):
+    """Writes the state fields which changed since they were last written.
+
+    Fields which serialize to more than Worker.flow_state_offload_size bytes
+    are written to their own data store attributes, so that they are only
+    rewritten when they change, and only read when they are used. All other
+    fields are kept in FLOW_STATE_DICT.
+
+    A new version of an offloaded field is written next to the old one and
+    FLOW_STATE_OFFLOADED refers to it by digest, so the stored state is
+    consistent until the flow object itself is written. The old versions are
+    deleted in the same data store call which writes FLOW_STATE_OFFLOADED.
+    """
+    offload_size = config.CONFIG["Worker.flow_state_offload_size"]
+
+    digests = {}
+    keys = {}
+    inline_fields = {}
+    to_write = {}
+    for name, value in self.state.RawItems():
+      if isinstance(value, _OffloadedStateField):
+        digests[name] = (value.digest, True)
+        keys[name] = value.digest
+        continue
+
+      serialized = self._SerializeStateField(value)
+      offloaded = len(serialized) > offload_size
+      digest = self._Digest(serialized)
+      digests[name] = (digest, offloaded)
+      if not offloaded:
+        inline_fields[name] = serialized
+      elif (self._state_digests.get(name) == digests[name] and
+            name in self._offloaded_keys):
+        # Unchanged, the stored version is still good.
+        keys[name] = self._offloaded_keys[name]
+      else:
+        keys[name] = digest
+        if self._offloaded_keys.get(name) != digest:
+          to_write[self.STATE_FIELD_TEMPLATE % (name, digest)] = [serialized]
+
+    if to_write:
+      pool = self.mutation_pool or data_store.DB.GetMutationPool()
+      pool.MultiSet(self.urn, to_write)
+      if self.mutation_pool is None:
+        pool.Flush()
+
+    stale = set(
+        self.STATE_FIELD_TEMPLATE % (name, key)
+        for name, key in self._offloaded_keys.iteritems()
+        if keys.get(name) != key)
+
+    if self.context.state != rdf_flows.FlowContext.State.RUNNING:
+      # Versions written by flow processing which was lost before the flow
+      # object was written are not referenced anywhere. The flow does not
+      # change anymore, so this is the time to collect them.
+      referenced = set(
+          self.STATE_FIELD_TEMPLATE % (name, key)
+          for name, key in keys.iteritems())
+      for attribute, _, _ in data_store.DB.ResolvePrefix(
+          self.urn, self.STATE_FIELD_PREFIX):
+        if attribute not in referenced:
+          stale.add(attribute)
+
+    def Fields(digests, offloaded):
+      return dict((name, digest)
+                  for name, (digest, is_offloaded) in digests.iteritems()
+                  if is_offloaded == offloaded)
+
+    # A state written by a flow which did not read it before replaces
+    # whatever was stored, so both attributes are always written then.
+    new_state = not self._state_digests
+    if new_state or Fields(digests, False) != Fields(self._state_digests,
+                                                     False):
+      protodict = rdf_protodict.AttributedDict()
+      for name, serialized in inline_fields.iteritems():
+        protodict.SetSerializedItem(name, serialized)
+      self.Set(self.Schema.FLOW_STATE_DICT(protodict))
+    if new_state or keys != self._offloaded_keys or stale:
+      self.Set(
+          self.Schema.FLOW_STATE_OFFLOADED(rdf_protodict.Dict().FromDict(keys)))
+      # The aff4 object deletes these in the same MultiSet call, through its
+      # mutation pool if it has one.
+      self._to_delete.update(stale)
+
+    self._state_digests = digests
+    self._offloaded_keys = keys
+
   def WriteState(self):
     if "w" in self.mode:
       self._ValidateState()
-      self.Set(self.Schema.FLOW_ARGS(self.args))
+      self._DigestReadValues()
+      self._SetIfChanged(self.Schema.FLOW_ARGS, self.args)
       self.Set(self.Schema.FLOW_CONTEXT(self.context))
-      self.Set(self.Schema.FLOW_RUNNER_ARGS(self.runner_args))
-      protodict = rdf_protodict.AttributedDict().FromDict(self.state)
-      self.Set(self.Schema.FLOW_STATE_DICT(protodict))
+      self._SetIfChanged(self.Schema.FLOW_RUNNER_ARGS, self.runner_args)
+      self._WriteStateFields()
 
   def Status(self, format_str, *args):
     """Flows can call this method to set a status message visible to users."""
@@ -1083,6 +1361,15 @@ class GRRFlow(FlowBase):
     return self.LogCollectionForFID(self.session_id)
 
 
+# Classes of the tasks that flows and hunts queue on the worker's thread pool.
+# The worker gives each class its own queue and share of the threads, see
+# threadpool.ThreadPool.AddTask.
+FLOW_TASK = "flow"
+WELL_KNOWN_FLOW_TASK = "well_known_flow"
+HUNT_TASK = "hunt"
+HUNT_REQUEST_TASK = "hunt_request"
+
+
 class WellKnownFlow(GRRFlow):
   """A flow with a well known session_id.
 
@@ -1161,7 +1448,8 @@ class WellKnownFlow(GRRFlow):
       thread_pool.AddTask(
           target=self._SafeProcessMessage,
           args=(response,),
-          name=self.__class__.__name__)
+          name=self.__class__.__name__,
+          task_class=WELL_KNOWN_FLOW_TASK)
 
   def ProcessMessages(self, msgs):
     for msg in msgs:
@@ -76,6 +76,7 @@ from grr.server.grr_response_server import output_plugin as output_plugin_lib
 
 from grr.server.grr_response_server import queue_manager
 from grr.server.grr_response_server import sequential_collection
+from grr.server.grr_response_server import tracing
 from grr.server.grr_response_server.aff4_objects import users as aff4_users
 
 
@@ -435,7 +436,7 @@ class FlowRunner(object):
     # ASAP. This must happen before we actually run the flow to ensure the
     # client requests are removed from the client queues.
     with queue_manager.QueueManager(token=self.token) as manager:
-      for request, _ in manager.FetchCompletedRequests(
+      for request, _ in self.queue_manager.FetchCompletedRequests(
           self.session_id, timestamp=(0, notification.timestamp)):
         # Requests which are not destined to clients have no embedded request
         # message.
@@ -568,6 +569,12 @@ class FlowRunner(object):
         creation of one.
     """
     client_id = None
+    span = tracing.TRACER.StartSpan(
+        "FlowRunner.RunStateMethod",
+        self.session_id,
+        state=method,
+        request_id=request.id if request else None,
+        response_count=len(responses) if responses else 0)
     try:
       self.context.current_state = method
       if request and responses:
@@ -607,6 +614,7 @@ class FlowRunner(object):
       self.Error(traceback.format_exc(), client_id=client_id)
 
     finally:
+      tracing.TRACER.EndSpan(span)
       if event:
         event.set()
 
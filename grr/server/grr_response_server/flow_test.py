@@ -681,6 +681,216 @@ class FlowTerminationTest(BasicFlowTest):
     self.assertRaisesRegexp(RuntimeError, "because i can", ProcessFlow)
 
 
+class FlowStateTest(BasicFlowTest):
+  """Tests for storing the flow state."""
+
+  def setUp(self):
+    super(FlowStateTest, self).setUp()
+    self.config_overrider = test_lib.ConfigOverrider({
+        "Worker.flow_state_offload_size": 100
+    })
+    self.config_overrider.Start()
+
+    self.session_id = flow.GRRFlow.StartFlow(
+        client_id=self.client_id,
+        flow_name=flow_test_lib.FlowOrderTest.__name__,
+        token=self.token)
+
+    with aff4.FACTORY.Open(
+        self.session_id, mode="rw", token=self.token) as flow_obj:
+      flow_obj.state.small = 1
+      flow_obj.state.large = dict((str(i), "x" * 10) for i in range(20))
+
+  def tearDown(self):
+    self.config_overrider.Stop()
+    super(FlowStateTest, self).tearDown()
+
+  def _WrittenAttributes(self, modify_state):
+    """Returns the attributes written when modify_state changes the state."""
+    written = set()
+    multi_set = data_store.DB.MultiSet
+
+    def RecordingMultiSet(subject, values, *args, **kwargs):
+      if subject == self.session_id:
+        written.update(str(attribute) for attribute in values)
+      return multi_set(subject, values, *args, **kwargs)
+
+    with utils.Stubber(data_store.DB, "MultiSet", RecordingMultiSet):
+      with aff4.FACTORY.Open(
+          self.session_id, mode="rw", token=self.token) as flow_obj:
+        modify_state(flow_obj.state)
+
+    return written
+
+  def _StoredAttributes(self):
+    return [
+        attribute for attribute, _, _ in data_store.DB.ResolvePrefix(
+            self.session_id, ["aff4:flow_", "flow_state:"])
+    ]
+
+  def _StoredStateFields(self):
+    return [
+        attribute for attribute in self._StoredAttributes()
+        if attribute.startswith("flow_state:")
+    ]
+
+  def _StateFieldAttribute(self, name):
+    flow_obj = aff4.FACTORY.Open(self.session_id, token=self.token)
+    digest = flow_obj.Get(flow_obj.Schema.FLOW_STATE_OFFLOADED).ToDict()[name]
+    return flow.GRRFlow.STATE_FIELD_TEMPLATE % (name, digest)
+
+  def testLargeFieldsAreStoredSeparately(self):
+    flow_obj = aff4.FACTORY.Open(self.session_id, token=self.token)
+    self.assertEqual(
+        flow_obj.Get(flow_obj.Schema.FLOW_STATE_DICT).ToDict(), {"small": 1})
+    self.assertEqual(
+        flow_obj.Get(flow_obj.Schema.FLOW_STATE_OFFLOADED).ToDict().keys(),
+        ["large"])
+
+    self.assertEqual(flow_obj.state.small, 1)
+    self.assertEqual(flow_obj.state.large["19"], "x" * 10)
+    self.assertEqual(
+        sorted(flow_obj.state.ToDict().keys()), ["large", "small"])
+
+  def testLargeFieldsAreOnlyReadWhenUsed(self):
+    resolved = []
+    resolve = data_store.DB.Resolve
+
+    def CountingResolve(subject, attribute):
+      resolved.append(attribute)
+      return resolve(subject, attribute)
+
+    with utils.Stubber(data_store.DB, "Resolve", CountingResolve):
+      flow_obj = aff4.FACTORY.Open(self.session_id, token=self.token)
+      self.assertIn("large", flow_obj.state)
+      self.assertEqual(resolved, [])
+
+      self.assertEqual(len(flow_obj.state.large), 20)
+      self.assertEqual(len(flow_obj.state.get("large")), 20)
+      self.assertEqual(resolved, [self._StateFieldAttribute("large")])
+
+  def testReadOnlyFlowsDoNotDigestTheirState(self):
+    with utils.Stubber(flow.GRRFlow, "_Digest",
+                       lambda *_: self.fail("State was digested.")):
+      flow_obj = aff4.FACTORY.Open(self.session_id, token=self.token)
+      self.assertEqual(flow_obj.state.small, 1)
+      self.assertEqual(len(flow_obj.state.large), 20)
+
+  def testOnlyChangedFieldsAreWritten(self):
+
+    def ReadState(state):
+      self.assertEqual(state.large["0"], "x" * 10)
+
+    self.assertEqual(self._WrittenAttributes(ReadState), set(
+        ["aff4:flow_context", "metadata:last"]))
+
+    def ChangeSmallField(state):
+      state.small = 2
+
+    self.assertEqual(self._WrittenAttributes(ChangeSmallField), set(
+        ["aff4:flow_context", "aff4:flow_state_dict", "metadata:last"]))
+
+    def ChangeLargeField(state):
+      state.large["20"] = "y"
+
+    old_field = self._StateFieldAttribute("large")
+    written = self._WrittenAttributes(ChangeLargeField)
+    new_field = self._StateFieldAttribute("large")
+
+    # The digests of the large fields identify their current version.
+    self.assertNotEqual(new_field, old_field)
+    self.assertEqual(written, set([
+        "aff4:flow_context", "aff4:flow_state_offloaded", new_field,
+        "metadata:last"
+    ]))
+    # The old version is deleted once the new state was written.
+    self.assertEqual(self._StoredStateFields(), [new_field])
+
+    flow_obj = aff4.FACTORY.Open(self.session_id, token=self.token)
+    self.assertEqual(flow_obj.state.small, 2)
+    self.assertEqual(flow_obj.state.large["20"], "y")
+
+  def testStateIsConsistentUntilTheFlowIsWritten(self):
+    old_field = self._StateFieldAttribute("large")
+
+    flow_obj = aff4.FACTORY.Open(self.session_id, mode="rw", token=self.token)
+    flow_obj.state.small = 2
+    flow_obj.state.large = {"a": "y" * 200}
+    # The new field version is written, but the flow is lost before the flow
+    # object itself is written.
+    flow_obj.WriteState()
+    self.assertEqual(len(self._StoredStateFields()), 2)
+
+    flow_obj = aff4.FACTORY.Open(self.session_id, token=self.token)
+    self.assertEqual(self._StateFieldAttribute("large"), old_field)
+    self.assertEqual(flow_obj.state.small, 1)
+    self.assertEqual(flow_obj.state.large["19"], "x" * 10)
+
+  def testLostFieldVersionsAreDeletedWhenTheFlowEnds(self):
+    flow_obj = aff4.FACTORY.Open(self.session_id, mode="rw", token=self.token)
+    flow_obj.state.large = {"a": "y" * 200}
+    flow_obj.WriteState()
+
+    with aff4.FACTORY.Open(
+        self.session_id, mode="rw", token=self.token) as flow_obj:
+      flow_obj.state.small = 2
+    self.assertEqual(len(self._StoredStateFields()), 2)
+
+    with aff4.FACTORY.Open(
+        self.session_id, mode="rw", token=self.token) as flow_obj:
+      flow_obj.context.state = rdf_flows.FlowContext.State.TERMINATED
+    self.assertEqual(self._StoredStateFields(),
+                     [self._StateFieldAttribute("large")])
+
+  def testReadOnlyFlowsReadReplacedFields(self):
+    flow_obj = aff4.FACTORY.Open(self.session_id, token=self.token)
+
+    with aff4.FACTORY.Open(
+        self.session_id, mode="rw", token=self.token) as writer:
+      writer.state.large = {"a": "y" * 200}
+
+    self.assertEqual(flow_obj.state.large, {"a": "y" * 200})
+
+  def testWritesThroughAMutationPoolDeleteReplacedFields(self):
+    with data_store.DB.GetMutationPool() as pool:
+      with aff4.FACTORY.Open(
+          self.session_id, mode="rw", token=self.token) as flow_obj:
+        flow_obj.mutation_pool = pool
+        flow_obj.state.large = {"a": "y" * 200}
+
+    self.assertEqual(self._StoredStateFields(),
+                     [self._StateFieldAttribute("large")])
+
+  def testFieldsAreMovedBackWhenTheyShrink(self):
+    with aff4.FACTORY.Open(
+        self.session_id, mode="rw", token=self.token) as flow_obj:
+      flow_obj.state.large = {}
+
+    self.assertEqual(self._StoredStateFields(), [])
+    flow_obj = aff4.FACTORY.Open(self.session_id, token=self.token)
+    self.assertEqual(flow_obj.state.ToDict(), {"small": 1, "large": {}})
+
+  def testStateWithoutOffloadedFieldsIsRead(self):
+    with aff4.FACTORY.Open(
+        self.session_id, mode="rw", token=self.token) as flow_obj:
+      # A state written before large fields were stored separately.
+      flow_obj.Set(flow_obj.Schema.FLOW_STATE_DICT(
+          rdf_protodict.AttributedDict(small=2, large={"a": "x" * 200})))
+      flow_obj.DeleteAttribute(flow_obj.Schema.FLOW_STATE_OFFLOADED)
+      data_store.DB.DeleteAttributes(self.session_id,
+                                     self._StoredStateFields())
+
+    with aff4.FACTORY.Open(
+        self.session_id, mode="rw", token=self.token) as flow_obj:
+      self.assertEqual(flow_obj.state.ToDict(),
+                       {"small": 2, "large": {"a": "x" * 200}})
+
+    self.assertEqual(self._StoredStateFields(),
+                     [self._StateFieldAttribute("large")])
+    flow_obj = aff4.FACTORY.Open(self.session_id, token=self.token)
+    self.assertEqual(flow_obj.state.large, {"a": "x" * 200})
+
+
 class DummyFlowOutputPlugin(output_plugin.OutputPluginWithOutputStreams):
   """Dummy plugin that opens a dummy stream."""
   num_calls = 0
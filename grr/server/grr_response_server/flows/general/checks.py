@@ -7,6 +7,7 @@ from grr_response_proto import flows_pb2
 from grr.server.grr_response_server import aff4
 from grr.server.grr_response_server import artifact
 from grr.server.grr_response_server import flow
+from grr.server.grr_response_server import process_pool
 from grr.server.grr_response_server.checks import checks
 from grr.server.grr_response_server.flows.general import collectors
 
@@ -166,10 +167,12 @@ class CheckRunner(flow.GRRFlow):
       raise RuntimeError("Checks did not run successfully.")
     # Hand host data across to checks. Do this after all data has been collected
     # in case some checks require multiple artifacts/results.
-    for finding in checks.CheckHost(
+    findings = process_pool.Run(
+        checks.CheckHost,
         self.state.host_data,
         os_name=self.state.knowledge_base.os,
-        restrict_checks=self.args.restrict_checks):
+        restrict_checks=list(self.args.restrict_checks))
+    for finding in findings:
       self.state.checks_run.append(finding.check_id)
       if finding.anomaly:
         self.state.checks_with_findings.append(finding.check_id)
@@ -3,6 +3,7 @@
 
 import logging
 import operator
+import threading
 import time
 
 from grr import config
@@ -22,12 +23,163 @@ from grr.server.grr_response_server import data_store
 from grr.server.grr_response_server import db
 from grr.server.grr_response_server import events
 from grr.server.grr_response_server import flow
+from grr.server.grr_response_server import process_pool
 from grr.server.grr_response_server import queue_manager
 from grr.server.grr_response_server import rekall_profile_server
 from grr.server.grr_response_server import threadpool
+from grr.server.grr_response_server import tracing
 from grr.server.grr_response_server.aff4_objects import aff4_grr
 
 
+def _DecryptMessageList(cipher, response_comms):
+  """Decrypts a message bundle, large ones in the process pool."""
+  if (len(response_comms.encrypted) <
+      config.CONFIG["Frontend.process_pool_min_bundle_size"]):
+    run = lambda function, *args: function(*args)
+  else:
+    run = process_pool.Run
+
+  return run(communicator.DecryptMessageList, cipher.cipher,
+             response_comms.encrypted, response_comms.packet_iv)
+
+
+class ClientPingUpdater(object):
+  """Writes the ping information of clients, optionally in batches.
+
+  Every message bundle updates the ping time, clock and ip of its client. With
+  an interval, the updates are collected and written every interval seconds by
+  a background thread instead, and only the newest values of every client are
+  written. The newest clock of every client is also kept in memory for the
+  replay protection, see GetClock().
+  """
+
+  def __init__(self,
+               interval,
+               write_aff4=True,
+               write_relational_db=False,
+               max_clients=100000,
+               token=None):
+    """Constructor.
+
+    Args:
+      interval: Seconds between writes. 0 writes every update right away.
+      write_aff4: If True, the values are written to the VFSGRRClient objects.
+      write_relational_db: If True, the values are written to the client
+        metadata of the relational db.
+      max_clients: The number of clients to remember the clock of.
+      token: The token to write with.
+    """
+    self.interval = interval
+    self.write_aff4 = write_aff4
+    self.write_relational_db = write_relational_db
+    self.token = token
+    self.lock = threading.Lock()
+    # Maps client ids to dicts of the values to write.
+    self.pending = {}
+    self.clocks = utils.FastStore(max_size=max_clients)
+    self.stopped = threading.Event()
+    self.flush_thread = None
+
+  def Update(self, client_id, ip=None, clock=None, ping=None):
+    """Records new ping information for a client.
+
+    Args:
+      client_id: The id of the client, e.g. C.1234567890123456.
+      ip: The ip address the client connected from.
+      clock: The RDFDatetime the client sent its messages at.
+      ping: The RDFDatetime the messages were received at.
+    """
+    values = dict(ip=ip, clock=clock, ping=ping)
+    values = dict((k, v) for k, v in values.iteritems() if v is not None)
+    if clock is not None:
+      self.clocks.Put(client_id, clock)
+
+    if not self.interval:
+      self._Write({client_id: values})
+      return
+
+    with self.lock:
+      self.pending.setdefault(client_id, {}).update(values)
+
+      if self.flush_thread is None:
+        self.flush_thread = threading.Thread(
+            target=self._FlushPeriodically, name="ClientPingUpdater")
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
+
+  def _FlushPeriodically(self):
+    while not self.stopped.wait(self.interval):
+      try:
+        self.Flush()
+      except Exception:  # pylint: disable=broad-except
+        logging.exception("Failed to write client pings.")
+
+  def GetClock(self, client_id):
+    """Returns the newest clock seen for client_id, or None."""
+    try:
+      return self.clocks.Get(client_id)
+    except KeyError:
+      return None
+
+  def Flush(self):
+    """Writes all pending updates."""
+    with self.lock:
+      pending = self.pending
+      self.pending = {}
+
+    if pending:
+      self._Write(pending)
+
+  def _Write(self, pending):
+    """Writes a dict mapping client ids to their new values."""
+    if self.write_aff4:
+      with data_store.DB.GetMutationPool() as pool:
+        for client_id, values in pending.iteritems():
+          # A write only object, so that the clients cached for reading are
+          # never modified here.
+          client = aff4.FACTORY.Create(
+              client_id,
+              aff4_grr.VFSGRRClient,
+              mode="w",
+              object_exists=True,
+              mutation_pool=pool,
+              token=self.token)
+          if "ip" in values:
+            client.Set(client.Schema.CLIENT_IP(values["ip"]))
+          if "clock" in values:
+            client.Set(client.Schema.CLOCK(values["clock"]))
+          if "ping" in values:
+            client.Set(client.Schema.PING(values["ping"]))
+          client.Close()
+
+    if self.write_relational_db:
+      for client_id, values in pending.iteritems():
+        if values.get("ip"):
+          last_ip = rdf_client.NetworkAddress(
+              human_readable_address=values["ip"])
+        else:
+          last_ip = None
+        if not (last_ip or "clock" in values or "ping" in values):
+          continue
+
+        try:
+          data_store.REL_DB.WriteClientMetadata(
+              client_id,
+              last_ip=last_ip,
+              last_clock=values.get("clock"),
+              last_ping=values.get("ping"),
+              fleetspeak_enabled=False)
+        except db.UnknownClientError:
+          pass
+
+  def Stop(self):
+    """Stops the background thread and writes all pending updates."""
+    self.stopped.set()
+    if self.flush_thread is not None:
+      self.flush_thread.join()
+    self.Flush()
+
+
 class ServerCommunicator(communicator.Communicator):
   """A communicator which stores certificates using AFF4."""
 
@@ -37,9 +189,19 @@ class ServerCommunicator(communicator.Communicator):
     super(ServerCommunicator, self).__init__(
         certificate=certificate, private_key=private_key)
     self.pub_key_cache = utils.FastStore(max_size=50000)
+    self.remote_cipher_cache = utils.FastStore(
+        max_size=config.CONFIG["Frontend.remote_cipher_cache_size"])
+    self.remote_cipher_max_age = config.CONFIG["Frontend.remote_cipher_max_age"]
+    self.ping_updater = ClientPingUpdater(
+        config.CONFIG["Frontend.ping_update_interval"],
+        write_relational_db=data_store.RelationalDBWriteEnabled(),
+        token=token)
     # Our common name as an RDFURN.
     self.common_name = rdfvalue.RDFURN(self.certificate.GetCN())
 
+  def _DecryptMessageList(self, cipher, response_comms):
+    return _DecryptMessageList(cipher, response_comms)
+
   def _GetRemotePublicKey(self, common_name):
     try:
       # See if we have this client already cached.
@@ -109,11 +271,13 @@ class ServerCommunicator(communicator.Communicator):
         stats.STATS.SetGaugeValue("grr_frontendserver_client_cache_size",
                                   len(self.client_cache))
 
-      ip = response_comms.orig_request.source_ip
-      client.Set(client.Schema.CLIENT_IP(ip))
-
-      # The very first packet we see from the client we do not have its clock
-      remote_time = client.Get(client.Schema.CLOCK) or rdfvalue.RDFDatetime(0)
+      # The very first packet we see from the client we do not have its clock.
+      # The cached client only holds the clock it was read with, newer ones are
+      # kept by the ping updater.
+      remote_time = max(
+          client.Get(client.Schema.CLOCK) or rdfvalue.RDFDatetime(0),
+          self.ping_updater.GetClock(client_id.Basename()) or
+          rdfvalue.RDFDatetime(0))
       client_time = packed_message_list.timestamp or rdfvalue.RDFDatetime(0)
 
       # This used to be a strict check here so absolutely no out of
@@ -137,10 +301,7 @@ class ServerCommunicator(communicator.Communicator):
       # Update the client and server timestamps only if the client
       # time moves forward.
       if client_time > long(remote_time):
-        client.Set(client.Schema.CLOCK, rdfvalue.RDFDatetime(client_time))
-        client.Set(client.Schema.PING, rdfvalue.RDFDatetime.Now())
-
-        clock = client_time
+        clock = rdfvalue.RDFDatetime(client_time)
         ping = rdfvalue.RDFDatetime.Now()
 
         for label in client.Get(client.Schema.LABELS, []):
@@ -152,25 +313,11 @@ class ServerCommunicator(communicator.Communicator):
         logging.warning("Out of order message for %s: %s >= %s", client_id,
                         long(remote_time), int(client_time))
 
-      client.Flush()
-      if data_store.RelationalDBWriteEnabled():
-        source_ip = response_comms.orig_request.source_ip
-        if source_ip:
-          last_ip = rdf_client.NetworkAddress(
-              human_readable_address=response_comms.orig_request.source_ip)
-        else:
-          last_ip = None
-
-        if ping or clock or last_ip:
-          try:
-            data_store.REL_DB.WriteClientMetadata(
-                client_id.Basename(),
-                last_ip=last_ip,
-                last_clock=clock,
-                last_ping=ping,
-                fleetspeak_enabled=False)
-          except db.UnknownClientError:
-            pass
+      self.ping_updater.Update(
+          client_id.Basename(),
+          ip=response_comms.orig_request.source_ip,
+          clock=clock,
+          ping=ping)
 
     except communicator.UnknownClientCert:
       pass
@@ -185,8 +332,18 @@ class RelationalServerCommunicator(communicator.Communicator):
     super(RelationalServerCommunicator, self).__init__(
         certificate=certificate, private_key=private_key)
     self.pub_key_cache = utils.FastStore(max_size=50000)
+    self.remote_cipher_cache = utils.FastStore(
+        max_size=config.CONFIG["Frontend.remote_cipher_cache_size"])
+    self.remote_cipher_max_age = config.CONFIG["Frontend.remote_cipher_max_age"]
+    self.ping_updater = ClientPingUpdater(
+        config.CONFIG["Frontend.ping_update_interval"],
+        write_aff4=False,
+        write_relational_db=True)
     self.common_name = self.certificate.GetCN()
 
+  def _DecryptMessageList(self, cipher, response_comms):
+    return _DecryptMessageList(cipher, response_comms)
+
   def _GetRemotePublicKey(self, common_name):
     remote_client_id = common_name.Basename()
     try:
@@ -239,6 +396,12 @@ class RelationalServerCommunicator(communicator.Communicator):
       metadata = data_store.REL_DB.ReadClientMetadata(client_id)
       client_time = packed_message_list.timestamp or rdfvalue.RDFDatetime(0)
 
+      # The clock last seen by this process can be newer than the stored one.
+      stored_client_time = self.ping_updater.GetClock(client_id)
+      if metadata and metadata.clock:
+        if stored_client_time is None or metadata.clock > stored_client_time:
+          stored_client_time = metadata.clock
+
       # This used to be a strict check here so absolutely no out of
       # order messages would be accepted ever. Turns out that some
       # proxies can send your request with some delay even if the
@@ -248,9 +411,7 @@ class RelationalServerCommunicator(communicator.Communicator):
       # precaution. Given the behavior of those proxies, this seems
       # now excessive and we have changed the replay protection to
       # only trigger on messages that are more than one hour old.
-      if metadata and metadata.clock:
-        stored_client_time = metadata.clock
-
+      if stored_client_time:
         if client_time < stored_client_time - rdfvalue.Duration("1h"):
           logging.warning("Message desynchronized for %s: %s >= %s", client_id,
                           long(stored_client_time), long(client_time))
@@ -272,19 +433,11 @@ class RelationalServerCommunicator(communicator.Communicator):
         stats.STATS.IncrementCounter(
             "client_pings_by_label", fields=[label.name])
 
-      source_ip = response_comms.orig_request.source_ip
-      if source_ip:
-        last_ip = rdf_client.NetworkAddress(
-            human_readable_address=response_comms.orig_request.source_ip)
-      else:
-        last_ip = None
-
-      data_store.REL_DB.WriteClientMetadata(
+      self.ping_updater.Update(
           client_id,
-          last_ip=last_ip,
-          last_clock=client_time,
-          last_ping=rdfvalue.RDFDatetime.Now(),
-          fleetspeak_enabled=False)
+          ip=response_comms.orig_request.source_ip,
+          clock=rdfvalue.RDFDatetime(client_time),
+          ping=rdfvalue.RDFDatetime.Now())
 
     except communicator.UnknownClientCert:
       pass
@@ -292,6 +445,182 @@ class RelationalServerCommunicator(communicator.Communicator):
     return rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED
 
 
+class _QueueWriteBatch(object):
+  """Queue writes of several message bundles which are flushed together."""
+
+  def __init__(self, token=None):
+    # The timestamp is not frozen, the writes are timestamped when they are
+    # flushed. Timestamps taken when the batch opens could be older than
+    # those of a batch which is flushed first.
+    self.manager = queue_manager.QueueManager(token=token)
+    self.bundle_count = 0
+    self.full = threading.Event()
+    self.done = threading.Event()
+    self.error = None
+
+
+class QueueWriteCoalescer(object):
+  """Batches the queue writes of message bundles received at the same time.
+
+  The first bundle to arrive opens a batch and waits for up to window seconds
+  for others to join, then writes the batch in one go. Only one notification
+  is written per session, no matter how many clients responded to it. Every caller blocks until the
+  batch holding its writes was flushed, so nothing is acknowledged to the
+  clients before it is stored.
+  """
+
+  def __init__(self, window, max_batch_size=1000, token=None):
+    """Constructor.
+
+    Args:
+      window: Seconds a batch waits for more bundles. 0 writes every bundle
+        on its own.
+      max_batch_size: A batch is written as soon as it holds this many
+        bundles.
+      token: The token to write with.
+    """
+    self.window = window
+    self.max_batch_size = max_batch_size
+    self.token = token
+    self.lock = threading.Lock()
+    self.batch = None
+
+  def Write(self, manager):
+    """Writes the pending writes of a queue manager together with others.
+
+    Args:
+      manager: A QueueManager holding the writes for one message bundle. It is
+        not flushed itself and should not be used afterwards.
+    """
+    if not self.window:
+      manager.Flush()
+      return
+
+    with self.lock:
+      batch = self.batch
+      leader = batch is None
+      if leader:
+        batch = self.batch = _QueueWriteBatch(token=self.token)
+
+      batch.manager.MergeFrom(manager)
+      batch.bundle_count += 1
+      if batch.bundle_count >= self.max_batch_size:
+        batch.full.set()
+
+    if leader:
+      batch.full.wait(self.window)
+      with self.lock:
+        self.batch = None
+
+      stats.STATS.RecordEvent("grr_frontendserver_queue_write_batch_size",
+                              batch.bundle_count)
+      try:
+        batch.manager.Flush()
+      except Exception as e:  # pylint: disable=broad-except
+        batch.error = e
+      finally:
+        batch.done.set()
+    else:
+      batch.done.wait()
+
+    if batch.error is not None:
+      raise batch.error
+
+
+class _TaskLeaseBatch(object):
+  """Client polls whose task queues are leased together."""
+
+  def __init__(self):
+    # Maps max_count to the clients asking for that many tasks.
+    self.clients = {}
+    self.client_count = 0
+    self.full = threading.Event()
+    self.done = threading.Event()
+    self.tasks = {}
+    self.error = None
+
+
+class TaskLeaseCoalescer(object):
+  """Batches the task leases of clients polling at the same time.
+
+  The first poll to arrive opens a batch and waits for up to window seconds
+  for others to join, then leases the tasks of all clients in the batch with
+  one call to drain. Every caller blocks until the batch holding its client
+  was leased.
+  """
+
+  def __init__(self, drain, window, max_batch_size=1000):
+    """Constructor.
+
+    Args:
+      drain: A function taking a list of clients and a max_count and returning
+        a dict mapping each client to its leased tasks, like
+        FrontEndServer.DrainTaskSchedulerQueueForClients().
+      window: Seconds a batch waits for more polls. 0 leases the tasks of
+        every poll on its own.
+      max_batch_size: A batch is leased as soon as it holds this many clients.
+    """
+    self.drain = drain
+    self.window = window
+    self.max_batch_size = max_batch_size
+    self.lock = threading.Lock()
+    self.batch = None
+
+  def Drain(self, client, max_count):
+    """Leases up to max_count tasks for client together with other polls.
+
+    Args:
+      client: The ClientURN of the polling client.
+      max_count: The maximum number of tasks to lease for the client.
+
+    Returns:
+      A list of the leased tasks.
+    """
+    if not self.window:
+      return self.drain([client], max_count)[client]
+
+    with self.lock:
+      batch = self.batch
+      leader = batch is None
+      if leader:
+        batch = self.batch = _TaskLeaseBatch()
+
+      clients = batch.clients.setdefault(max_count, set())
+      # The same client polling twice at once must not get the same tasks
+      # twice, so the second poll is leased on its own.
+      duplicate = client in clients
+      if not duplicate:
+        clients.add(client)
+        batch.client_count += 1
+        if batch.client_count >= self.max_batch_size:
+          batch.full.set()
+
+    if duplicate:
+      return self.drain([client], max_count)[client]
+
+    if leader:
+      batch.full.wait(self.window)
+      with self.lock:
+        self.batch = None
+
+      stats.STATS.RecordEvent("grr_frontendserver_task_lease_batch_size",
+                              batch.client_count)
+      try:
+        for count, clients in batch.clients.iteritems():
+          batch.tasks.update(self.drain(list(clients), count))
+      except Exception as e:  # pylint: disable=broad-except
+        batch.error = e
+      finally:
+        batch.done.set()
+    else:
+      batch.done.wait()
+
+    if batch.error is not None:
+      raise batch.error
+
+    return batch.tasks[client]
+
+
 class FrontEndServer(object):
   """This is the front end server.
 
@@ -350,6 +679,23 @@ class FrontEndServer(object):
         for flow_name in whitelist & available_wkf_set
     }
 
+    self.queue_write_coalescer = QueueWriteCoalescer(
+        config.CONFIG["Frontend.queue_write_window"], token=self.token)
+    self.task_lease_coalescer = TaskLeaseCoalescer(
+        self.DrainTaskSchedulerQueueForClients,
+        config.CONFIG["Frontend.task_lease_window"])
+
+    self.empty_queue_cache = None
+    empty_queue_cache_size = config.CONFIG["Frontend.empty_queue_cache_size"]
+    if empty_queue_cache_size:
+      self.empty_queue_cache = queue_manager.EmptyQueueCache(
+          max_size=empty_queue_cache_size)
+
+  def Stop(self):
+    """Writes the pending client pings and stops the background threads."""
+    self._communicator.ping_updater.Stop()
+    self.thread_pool.Stop()
+
   @stats.Counted("grr_frontendserver_handle_num")
   @stats.Timed("grr_frontendserver_handle_time")
   def HandleMessageBundles(self, request_comms, response_comms):
@@ -385,8 +731,10 @@ class FrontEndServer(object):
     message_list = rdf_flows.MessageList()
     # Only give the client messages if we are able to receive them in a
     # reasonable time.
-    if time.time() - now < 10:
-      tasks = self.DrainTaskSchedulerQueueForClient(source, required_count)
+    if time.time() - now < 10 and required_count > 0:
+      # Tasks are leased together with those of other clients polling now.
+      tasks = self.task_lease_coalescer.Drain(
+          rdf_client.ClientURN(source), required_count)
       message_list.job = tasks
 
     # Encode the message_list in the response_comms using the same API version
@@ -410,11 +758,6 @@ class FrontEndServer(object):
   def DrainTaskSchedulerQueueForClient(self, client, max_count=None):
     """Drains the client's Task Scheduler queue.
 
-    1) Get all messages in the client queue.
-    2) Sort these into a set of session_ids.
-    3) Use data_store.DB.ResolvePrefix() to query all requests.
-    4) Delete all responses for retransmitted messages (if needed).
-
     Args:
        client: The ClientURN object specifying this client.
 
@@ -426,47 +769,92 @@ class FrontEndServer(object):
        The tasks respresenting the messages returned. If we can not send them,
        we can reschedule them for later.
     """
+    client = rdf_client.ClientURN(client)
+    return self.DrainTaskSchedulerQueueForClients(
+        [client], max_count=max_count)[client]
+
+  def DrainTaskSchedulerQueueForClients(self, clients, max_count=None):
+    """Drains the Task Scheduler queues of many clients at once.
+
+    1) Skip clients whose queues are known to be empty.
+    2) Lease up to max_count messages from each remaining client queue.
+    3) Use data_store.DB.CheckRequestsForCompletion() to check which
+       retransmitted messages were answered already.
+    4) Delete the answered messages from the client queues.
+
+    Args:
+       clients: A list of ClientURN objects.
+
+       max_count: The maximum number of messages we will issue for each
+                  client.
+                  If not given, uses self.max_queue_size .
+
+    Returns:
+       A dict mapping each client to the tasks respresenting the messages
+       returned. If we can not send them, we can reschedule them for later.
+    """
     if max_count is None:
       max_count = self.max_queue_size
 
+    clients = [rdf_client.ClientURN(client) for client in clients]
+    result = dict((client, []) for client in clients)
     if max_count <= 0:
-      return []
-
-    client = rdf_client.ClientURN(client)
+      return result
 
     start_time = time.time()
-    # Drain the queue for this client
-    new_tasks = queue_manager.QueueManager(token=self.token).QueryAndOwn(
-        queue=client.Queue(),
-        limit=max_count,
-        lease_seconds=self.message_expiry_time)
+    queues = dict((client.Queue(), client) for client in clients)
+    if self.empty_queue_cache:
+      generation = self.empty_queue_cache.Sync()
+      to_query = [
+          queue for queue in queues
+          if not self.empty_queue_cache.IsEmpty(queue)
+      ]
+      stats.STATS.IncrementCounter(
+          "grr_frontendserver_empty_queue_cache_hits",
+          delta=len(queues) - len(to_query))
+    else:
+      to_query = list(queues)
+
+    if not to_query:
+      return result
+
+    # Drain the queues for these clients
+    new_tasks = queue_manager.QueueManager(token=self.token).MultiQueryAndOwn(
+        to_query, limit=max_count, lease_seconds=self.message_expiry_time)
+
+    if self.empty_queue_cache:
+      self.empty_queue_cache.MarkEmpty(
+          [queue for queue in to_query if queue not in new_tasks], generation)
 
     initial_ttl = rdf_flows.GrrMessage().task_ttl
     check_before_sending = []
-    result = []
-    for task in new_tasks:
-      if task.task_ttl < initial_ttl - 1:
-        # This message has been leased before.
-        check_before_sending.append(task)
-      else:
-        result.append(task)
+    for queue, tasks in new_tasks.iteritems():
+      client = queues[queue]
+      for task in tasks:
+        if task.task_ttl < initial_ttl - 1:
+          # This message has been leased before.
+          check_before_sending.append((client, task))
+        else:
+          result[client].append(task)
 
     if check_before_sending:
       with queue_manager.QueueManager(token=self.token) as manager:
-        status_found = manager.MultiCheckStatus(check_before_sending)
+        status_found = manager.MultiCheckStatus(
+            [task for _, task in check_before_sending])
 
         # All messages that don't have a status yet should be sent again.
-        for task in check_before_sending:
+        for client, task in check_before_sending:
           if task not in status_found:
-            result.append(task)
+            result[client].append(task)
           else:
             manager.DeQueueClientRequest(client, task.task_id)
 
-    stats.STATS.IncrementCounter("grr_messages_sent", len(result))
-    if result:
-      logging.debug("Drained %d messages for %s in %s seconds.", len(result),
-                    client,
-                    time.time() - start_time)
+    for client, tasks in result.iteritems():
+      stats.STATS.IncrementCounter("grr_messages_sent", len(tasks))
+      if tasks:
+        logging.debug("Drained %d messages for %s in %s seconds.", len(tasks),
+                      client,
+                      time.time() - start_time)
 
     return result
 
@@ -547,7 +935,13 @@ class FrontEndServer(object):
       messages: A list of GrrMessage RDFValues.
     """
     now = time.time()
-    with queue_manager.QueueManager(token=self.token) as manager:
+    # The spans cover writing the messages to the queues.
+    traced = tracing.TRACER.Spans("FrontEndServer.ReceiveMessages",
+                                  self._TracedSessions(client_id, messages))
+    with traced:
+      # The writes are only collected here, and written together with those
+      # of other bundles received at the same time.
+      manager = queue_manager.QueueManager(token=self.token)
       for session_id, msgs in utils.GroupBy(
           messages, operator.attrgetter("session_id")).iteritems():
 
@@ -599,10 +993,26 @@ class FrontEndServer(object):
                       rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED))
               events.Events.PublishEvent("ClientCrash", msg, token=self.token)
 
+      self.queue_write_coalescer.Write(manager)
+
     logging.debug("Received %s messages from %s in %s sec", len(messages),
                   client_id,
                   time.time() - now)
 
+  def _TracedSessions(self, client_id, messages):
+    """Returns tracing attributes by session id, if tracing is enabled."""
+    if not tracing.TRACER.enabled:
+      return {}
+
+    result = {}
+    for session_id, msgs in utils.GroupBy(
+        messages, operator.attrgetter("session_id")).iteritems():
+      result[session_id] = dict(
+          client_id=utils.SmartUnicode(client_id),
+          request_ids=sorted(set(msg.request_id for msg in msgs)),
+          message_count=len(msgs))
+    return result
+
   def HandleWellKnownFlows(self, messages):
     """Hands off messages to well known flows."""
     msgs_by_wkf = {}
@@ -690,13 +1100,24 @@ class FrontendInit(registry.InitHook):
     # misconfiguration.
     stats.STATS.RegisterCounterMetric(
         "frontend_inactive_request_count", fields=[("source", str)])
+    # Client requests rejected because the frontend was too busy.
+    stats.STATS.RegisterCounterMetric(
+        "frontend_rejected_request_count", fields=[("source", str)])
     stats.STATS.RegisterEventMetric(
         "frontend_request_latency", fields=[("source", str)])
 
     stats.STATS.RegisterEventMetric("grr_frontendserver_handle_time")
     stats.STATS.RegisterCounterMetric("grr_frontendserver_handle_num")
+    stats.STATS.RegisterEventMetric(
+        "grr_frontendserver_queue_write_batch_size",
+        bins=[1, 2, 5, 10, 20, 50, 100, 200, 500, 1000])
+    stats.STATS.RegisterEventMetric(
+        "grr_frontendserver_task_lease_batch_size",
+        bins=[1, 2, 5, 10, 20, 50, 100, 200, 500, 1000])
     stats.STATS.RegisterGaugeMetric("grr_frontendserver_client_cache_size", int)
     stats.STATS.RegisterCounterMetric("grr_messages_sent")
+    stats.STATS.RegisterCounterMetric(
+        "grr_frontendserver_empty_queue_cache_hits")
 
     stats.STATS.RegisterCounterMetric(
         "grr_pub_key_cache", fields=[("type", str)])
@@ -3,8 +3,11 @@
 
 import array
 import logging
+import os
 import pdb
+import threading
 import time
+import zlib
 
 import requests
 
@@ -27,6 +30,7 @@ from grr.server.grr_response_server import data_store
 from grr.server.grr_response_server import flow
 from grr.server.grr_response_server import front_end
 from grr.server.grr_response_server import maintenance_utils
+from grr.server.grr_response_server import process_pool
 from grr.server.grr_response_server import queue_manager
 from grr.server.grr_response_server.aff4_objects import aff4_grr
 from grr.server.grr_response_server.flows.general import ca_enroller
@@ -131,6 +135,84 @@ class GRRFEServerTest(front_end_test_lib.FrontEndServerTest):
       stored_message.timestamp = None
       self.assertRDFValuesEqual(stored_message, message)
 
+  def _SendStatusesConcurrently(self, session_id, request_ids):
+    """Receives a status for each request id from a separate thread."""
+    threads = []
+    for request_id in request_ids:
+      message = rdf_flows.GrrMessage(
+          request_id=request_id,
+          response_id=1,
+          session_id=session_id,
+          payload=rdf_flows.GrrStatus(),
+          type=rdf_flows.GrrMessage.Type.STATUS)
+      threads.append(
+          threading.Thread(
+              target=self.server.ReceiveMessages,
+              args=(test_lib.TEST_CLIENT_ID, [message])))
+
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+  def testConcurrentlyReceivedMessagesAreWrittenTogether(self):
+    flow_obj = self.FlowSetup(
+        flow_test_lib.FlowOrderTest.__name__,
+        client_id=test_lib.TEST_CLIENT_ID)
+    session_id = flow_obj.session_id
+
+    flushes = []
+    notifications = []
+    flush = queue_manager.QueueManager.Flush
+    notify_queue = queue_manager.QueueManager.NotifyQueue
+
+    def RecordingFlush(manager):
+      flushes.append(manager)
+      return flush(manager)
+
+    def RecordingNotifyQueue(manager, notification, **kwargs):
+      notifications.append(notification)
+      return notify_queue(manager, notification, **kwargs)
+
+    coalescer = self.server.queue_write_coalescer
+    with utils.MultiStubber(
+        (coalescer, "window", 60), (coalescer, "max_batch_size", 5),
+        (queue_manager.QueueManager, "Flush", RecordingFlush),
+        (queue_manager.QueueManager, "NotifyQueue", RecordingNotifyQueue)):
+      self._SendStatusesConcurrently(session_id, range(1, 6))
+
+    self.assertEqual(len(flushes), 1)
+    self.assertEqual(len(notifications), 1)
+    self.assertEqual(notifications[0].session_id, session_id)
+    self.assertEqual(notifications[0].last_status, 5)
+
+    for request_id in range(1, 6):
+      stored_messages = data_store.DB.ReadResponsesForRequestId(
+          session_id, request_id)
+      self.assertEqual(len(stored_messages), 1)
+
+  def testQueueWriteErrorsAreRaisedForAllMessages(self):
+    errors = []
+
+    def ReceiveMessages(client_id, messages):
+      try:
+        receive_messages(client_id, messages)
+      except IOError as e:
+        errors.append(e)
+
+    def FailingFlush(unused_manager):
+      raise IOError("Write failed.")
+
+    receive_messages = self.server.ReceiveMessages
+    coalescer = self.server.queue_write_coalescer
+    with utils.MultiStubber(
+        (coalescer, "window", 60), (coalescer, "max_batch_size", 3),
+        (self.server, "ReceiveMessages", ReceiveMessages),
+        (queue_manager.QueueManager, "Flush", FailingFlush)):
+      self._SendStatusesConcurrently("aff4:/W:1234", range(1, 4))
+
+    self.assertEqual(len(errors), 3)
+
   def testReceiveUnsolicitedClientMessage(self):
     client_id = test_lib.TEST_CLIENT_ID
     flow_obj = self.FlowSetup(
@@ -308,6 +390,84 @@ class GRRFEServerTest(front_end_test_lib.FrontEndServerTest):
       self.assertEqual(response.job[i].session_id, session_id)
       self.assertEqual(response.job[i].name, "Test")
 
+  def testDrainTaskSchedulerQueueForClients(self):
+    client_ids = self.SetupClients(3)
+    for client_id in client_ids[:2]:
+      flow.GRRFlow.StartFlow(
+          client_id=client_id,
+          flow_name=flow_test_lib.SendingFlow.__name__,
+          message_count=3,
+          token=self.token)
+
+    tasks = self.server.DrainTaskSchedulerQueueForClients(client_ids, 2)
+
+    self.assertEqual(sorted(tasks), sorted(client_ids))
+    self.assertEqual(len(tasks[client_ids[0]]), 2)
+    self.assertEqual(len(tasks[client_ids[1]]), 2)
+    self.assertEqual(tasks[client_ids[2]], [])
+    for task in tasks[client_ids[0]]:
+      self.assertEqual(task.queue, client_ids[0].Queue())
+
+  def testConcurrentPollsAreLeasedTogether(self):
+    client_ids = self.SetupClients(3)
+    for client_id in client_ids:
+      flow.GRRFlow.StartFlow(
+          client_id=client_id,
+          flow_name=flow_test_lib.SendingFlow.__name__,
+          message_count=2,
+          token=self.token)
+
+    drains = []
+    drain = self.server.DrainTaskSchedulerQueueForClients
+
+    def RecordingDrain(clients, max_count=None):
+      drains.append(sorted(clients))
+      return drain(clients, max_count=max_count)
+
+    tasks = {}
+
+    def Poll(client_id):
+      tasks[client_id] = coalescer.Drain(client_id, 5)
+
+    coalescer = self.server.task_lease_coalescer
+    with utils.MultiStubber((coalescer, "window", 60),
+                            (coalescer, "max_batch_size", 3),
+                            (coalescer, "drain", RecordingDrain)):
+      threads = [
+          threading.Thread(target=Poll, args=(client_id,))
+          for client_id in client_ids
+      ]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+
+    self.assertEqual(drains, [sorted(client_ids)])
+    for client_id in client_ids:
+      self.assertEqual(len(tasks[client_id]), 2)
+      for task in tasks[client_id]:
+        self.assertEqual(task.queue, client_id.Queue())
+
+  def testDrainSkipsClientsWithEmptyQueues(self):
+    self.server.empty_queue_cache = queue_manager.EmptyQueueCache(max_size=100)
+    client_id = self.SetupClient(0)
+    self.assertEqual(
+        self.server.DrainTaskSchedulerQueueForClient(client_id, 5), [])
+
+    with utils.Stubber(queue_manager.QueueManager, "MultiQueryAndOwn",
+                       lambda *args, **kwargs: self.fail("Queue was read.")):
+      self.assertEqual(
+          self.server.DrainTaskSchedulerQueueForClient(client_id, 5), [])
+
+    flow.GRRFlow.StartFlow(
+        client_id=client_id,
+        flow_name=flow_test_lib.SendingFlow.__name__,
+        message_count=1,
+        token=self.token)
+    with test_lib.FakeTime(time.time() + 2):
+      tasks = self.server.DrainTaskSchedulerQueueForClient(client_id, 5)
+    self.assertEqual(len(tasks), 1)
+
   def testHandleMessageBundle(self):
     """Check that HandleMessageBundles() requeues messages if it failed.
 
@@ -740,6 +900,288 @@ class ClientCommsTest(test_lib.GRRBaseTest):
     self.assertEqual(len(list(self.ClientServerCommunicate())), 10)
 
 
+class RemoteCipherCacheTest(test_lib.GRRBaseTest):
+  """Tests reusing the ciphers for messages sent to clients."""
+
+  def setUp(self):
+    super(RemoteCipherCacheTest, self).setUp()
+
+    self.client_private_key = config.CONFIG["Client.private_key"]
+    client_cert = self.ClientCertFromPrivateKey(self.client_private_key)
+    self.client_id = client_cert.GetCN()
+    with aff4.FACTORY.Create(
+        self.client_id, aff4_grr.VFSGRRClient, token=self.token) as client:
+      client.Set(client.Schema.CERT, client_cert)
+
+    self.server_communicator = front_end.ServerCommunicator(
+        certificate=config.CONFIG["Frontend.certificate"],
+        private_key=config.CONFIG["PrivateKeys.server_key"],
+        token=self.token)
+
+  def _Encode(self, name):
+    message_list = rdf_flows.MessageList()
+    message_list.job.Append(session_id="aff4:/flows/W:1", name=name)
+
+    result = rdf_flows.ClientCommunication()
+    self.server_communicator.EncodeMessages(
+        message_list, result, destination=self.client_id)
+    return result
+
+  def _Decode(self, result):
+    cipher = communicator.ReceivedCipher(result, self.client_private_key)
+    packed_message_list = rdf_flows.PackedMessageList.FromSerializedString(
+        cipher.Decrypt(result.encrypted, result.packet_iv))
+    message_list = communicator.Communicator.DecompressMessageList(
+        packed_message_list)
+    return [message.name for message in message_list.job]
+
+  def testCipherIsReusedForTheSameClient(self):
+    rsa_operations = stats.STATS.GetMetricValue("grr_rsa_operations")
+
+    with test_lib.FakeTime(100):
+      first = self._Encode("first")
+      second = self._Encode("second")
+
+    self.assertEqual(
+        stats.STATS.GetMetricValue("grr_rsa_operations"), rsa_operations + 1)
+    self.assertEqual(first.encrypted_cipher, second.encrypted_cipher)
+    self.assertNotEqual(first.packet_iv, second.packet_iv)
+    self.assertEqual(self._Decode(first), ["first"])
+    self.assertEqual(self._Decode(second), ["second"])
+
+  def testCipherIsReplacedWhenItIsTooOld(self):
+    with test_lib.FakeTime(100):
+      first = self._Encode("first")
+
+    with test_lib.FakeTime(100 + rdfvalue.Duration("1d").seconds + 1):
+      second = self._Encode("second")
+
+    self.assertNotEqual(first.encrypted_cipher, second.encrypted_cipher)
+    self.assertEqual(self._Decode(second), ["second"])
+
+
+class _SendingCommunicator(communicator.Communicator):
+  """Encodes messages from a client to the server, without client comms."""
+
+  def __init__(self, client_id, private_key):
+    super(_SendingCommunicator, self).__init__(private_key=private_key)
+    self.common_name = rdfvalue.RDFURN(client_id)
+    self.server_name = "server"
+
+  def _GetRemotePublicKey(self, unused_common_name):
+    return config.CONFIG["Frontend.certificate"].GetPublicKey()
+
+
+class DecodePipelineTest(test_lib.GRRBaseTest):
+  """Tests decoding message bundles from clients."""
+
+  def setUp(self):
+    super(DecodePipelineTest, self).setUp()
+
+    client_private_key = config.CONFIG["Client.private_key"]
+    client_cert = self.ClientCertFromPrivateKey(client_private_key)
+    self.client_id = client_cert.GetCN()
+    with aff4.FACTORY.Create(
+        self.client_id, aff4_grr.VFSGRRClient, token=self.token) as client:
+      client.Set(client.Schema.CERT, client_cert)
+
+    self.client_communicator = _SendingCommunicator(self.client_id,
+                                                    client_private_key)
+
+  def _CreateServerCommunicator(self, ping_update_interval=0):
+    with test_lib.ConfigOverrider({
+        "Frontend.ping_update_interval": ping_update_interval
+    }):
+      server_communicator = front_end.ServerCommunicator(
+          certificate=config.CONFIG["Frontend.certificate"],
+          private_key=config.CONFIG["PrivateKeys.server_key"],
+          token=self.token)
+    self.addCleanup(server_communicator.ping_updater.Stop)
+    return server_communicator
+
+  def _Encode(self, names, timestamp):
+    message_list = rdf_flows.MessageList()
+    for name in names:
+      message_list.job.Append(session_id="aff4:/flows/W:1", name=name)
+
+    request_comms = rdf_flows.ClientCommunication()
+    self.client_communicator.EncodeMessages(
+        message_list, request_comms, timestamp=long(timestamp))
+    return request_comms
+
+  def _Decode(self, server_communicator, names, timestamp=None):
+    if timestamp is None:
+      timestamp = rdfvalue.RDFDatetime.Now()
+    messages, source, _ = server_communicator.DecodeMessages(
+        self._Encode(names, timestamp))
+
+    self.assertEqual(source, self.client_id)
+    self.assertEqual([m.name for m in messages], names)
+    return messages[0].auth_state
+
+  def _GetPing(self):
+    client = aff4.FACTORY.Open(self.client_id, token=self.token)
+    return client.Get(client.Schema.PING).AsSecondsSinceEpoch()
+
+  def testLargeBundlesAreDecodedInTheProcessPool(self):
+    server_communicator = self._CreateServerCommunicator()
+    pool = process_pool.ProcessPool(1)
+    self.addCleanup(pool.Stop)
+    pool_runs = []
+
+    def Run(function, *args):
+      pool_runs.append(function)
+      return process_pool.ProcessPool.Run(pool, function, *args)
+
+    with utils.MultiStubber((process_pool, "POOL", pool), (pool, "Run", Run)):
+      with test_lib.ConfigOverrider({
+          "Frontend.process_pool_min_bundle_size": 1000
+      }):
+        # Random names, so that the bundle does not compress below the limit.
+        self.assertEqual(
+            self._Decode(server_communicator, [os.urandom(1000).encode("hex")]),
+            rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
+        self._Decode(server_communicator, ["small"])
+
+    self.assertEqual(pool_runs, [communicator.DecryptMessageList])
+
+  def testPingUpdatesAreDeferred(self):
+    server_communicator = self._CreateServerCommunicator(
+        ping_update_interval=3600)
+
+    self._Decode(server_communicator, ["first"])
+    self._Decode(server_communicator, ["second"])
+    self.assertEqual(self._GetPing(), 0)
+
+    server_communicator.ping_updater.Flush()
+    self.assertGreater(self._GetPing(), 0)
+
+  def testPingUpdatesAreWrittenRightAwayWithoutInterval(self):
+    server_communicator = self._CreateServerCommunicator()
+
+    self._Decode(server_communicator, ["first"])
+
+    self.assertGreater(self._GetPing(), 0)
+
+  def testPendingValuesAreMergedPerClient(self):
+    updater = front_end.ClientPingUpdater(
+        3600, write_aff4=False, write_relational_db=True)
+    self.addCleanup(updater.Stop)
+    writes = []
+
+    with utils.Stubber(data_store.REL_DB, "WriteClientMetadata",
+                       lambda client_id, **kw: writes.append((client_id, kw))):
+      updater.Update("C.1000000000000000", ip="10.0.0.1", clock=1, ping=2)
+      updater.Update("C.1000000000000000", clock=3, ping=4)
+      self.assertEqual(writes, [])
+      self.assertEqual(updater.GetClock("C.1000000000000000"), 3)
+
+      updater.Flush()
+
+    self.assertEqual(len(writes), 1)
+    client_id, metadata = writes[0]
+    self.assertEqual(client_id, "C.1000000000000000")
+    self.assertEqual(metadata["last_ip"].human_readable_address, "10.0.0.1")
+    self.assertEqual(metadata["last_clock"], 3)
+    self.assertEqual(metadata["last_ping"], 4)
+
+  def testCachedClientsAreNotModified(self):
+    server_communicator = self._CreateServerCommunicator()
+
+    self._Decode(server_communicator, ["first"])
+    client = server_communicator.client_cache.Get(self.client_id)
+
+    self.assertFalse(client.new_attributes)
+    self.assertGreater(self._GetPing(), 0)
+
+  def testPendingClockIsUsedForReplayProtection(self):
+    server_communicator = self._CreateServerCommunicator(
+        ping_update_interval=3600)
+    now = rdfvalue.RDFDatetime.Now()
+
+    self._Decode(server_communicator, ["first"], timestamp=now)
+    server_communicator.client_cache.Flush()
+
+    self.assertEqual(
+        self._Decode(
+            server_communicator, ["replayed"],
+            timestamp=now - rdfvalue.Duration("2h")),
+        rdf_flows.GrrMessage.AuthorizationState.DESYNCHRONIZED)
+
+
+class MessageListCompressionTest(test_lib.GRRBaseTest):
+  """Tests the compression of PackedMessageLists."""
+
+  def _Encode(self, payloads, api_version=3):
+    message_list = rdf_flows.MessageList()
+    for payload in payloads:
+      message_list.job.Append(session_id="aff4:/flows/W:1", payload=payload)
+
+    packed_message_list = rdf_flows.PackedMessageList()
+    communicator.Communicator.EncodeMessageList(
+        message_list, packed_message_list, api_version=api_version)
+    return packed_message_list
+
+  def _Decode(self, packed_message_list):
+    message_list = communicator.Communicator.DecompressMessageList(
+        packed_message_list)
+    return [message.payload for message in message_list.job]
+
+  def testCompressibleMessagesAreCompressed(self):
+    payloads = [rdfvalue.RDFString("x" * 1000)] * 10
+
+    for level in [1, 9]:
+      with test_lib.ConfigOverrider({"Network.compression_level": level}):
+        packed_message_list = self._Encode(payloads)
+
+      self.assertEqual(packed_message_list.compression,
+                       rdf_flows.PackedMessageList.CompressionType.ZCOMPRESSION)
+      self.assertEqual(self._Decode(packed_message_list), payloads)
+
+  def testCompressedBlobsAreNotCompressedAgain(self):
+    blob = rdf_protodict.DataBlob(
+        data=zlib.compress("x" * 100000),
+        compression=rdf_protodict.DataBlob.CompressionType.ZCOMPRESSION)
+
+    with utils.Stubber(communicator.ZlibCompression, "Compress",
+                       lambda *_: self.fail("Compressed the blobs.")):
+      packed_message_list = self._Encode([blob, rdfvalue.RDFString("x")])
+
+    self.assertEqual(packed_message_list.compression,
+                     rdf_flows.PackedMessageList.CompressionType.UNCOMPRESSED)
+    self.assertEqual(self._Decode(packed_message_list)[0], blob)
+
+  def testUncompressedBlobsAreCompressed(self):
+    blob = rdf_protodict.DataBlob(data="x" * 100000)
+
+    packed_message_list = self._Encode([blob])
+
+    self.assertEqual(packed_message_list.compression,
+                     rdf_flows.PackedMessageList.CompressionType.ZCOMPRESSION)
+
+  def testCompressionIsOnlyUsedIfTheReceiverSupportsIt(self):
+    payloads = [rdfvalue.RDFString("x" * 1000)]
+
+    with utils.Stubber(communicator.ZlibCompression, "min_api_version", 4):
+      old_endpoint = self._Encode(payloads, api_version=3)
+      new_endpoint = self._Encode(payloads, api_version=4)
+
+    self.assertEqual(old_endpoint.compression,
+                     rdf_flows.PackedMessageList.CompressionType.UNCOMPRESSED)
+    self.assertEqual(new_endpoint.compression,
+                     rdf_flows.PackedMessageList.CompressionType.ZCOMPRESSION)
+
+  def testInvalidCompressedDataIsRejected(self):
+    packed_message_list = rdf_flows.PackedMessageList(
+        message_list="not zlib data", compression=1)
+
+    with self.assertRaises(communicator.DecodingError):
+      self._Decode(packed_message_list)
+
+    with self.assertRaisesRegexp(communicator.DecodingError, "not supported"):
+      communicator.MessageListCompressor.GetCompressor(99)
+
+
 class HTTPClientTests(test_lib.GRRBaseTest):
   """Test the http communicator."""
 
@@ -133,7 +133,7 @@ class HuntRunner(object):
     # ASAP. This must happen before we actually run the hunt to ensure the
     # client requests are removed from the client queues.
     with queue_manager.QueueManager(token=self.token) as manager:
-      for request, _ in manager.FetchCompletedRequests(
+      for request, _ in self.queue_manager.FetchCompletedRequests(
           self.session_id, timestamp=(0, notification.timestamp)):
         # Requests which are not destined to clients have no embedded request
         # message.
@@ -556,7 +556,8 @@ class HuntRunner(object):
     thread_pool.AddTask(
         target=self.RunStateMethod,
         args=(request.next_state, request, responses, event),
-        name="Hunt processing")
+        name="Hunt processing",
+        task_class=flow.HUNT_REQUEST_TASK)
 
   def Log(self, format_str, *args):
     """Logs the message using the hunt's standard logging.
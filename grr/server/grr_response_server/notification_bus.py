@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""Wakes up workers when new notifications are written.
+
+Workers find new work by scanning their notification queues. Without a bus
+they scan every Worker.POLLING_INTERVAL seconds, which adds latency to every
+flow step and loads the data store even when the system is idle. With a bus
+configured, the data store publishes the queue shard every time a
+notification is written and workers block on their subscription until they
+are woken up. A subscription only covers the shards its worker owns, and a
+woken up worker scans the shards that were published next. The polling
+interval then only serves as a fallback in case a
+wake up gets lost.
+"""
+
+import errno
+import itertools
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+
+from grr import config
+from grr.lib import registry
+from grr.lib import stats
+from grr.lib import utils
+
+
+class Subscription(object):
+  """A subscription to notifications on a set of queues."""
+
+  def __init__(self, queues, shard_indices=None):
+    """Constructor.
+
+    Args:
+      queues: The queues to receive notifications for.
+      shard_indices: If given, only notifications for the shards with these
+        indices are received, e.g. the shards owned by a worker process.
+    """
+    self.queues = [utils.SmartUnicode(queue).rstrip("/") for queue in queues]
+    self.shard_indices = set(shard_indices) if shard_indices else None
+
+  def ShardIndex(self, queue_shard):
+    """Returns the shard index of queue_shard, None if it is not ours."""
+    queue_shard = utils.SmartUnicode(queue_shard).rstrip("/")
+    for queue in self.queues:
+      if queue_shard == queue:
+        shard_index = 0
+      elif queue_shard.startswith(queue + "/"):
+        try:
+          shard_index = int(queue_shard[len(queue) + 1:])
+        except ValueError:
+          continue
+      else:
+        continue
+
+      if self.shard_indices is None or shard_index in self.shard_indices:
+        return shard_index
+    return None
+
+  def Matches(self, queue_shard):
+    """Returns True if queue_shard is one of the shards we subscribed to."""
+    return self.ShardIndex(queue_shard) is not None
+
+  def Wait(self, timeout):
+    """Blocks until a matching notification arrives or timeout passes.
+
+    Args:
+      timeout: The maximum time to block, in seconds.
+
+    Returns:
+      The sorted list of the indices of the shards notifications were
+      published for since the last call, an empty list if the timeout expired.
+    """
+    time.sleep(timeout)
+    return []
+
+  def Close(self):
+    pass
+
+
+class NotificationBus(object):
+  """The default bus, which delivers nothing and leaves workers polling."""
+
+  __metaclass__ = registry.MetaclassRegistry
+
+  def Publish(self, queue_shard):
+    """Announces that notifications were written to queue_shard."""
+
+  def Subscribe(self, queues, shard_indices=None):
+    """Returns a Subscription for notifications on the given queues.
+
+    Args:
+      queues: The queues to receive notifications for.
+      shard_indices: If given, only notifications for the shards with these
+        indices are received.
+    """
+    return Subscription(queues, shard_indices=shard_indices)
+
+
+class LocalSubscription(Subscription):
+  """A subscription on a LocalNotificationBus."""
+
+  def __init__(self, bus, queues, shard_indices=None):
+    super(LocalSubscription, self).__init__(queues, shard_indices=shard_indices)
+    self.bus = bus
+    self.lock = threading.Lock()
+    self.event = threading.Event()
+    self.published = set()
+
+  def Notify(self, shard_index):
+    with self.lock:
+      self.published.add(shard_index)
+      self.event.set()
+
+  def Wait(self, timeout):
+    self.event.wait(timeout)
+    with self.lock:
+      self.event.clear()
+      published = self.published
+      self.published = set()
+    return sorted(published)
+
+  def Close(self):
+    self.bus.Unsubscribe(self)
+
+
+class LocalNotificationBus(NotificationBus):
+  """A bus delivering notifications to subscribers in the same process."""
+
+  def __init__(self):
+    super(LocalNotificationBus, self).__init__()
+    self.lock = threading.Lock()
+    self.subscriptions = []
+
+  def Publish(self, queue_shard):
+    with self.lock:
+      subscriptions = list(self.subscriptions)
+
+    for subscription in subscriptions:
+      shard_index = subscription.ShardIndex(queue_shard)
+      if shard_index is not None:
+        subscription.Notify(shard_index)
+
+  def Subscribe(self, queues, shard_indices=None):
+    subscription = LocalSubscription(
+        self, queues, shard_indices=shard_indices)
+    with self.lock:
+      self.subscriptions.append(subscription)
+    return subscription
+
+  def Unsubscribe(self, subscription):
+    with self.lock:
+      if subscription in self.subscriptions:
+        self.subscriptions.remove(subscription)
+
+
+class UnixSocketSubscription(Subscription):
+  """A subscription listening on a unix datagram socket."""
+
+  def __init__(self, path, queues, shard_indices=None):
+    super(UnixSocketSubscription, self).__init__(
+        queues, shard_indices=shard_indices)
+    self.path = path
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self.sock.bind(path)
+    self.sock.setblocking(False)
+
+  def Wait(self, timeout):
+    # Datagrams published while the worker was busy are queued up in the
+    # socket, so they wake us up right away.
+    deadline = time.time() + timeout
+    while True:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return []
+
+      try:
+        readable, _, _ = select.select([self.sock], [], [], remaining)
+      except select.error as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+
+      if readable:
+        published = self._Drain()
+        if published:
+          return published
+
+  def _Drain(self):
+    """Reads all pending datagrams, returns the sorted matching shards."""
+    published = set()
+    while True:
+      try:
+        queue_shard = self.sock.recv(UnixSocketNotificationBus.MAX_MESSAGE_SIZE)
+      except socket.error as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return sorted(published)
+        raise
+
+      shard_index = self.ShardIndex(queue_shard)
+      if shard_index is not None:
+        published.add(shard_index)
+
+  def Close(self):
+    self.sock.close()
+    try:
+      os.unlink(self.path)
+    except OSError:
+      pass
+
+
+class UnixSocketNotificationBus(NotificationBus):
+  """A bus broadcasting notifications to all processes on this machine.
+
+  Every subscriber binds a datagram socket in Worker.notification_bus_path.
+  Publishing sends the queue shard to every socket found there, so frontends
+  and workers running on the same machine wake each other up without a
+  broker process. Sockets left behind by dead subscribers are removed by the
+  next publisher.
+  """
+
+  MAX_MESSAGE_SIZE = 4096
+
+  _subscription_counter = itertools.count()
+
+  def __init__(self, path=None):
+    super(UnixSocketNotificationBus, self).__init__()
+    if path is None:
+      path = config.CONFIG["Worker.notification_bus_path"]
+    self.path = path
+    self.lock = threading.Lock()
+    self.sock = None
+
+  def _Socket(self):
+    if self.sock is None:
+      self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+      self.sock.setblocking(False)
+    return self.sock
+
+  def Publish(self, queue_shard):
+    message = utils.SmartStr(queue_shard)
+    try:
+      names = os.listdir(self.path)
+    except OSError:
+      # Nobody has subscribed yet.
+      return
+
+    with self.lock:
+      sock = self._Socket()
+      for name in names:
+        if not name.endswith(".sock"):
+          continue
+
+        path = os.path.join(self.path, name)
+        try:
+          sock.sendto(message, path)
+        except socket.error as e:
+          if e.errno == errno.ECONNREFUSED:
+            # Nobody is listening on this socket anymore.
+            logging.debug("Removing stale notification socket %s.", path)
+            try:
+              os.unlink(path)
+            except OSError:
+              pass
+          elif e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOENT):
+            # A full socket buffer means the subscriber has pending wake ups
+            # already, everything else only delays it until its next poll.
+            logging.warning("Unable to publish notification to %s: %s", path,
+                            e)
+          stats.STATS.IncrementCounter("notification_bus_publish_errors")
+
+  def Subscribe(self, queues, shard_indices=None):
+    try:
+      os.makedirs(self.path)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+    path = os.path.join(self.path, "%d.%d.sock" %
+                        (os.getpid(), next(self._subscription_counter)))
+    if os.path.exists(path):
+      # Left behind by a dead process which had our pid.
+      os.unlink(path)
+    return UnixSocketSubscription(path, queues, shard_indices=shard_indices)
+
+
+BUS = None
+
+
+def Publish(queue_shard):
+  """Publishes queue_shard on the configured bus, if any."""
+  if BUS is not None:
+    BUS.Publish(queue_shard)
+
+
+class NotificationBusInit(registry.InitHook):
+  """Creates the configured notification bus."""
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("notification_bus_publish_errors")
+
+    global BUS  # pylint: disable=global-statement
+
+    bus_cls_name = config.CONFIG["Worker.notification_bus_class"]
+    logging.debug("Using notification bus: %s", bus_cls_name)
+    BUS = NotificationBus.classes[bus_cls_name]()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""Tests for the notification bus."""
+
+import os
+import threading
+
+from grr.lib import flags
+from grr.lib import queues
+from grr.lib import rdfvalue
+from grr.lib import utils
+from grr.server.grr_response_server import notification_bus
+from grr.server.grr_response_server import queue_manager
+from grr.test_lib import test_lib
+
+
+class SubscriptionTest(test_lib.GRRBaseTest):
+
+  def testMatchesQueueAndItsShards(self):
+    subscription = notification_bus.Subscription([queues.FLOWS])
+
+    self.assertTrue(subscription.Matches(queues.FLOWS))
+    self.assertTrue(subscription.Matches(queues.FLOWS.Add("3")))
+    self.assertFalse(subscription.Matches(queues.HUNTS))
+    self.assertFalse(subscription.Matches(rdfvalue.RDFURN("F2")))
+
+  def testOnlyMatchesTheGivenShards(self):
+    subscription = notification_bus.Subscription(
+        [queues.FLOWS], shard_indices=[0, 3])
+
+    self.assertEqual(subscription.ShardIndex(queues.FLOWS), 0)
+    self.assertEqual(subscription.ShardIndex(queues.FLOWS.Add("3")), 3)
+    self.assertIsNone(subscription.ShardIndex(queues.FLOWS.Add("2")))
+    self.assertFalse(subscription.Matches(queues.FLOWS.Add("2")))
+
+
+class LocalNotificationBusTest(test_lib.GRRBaseTest):
+
+  def setUp(self):
+    super(LocalNotificationBusTest, self).setUp()
+    self.bus = notification_bus.LocalNotificationBus()
+
+  def testWaitTimesOutWithoutNotifications(self):
+    subscription = self.bus.Subscribe([queues.FLOWS])
+    self.bus.Publish(queues.HUNTS)
+    self.assertFalse(subscription.Wait(0.01))
+
+  def testNotificationPublishedBeforeWaitIsNotLost(self):
+    subscription = self.bus.Subscribe([queues.FLOWS])
+    self.bus.Publish(queues.FLOWS.Add("2"))
+
+    self.assertTrue(subscription.Wait(0))
+    # The wake up is consumed.
+    self.assertFalse(subscription.Wait(0))
+
+  def testPublishWakesUpWaitingSubscriber(self):
+    subscription = self.bus.Subscribe([queues.FLOWS])
+    results = []
+    waiter = threading.Thread(
+        target=lambda: results.append(subscription.Wait(60)))
+    waiter.start()
+    self.bus.Publish(queues.FLOWS)
+    waiter.join()
+
+    self.assertEqual(results, [[0]])
+
+  def testWaitReturnsThePublishedShards(self):
+    subscription = self.bus.Subscribe([queues.FLOWS], shard_indices=[1, 2])
+    for shard in ["2", "3", "1", "2"]:
+      self.bus.Publish(queues.FLOWS.Add(shard))
+
+    self.assertEqual(subscription.Wait(0), [1, 2])
+
+  def testClosedSubscriptionIsNotNotified(self):
+    subscription = self.bus.Subscribe([queues.FLOWS])
+    subscription.Close()
+    self.bus.Publish(queues.FLOWS)
+    self.assertFalse(subscription.Wait(0))
+
+  def testWritingNotificationsPublishesTheShard(self):
+    subscription = self.bus.Subscribe([queues.FLOWS])
+
+    with utils.Stubber(notification_bus, "BUS", self.bus):
+      with queue_manager.QueueManager(token=self.token) as manager:
+        manager.QueueNotification(
+            session_id=rdfvalue.SessionID(queue=queues.FLOWS, flow_name="42"))
+        # Nothing is published before the notification is written.
+        self.assertFalse(subscription.Wait(0))
+
+    self.assertTrue(subscription.Wait(0))
+
+
+class UnixSocketNotificationBusTest(test_lib.GRRBaseTest):
+
+  def setUp(self):
+    super(UnixSocketNotificationBusTest, self).setUp()
+    self.path = os.path.join(self.temp_dir, "bus")
+    self.bus = notification_bus.UnixSocketNotificationBus(path=self.path)
+
+  def testPublishWithoutSubscribers(self):
+    self.bus.Publish(queues.FLOWS)
+
+  def testPublishWakesUpSubscribers(self):
+    flows_subscription = self.bus.Subscribe([queues.FLOWS])
+    hunts_subscription = self.bus.Subscribe([queues.HUNTS])
+
+    # Publishing from another bus instance, like another process would.
+    notification_bus.UnixSocketNotificationBus(path=self.path).Publish(
+        queues.FLOWS.Add("1"))
+
+    self.assertEqual(flows_subscription.Wait(5), [1])
+    self.assertFalse(flows_subscription.Wait(0))
+    self.assertFalse(hunts_subscription.Wait(0))
+
+    flows_subscription.Close()
+    hunts_subscription.Close()
+    self.assertEqual(os.listdir(self.path), [])
+
+  def testStaleSocketsAreRemoved(self):
+    subscription = self.bus.Subscribe([queues.FLOWS])
+    # Simulate a subscriber that died without cleaning up.
+    subscription.sock.close()
+    self.assertEqual(len(os.listdir(self.path)), 1)
+
+    self.bus.Publish(queues.FLOWS)
+
+    self.assertEqual(os.listdir(self.path), [])
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
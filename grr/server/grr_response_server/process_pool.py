@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""A process pool for CPU heavy work done by flows.
+
+Flow states run in the worker's thread pool, so parsing large amounts of
+client data holds the GIL and stalls every other flow on that worker. Pure
+functions which only work on RDFValues can instead be sent to a pool of
+worker processes with Run(). Arguments and results are passed across the
+process boundary as serialized RDFValues.
+
+The frontend also uses the pool to decode large client message bundles.
+
+The pool is only started by the worker and the frontend, everywhere else Run()
+calls the function in the calling thread.
+"""
+
+import logging
+import multiprocessing
+import threading
+import types
+
+
+from grr.lib import rdfvalue
+from grr.lib import stats
+
+# Tags used to pack values for the trip across the process boundary.
+_PLAIN = 0
+_RDFVALUE = 1
+_LIST = 2
+_TUPLE = 3
+_DICT = 4
+
+
+def _Pack(value):
+  """Converts value into something that pickles without RDFValue support."""
+  if isinstance(value, rdfvalue.RDFValue):
+    return (_RDFVALUE, value.__class__.__name__, value.SerializeToString())
+  if isinstance(value, list):
+    return (_LIST, [_Pack(v) for v in value])
+  if isinstance(value, tuple):
+    return (_TUPLE, [_Pack(v) for v in value])
+  if isinstance(value, dict):
+    return (_DICT, [(k, _Pack(v)) for k, v in value.iteritems()])
+  return (_PLAIN, value)
+
+
+def _Unpack(packed):
+  """Reverses _Pack()."""
+  tag = packed[0]
+  if tag == _RDFVALUE:
+    _, cls_name, serialized = packed
+    return rdfvalue.RDFValue.classes[cls_name].FromSerializedString(serialized)
+  if tag == _LIST:
+    return [_Unpack(v) for v in packed[1]]
+  if tag == _TUPLE:
+    return tuple(_Unpack(v) for v in packed[1])
+  if tag == _DICT:
+    return dict((k, _Unpack(v)) for k, v in packed[1])
+  return packed[1]
+
+
+def _InitPoolProcess():
+  """Replaces locks which other threads may have held at fork time.
+
+  The pool is forked after server_startup.Init() started the stats server
+  and other background threads. Only the forking thread exists in the pool
+  processes, so a lock one of the other threads held at the time of the fork
+  would never be released. Parsers and checks log and update stats, so the
+  logging and stats locks are recreated before the first task runs.
+  """
+  # pylint: disable=protected-access
+  logging._lock = threading.RLock()
+  for handler_ref in logging._handlerList:
+    handler = handler_ref()
+    if handler is not None:
+      handler.createLock()
+  # pylint: enable=protected-access
+
+  stats.STATS.lock = threading.RLock()
+
+
+def _RunPacked(function, packed_args, packed_kwargs):
+  """Runs function in a pool process."""
+  result = function(*_Unpack(packed_args), **_Unpack(packed_kwargs))
+  if isinstance(result, types.GeneratorType):
+    result = list(result)
+  return _Pack(result)
+
+
+class ProcessPool(object):
+  """A pool of processes running functions on RDFValues."""
+
+  # A pool process that dies leaves its task unfinished forever, so we never
+  # wait longer than this for a result.
+  TASK_TIMEOUT = 3600
+
+  def __init__(self, processes):
+    # The processes are forked, so they share the parser and check
+    # registries of the worker. They must not use its data store connections
+    # or any lock other than the ones _InitPoolProcess() replaces.
+    self.pool = multiprocessing.Pool(processes, initializer=_InitPoolProcess)
+    self.processes = processes
+
+  def Run(self, function, *args, **kwargs):
+    """Runs function(*args, **kwargs) in one of the pool processes.
+
+    Args:
+      function: A module level function, so that it can be pickled.
+      *args: Positional arguments, RDFValues or plain python values and lists,
+        tuples or dicts of them.
+      **kwargs: Keyword arguments, as for args.
+
+    Returns:
+      The return value of the function. Generators are returned as a list.
+    """
+    result = self.pool.apply_async(_RunPacked,
+                                   (function, _Pack(args), _Pack(kwargs)))
+    return _Unpack(result.get(self.TASK_TIMEOUT))
+
+  def Stop(self):
+    self.pool.terminate()
+    self.pool.join()
+
+
+POOL = None
+
+
+def Start(processes):
+  """Starts the process pool if processes is positive."""
+  global POOL  # pylint: disable=global-statement
+
+  if processes > 0 and POOL is None:
+    logging.info("Starting process pool with %d processes.", processes)
+    POOL = ProcessPool(processes)
+
+
+def Stop():
+  global POOL  # pylint: disable=global-statement
+
+  if POOL is not None:
+    POOL.Stop()
+    POOL = None
+
+
+def Run(function, *args, **kwargs):
+  """Runs function in the process pool, or directly if there is none."""
+  if POOL is None:
+    return function(*args, **kwargs)
+  return POOL.Run(function, *args, **kwargs)
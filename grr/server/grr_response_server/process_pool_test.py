@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""Tests for the process pool."""
+
+import logging
+import os
+import threading
+
+from grr.lib import flags
+from grr.lib import parsers
+from grr.lib import rdfvalue
+from grr.lib import stats
+from grr.lib import utils
+from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import paths as rdf_paths
+from grr.lib.rdfvalues import protodict as rdf_protodict
+from grr.server.grr_response_server import artifact
+from grr.server.grr_response_server import process_pool
+from grr.test_lib import test_lib
+
+
+def ProcessId(unused_value):
+  return os.getpid()
+
+
+def Echo(*args, **kwargs):
+  return args, kwargs
+
+
+def Fail(message):
+  raise parsers.ParseError(message)
+
+
+def LogAndTakeStatsLock():
+  logging.info("Running in the process pool.")
+  with stats.STATS.lock:
+    return True
+
+
+def YieldStrings(count):
+  for i in range(count):
+    yield rdfvalue.RDFString("string %d" % i)
+
+
+class PidParser(parsers.RegistryValueParser):
+  """Reports which process it ran in."""
+
+  supported_artifacts = ["ProcessPoolTestArtifact"]
+
+  def Parse(self, stat, knowledge_base):
+    yield rdf_protodict.Dict(
+        path=stat.pathspec.path, os=knowledge_base.os, pid=os.getpid())
+
+
+class ProcessPoolTest(test_lib.GRRBaseTest):
+
+  def setUp(self):
+    super(ProcessPoolTest, self).setUp()
+    self.pool = process_pool.ProcessPool(2)
+
+  def tearDown(self):
+    self.pool.Stop()
+    super(ProcessPoolTest, self).tearDown()
+
+  def testFunctionsRunInOtherProcesses(self):
+    self.assertNotEqual(self.pool.Run(ProcessId, None), os.getpid())
+
+  def testArgumentsAndResultsAreSerialized(self):
+    stat = rdf_client.StatEntry(
+        pathspec=rdf_paths.PathSpec(path="/etc/passwd"), st_size=10)
+    args, kwargs = self.pool.Run(
+        Echo, [stat, 1], {"a": (u"b", None)}, urn=rdfvalue.RDFURN("aff4:/C"))
+
+    self.assertEqual(args, ([stat, 1], {"a": (u"b", None)}))
+    self.assertIsInstance(args[0][0], rdf_client.StatEntry)
+    self.assertEqual(kwargs, {"urn": rdfvalue.RDFURN("aff4:/C")})
+    self.assertIsInstance(kwargs["urn"], rdfvalue.RDFURN)
+
+  def testGeneratorsAreReturnedAsLists(self):
+    self.assertEqual(
+        self.pool.Run(YieldStrings, 2), ["string 0", "string 1"])
+
+  def testExceptionsArePropagated(self):
+    with self.assertRaisesRegexp(parsers.ParseError, "Bad data"):
+      self.pool.Run(Fail, "Bad data")
+
+  def testParsersRunInThePool(self):
+    flow_obj = utils.DataObject(
+        state=utils.DataObject(knowledge_base=rdf_client.KnowledgeBase(
+            os="Windows")))
+    stat = rdf_client.StatEntry(
+        pathspec=rdf_paths.PathSpec(path="HKEY_LOCAL_MACHINE\\Key"))
+
+    with utils.Stubber(process_pool, "POOL", self.pool):
+      results = list(
+          artifact.ApplyParserToResponses(PidParser(), stat, None, flow_obj,
+                                          self.token))
+
+    self.assertEqual(len(results), 1)
+    self.assertEqual(results[0]["path"], "HKEY_LOCAL_MACHINE\\Key")
+    self.assertEqual(results[0]["os"], "Windows")
+    self.assertNotEqual(results[0]["pid"], os.getpid())
+
+  def testLocksHeldAtForkTimeAreReplaced(self):
+    locked = threading.Event()
+    release = threading.Event()
+
+    def HoldLocks():
+      with stats.STATS.lock:
+        logging._acquireLock()  # pylint: disable=protected-access
+        locked.set()
+        release.wait()
+        logging._releaseLock()  # pylint: disable=protected-access
+
+    holder = threading.Thread(target=HoldLocks)
+    holder.start()
+    locked.wait()
+    try:
+      pool = process_pool.ProcessPool(1)
+    finally:
+      release.set()
+      holder.join()
+
+    try:
+      with utils.Stubber(process_pool.ProcessPool, "TASK_TIMEOUT", 10):
+        self.assertTrue(pool.Run(LogAndTakeStatsLock))
+    finally:
+      pool.Stop()
+
+  def testRunWithoutPoolCallsFunctionDirectly(self):
+    self.assertEqual(process_pool.Run(ProcessId, None), os.getpid())
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
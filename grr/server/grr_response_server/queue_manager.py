@@ -4,6 +4,7 @@
 import collections
 import logging
 import random
+import threading
 
 from grr import config
 from grr.lib import rdfvalue
@@ -14,6 +15,7 @@ from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.server.grr_response_server import data_store
 from grr.server.grr_response_server import fleetspeak_utils
+from grr.server.grr_response_server import tracing
 
 
 class Error(Exception):
@@ -112,14 +114,32 @@ class QueueManager(object):
     self.prev_frozen_timestamps = []
     self.frozen_timestamp = None
 
+    # Completed requests read in bulk ahead of time, keyed by session id. See
+    # UsePrefetchedRequests.
+    self.prefetched_requests = {}
+
     self.num_notification_shards = config.CONFIG["Worker.queue_shards"]
 
-  def GetNotificationShard(self, queue):
+  def GetNotificationShard(self, queue, shard_indices=None):
+    """Returns the next notification shard of the queue to use.
+
+    Args:
+      queue: The queue to return a shard for.
+      shard_indices: If given, only the shards with these indices are cycled
+        through. Workers use this to restrict themselves to the shards they
+        own.
+
+    Returns:
+      The queue urn of the notification shard.
+    """
     queue_name = str(queue)
     QueueManager.notification_shard_counters.setdefault(queue_name, 0)
     QueueManager.notification_shard_counters[queue_name] += 1
-    notification_shard_index = (QueueManager.notification_shard_counters[
-        queue_name] % self.num_notification_shards)
+    counter = QueueManager.notification_shard_counters[queue_name]
+    if shard_indices:
+      notification_shard_index = shard_indices[counter % len(shard_indices)]
+    else:
+      notification_shard_index = counter % self.num_notification_shards
     if notification_shard_index > 0:
       return queue.Add(str(notification_shard_index))
     else:
@@ -185,15 +205,64 @@ class QueueManager(object):
     """Checks if there is a status message queued for a number of requests."""
     return self.data_store.CheckRequestsForCompletion(requests)
 
+  def UsePrefetchedRequests(self, session_id, timestamp, completed_requests,
+                            responses):
+    """Serves a flow's completed requests from data that was read in bulk.
+
+    The prefetched data is only used for fetches with exactly the same
+    timestamp range and is dropped on the next Flush(), since the flow's
+    state changes then.
+
+    Args:
+      session_id: The session id of the flow.
+      timestamp: The (start, end) time range the data was read for.
+      completed_requests: A list of (request, status) tuples as returned by
+        DataStore.ReadCompletedRequests.
+      responses: A dict mapping request ids to the sorted lists of their
+        responses. Responses of requests missing here are read from the data
+        store as usual.
+    """
+    self.prefetched_requests[session_id] = (timestamp, completed_requests,
+                                            responses)
+
+  def _GetPrefetchedRequests(self, session_id, timestamp):
+    try:
+      prefetched_timestamp, completed_requests, responses = (
+          self.prefetched_requests[session_id])
+    except KeyError:
+      return None, None
+
+    if prefetched_timestamp != timestamp:
+      return None, None
+    return completed_requests, responses
+
   def FetchCompletedRequests(self, session_id, timestamp=None):
     """Fetch all the requests with a status message queued for them."""
     if timestamp is None:
       timestamp = (0, self.frozen_timestamp or rdfvalue.RDFDatetime.Now())
 
-    for request, status in self.data_store.ReadCompletedRequests(
-        session_id, timestamp=timestamp, limit=self.request_limit):
+    completed_requests, _ = self._GetPrefetchedRequests(session_id, timestamp)
+    if completed_requests is None:
+      completed_requests = self.data_store.ReadCompletedRequests(
+          session_id, timestamp=timestamp, limit=self.request_limit)
+
+    for request, status in completed_requests:
       yield request, status
 
+  def _ReadResponses(self, session_id, timestamp, request_list):
+    """Reads responses, preferring the prefetched ones."""
+    _, prefetched = self._GetPrefetchedRequests(session_id, timestamp)
+    if not prefetched:
+      return self.data_store.ReadResponses(request_list)
+
+    missing = [r for r in request_list if r.id not in prefetched]
+    if not missing:
+      return [(r, prefetched[r.id]) for r in request_list]
+
+    read = dict((r.id, responses)
+                for r, responses in self.data_store.ReadResponses(missing))
+    return [(r, prefetched.get(r.id, read.get(r.id, []))) for r in request_list]
+
   def FetchCompletedResponses(self, session_id, timestamp=None, limit=10000):
     """Fetch only completed requests and responses up to a limit."""
     if timestamp is None:
@@ -223,7 +292,8 @@ class QueueManager(object):
         if projected_total_size > limit:
           break
 
-      for request, responses in self.data_store.ReadResponses(request_list):
+      for request, responses in self._ReadResponses(session_id, timestamp,
+                                                    request_list):
 
         yield (request, responses)
         total_size += len(responses)
@@ -287,9 +357,22 @@ class QueueManager(object):
         # Client request dequeueing is cached so we can call it directly.
         self.DeQueueClientRequest(request.client_id, request.request.task_id)
 
+  def _TracedSessionIds(self):
+    """Returns the session ids Flush() writes to, if tracing is enabled."""
+    if not tracing.TRACER.enabled:
+      return {}
+
+    session_ids = set(n.session_id for n in self.notifications.itervalues())
+    session_ids.update(r.session_id for r, _ in self.request_queue)
+    session_ids.update(r.session_id for r, _ in self.response_queue)
+    return dict((session_id, {}) for session_id in session_ids)
+
   def Flush(self):
     """Writes the changes in this object to the datastore."""
+    with tracing.TRACER.Spans("QueueManager.Flush", self._TracedSessionIds()):
+      self._Flush()
 
+  def _Flush(self):
     self.data_store.StoreRequestsAndResponses(
         new_requests=self.request_queue,
         new_responses=self.response_queue,
@@ -324,6 +407,33 @@ class QueueManager(object):
     self.client_messages_to_delete = {}
     self.notifications = {}
     self.new_client_messages = []
+    self.prefetched_requests = {}
+
+  def MergeFrom(self, other):
+    """Queues all writes pending in another queue manager in this one.
+
+    Writes which were queued without a timestamp get this manager's frozen
+    timestamp, so notifications for the same session are merged into one.
+
+    Args:
+      other: A QueueManager, which should not be flushed afterwards.
+    """
+    for request, timestamp in other.request_queue:
+      self.QueueRequest(request, timestamp=timestamp)
+    for response, timestamp in other.response_queue:
+      self.QueueResponse(response, timestamp=timestamp)
+    self.requests_to_delete.extend(other.requests_to_delete)
+
+    for client_id, task_ids in other.client_messages_to_delete.iteritems():
+      self.client_messages_to_delete.setdefault(client_id, []).extend(task_ids)
+    for msg, timestamp in other.new_client_messages:
+      self.QueueClientMessage(msg, timestamp=timestamp)
+
+    for notification in other.notifications.itervalues():
+      timestamp = None
+      if notification.HasField("timestamp"):
+        timestamp = notification.timestamp
+      self.QueueNotification(notification, timestamp=timestamp)
 
   def QueueResponse(self, response, timestamp=None):
     """Queues the message on the flow's state."""
@@ -434,11 +544,20 @@ class QueueManager(object):
 
     return output_dict
 
-  def GetNotificationsByPriority(self, queue):
-    """Retrieves session ids for processing grouped by priority."""
+  def GetNotificationsByPriority(self, queue, shard_indices=None):
+    """Retrieves session ids for processing grouped by priority.
+
+    Args:
+      queue: The queue to read notifications from.
+      shard_indices: Optional list of notification shard indices to restrict
+        the read to.
+
+    Returns:
+      A dict mapping priorities to lists of notifications.
+    """
     # Check which sessions have new data.
     # Read all the sessions that have notifications.
-    queue_shard = self.GetNotificationShard(queue)
+    queue_shard = self.GetNotificationShard(queue, shard_indices=shard_indices)
     return self._SortByPriority(
         self._GetUnsortedNotifications(queue_shard).values(), queue)
 
@@ -624,6 +743,102 @@ class QueueManager(object):
       return mutation_pool.QueueQueryAndOwn(queue, lease_seconds, limit,
                                             self.frozen_timestamp)
 
+  def MultiQueryAndOwn(self, queues, lease_seconds=10, limit=1):
+    """Leases tasks from many queues at once.
+
+    Args:
+      queues: The queues to query from.
+      lease_seconds: The tasks will be leased for this long.
+      limit: Number of tasks to lease from each queue.
+    Returns:
+      A dict mapping queues to lists of leased GrrMessage() objects. Queues
+      which hold no tasks at all are missing from the result.
+    """
+    with self.data_store.GetMutationPool() as mutation_pool:
+      return mutation_pool.QueueMultiQueryAndOwn(queues, lease_seconds, limit,
+                                                 self.frozen_timestamp)
+
+
+class EmptyQueueCache(object):
+  """Remembers which task queues had no tasks at all.
+
+  Most clients have nothing queued when they poll, so frontends check this
+  before leasing tasks and skip the data store for queues known to be empty.
+  Scheduling tasks logs the queue in the data store, the cache reads that
+  log every sync_interval seconds and forgets the queues in it.
+  """
+
+  # Change log entries are read with this much overlap in seconds, to cover
+  # clock skew between machines and writes in flight.
+  SYNC_OVERLAP = 5
+
+  def __init__(self, store=None, max_size=100000, max_age=3600,
+               sync_interval=1):
+    if store is None:
+      store = data_store.DB
+    self.data_store = store
+    self.queues = utils.AgeBasedCache(max_size=max_size, max_age=max_age)
+    self.sync_interval = sync_interval
+    self.lock = threading.RLock()
+    self.last_sync = None
+    # Bumped on every sync, see MarkEmpty.
+    self.generation = 0
+
+  def Sync(self):
+    """Forgets queues which had tasks scheduled since the last sync.
+
+    Returns:
+      The current generation of the cache, to be passed to MarkEmpty.
+    """
+    with self.lock:
+      now = int(rdfvalue.RDFDatetime.Now())
+      last_sync = self.last_sync
+      if last_sync is not None and now - last_sync < self.sync_interval * 1e6:
+        return self.generation
+
+      start = (last_sync or 0) - self.SYNC_OVERLAP * 1e6
+      if (last_sync is None or
+          now - start >= self.data_store.QUEUE_CHANGES_RETENTION):
+        # The change log does not go back far enough to tell what changed.
+        self.queues.Flush()
+      else:
+        for queue in self.data_store.QueueReadChanges(start, now):
+          self.queues.ExpireObject(queue)
+
+      bucket_size = self.data_store.QUEUE_CHANGES_BUCKET_SIZE
+      if last_sync is None or now // bucket_size != last_sync // bucket_size:
+        self.data_store.QueueExpireChanges(now)
+
+      self.last_sync = now
+      self.generation += 1
+      return self.generation
+
+  def IsEmpty(self, queue):
+    with self.lock:
+      try:
+        return self.queues.Get(utils.SmartUnicode(queue))
+      except KeyError:
+        return False
+
+  def MarkEmpty(self, queues, generation):
+    """Remembers queues as empty.
+
+    Args:
+      queues: Queues which were found to hold no tasks.
+      generation: The value Sync() returned before the queues were read. If
+        the cache was synced since, the queues might have changed after they
+        were read and are not remembered.
+    """
+    with self.lock:
+      if generation != self.generation:
+        return
+      for queue in queues:
+        self.queues.Put(utils.SmartUnicode(queue), True)
+
+  def Forget(self, queue):
+    with self.lock:
+      self.queues.ExpireObject(utils.SmartUnicode(queue))
+
 
 class WellKnownQueueManager(QueueManager):
   """A flow manager for well known flows."""
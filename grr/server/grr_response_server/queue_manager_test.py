@@ -426,6 +426,64 @@ class QueueManagerTest(flow_test_lib.FlowTestsBaseclass):
     self._current_mock_time += 10
     self.assertEqual(len(manager.GetNotificationsForAllShards(queues.HUNTS)), 0)
 
+  def testMultiQueryAndOwn(self):
+    queue_names = [rdfvalue.RDFURN("fooMulti%d" % i) for i in range(3)]
+    manager = queue_manager.QueueManager(token=self.token)
+    with data_store.DB.GetMutationPool() as pool:
+      for queue in queue_names[:2]:
+        manager.Schedule([
+            rdf_flows.GrrMessage(
+                queue=queue, session_id="aff4:/Test", generate_task_id=True)
+            for _ in range(2)
+        ], pool)
+
+    tasks = manager.MultiQueryAndOwn(queue_names, lease_seconds=100, limit=5)
+
+    # Queues without any tasks are missing from the result.
+    self.assertItemsEqual(tasks, queue_names[:2])
+    for queue in queue_names[:2]:
+      self.assertEqual(len(tasks[queue]), 2)
+
+    # Leased tasks are not returned again, but the queues are not empty.
+    self._current_mock_time += 10
+    tasks = manager.MultiQueryAndOwn(queue_names, lease_seconds=100, limit=5)
+    self.assertEqual(tasks, {queue_names[0]: [], queue_names[1]: []})
+
+  def testEmptyQueueCacheForgetsQueuesWithNewTasks(self):
+    test_queue = rdfvalue.RDFURN("fooEmptyQueueCache")
+    cache = queue_manager.EmptyQueueCache()
+
+    generation = cache.Sync()
+    cache.MarkEmpty([test_queue], generation)
+    self.assertTrue(cache.IsEmpty(test_queue))
+
+    manager = queue_manager.QueueManager(token=self.token)
+    with data_store.DB.GetMutationPool() as pool:
+      manager.Schedule([
+          rdf_flows.GrrMessage(
+              queue=test_queue, session_id="aff4:/Test", generate_task_id=True)
+      ], pool)
+
+    # The change is only picked up once the sync interval has passed.
+    cache.Sync()
+    self.assertTrue(cache.IsEmpty(test_queue))
+
+    self._current_mock_time += 2
+    cache.Sync()
+    self.assertFalse(cache.IsEmpty(test_queue))
+
+  def testEmptyQueueCacheIgnoresQueuesReadBeforeSync(self):
+    test_queue = rdfvalue.RDFURN("fooEmptyQueueCache")
+    cache = queue_manager.EmptyQueueCache()
+
+    generation = cache.Sync()
+    self._current_mock_time += 2
+    cache.Sync()
+
+    # The queue might have changed since it was read, so it is not cached.
+    cache.MarkEmpty([test_queue], generation)
+    self.assertFalse(cache.IsEmpty(test_queue))
+
   def testGetClientIdFromQueue(self):
 
     def MockQueue(path):
@@ -492,6 +550,27 @@ class MultiShardedQueueManagerTest(QueueManagerTest):
 
     self.assertEqual(shard, queues.HUNTS.Add("1"))
 
+  def testShardIndicesRestrictNotificationShards(self):
+    manager = queue_manager.QueueManager(token=self.token)
+    for _ in range(5):
+      shard = manager.GetNotificationShard(queues.HUNTS, shard_indices=[1])
+      self.assertEqual(shard, queues.HUNTS.Add("1"))
+
+    manager.QueueNotification(
+        session_id=rdfvalue.SessionID(
+            base="aff4:/hunts", queue=queues.HUNTS, flow_name="42"))
+    manager.Flush()
+    manager.QueueNotification(
+        session_id=rdfvalue.SessionID(
+            base="aff4:/hunts", queue=queues.HUNTS, flow_name="43"))
+    manager.Flush()
+
+    # Each shard holds exactly one of the notifications.
+    for shard_index in range(manager.num_notification_shards):
+      by_priority = manager.GetNotificationsByPriority(
+          queues.HUNTS, shard_indices=[shard_index])
+      self.assertEqual(sum(len(n) for n in by_priority.values()), 1)
+
   def testNotificationsAreDeletedFromAllShards(self):
     manager = queue_manager.QueueManager(token=self.token)
     manager.QueueNotification(
@@ -545,6 +624,29 @@ class MultiShardedQueueManagerTest(QueueManagerTest):
     notifications = manager.GetNotificationsForAllShards(queues.HUNTS)
     self.assertEqual(len(notifications), 2)
 
+  def testMergeFrom(self):
+    session_id = rdfvalue.SessionID(flow_name="test")
+    batch = queue_manager.QueueManager(token=self.token)
+    batch.FreezeTimestamp()
+
+    for request_id in [2, 1]:
+      manager = queue_manager.QueueManager(token=self.token)
+      manager.QueueResponse(
+          rdf_flows.GrrMessage(session_id=session_id, request_id=request_id))
+      manager.QueueNotification(session_id=session_id, last_status=request_id)
+      manager.DeQueueClientRequest(test_lib.TEST_CLIENT_ID, request_id)
+      batch.MergeFrom(manager)
+
+    self.assertEqual(len(batch.response_queue), 2)
+    for _, timestamp in batch.response_queue:
+      self.assertEqual(timestamp, batch.frozen_timestamp)
+
+    # Both notifications are for the same session and timestamp.
+    self.assertEqual(len(batch.notifications), 1)
+    self.assertEqual(batch.notifications.values()[0].last_status, 2)
+
+    self.assertEqual(batch.client_messages_to_delete.values(), [[2, 1]])
+
   def testNotificationRequeueing(self):
     with test_lib.ConfigOverrider({"Worker.queue_shards": 1}):
       session_id = rdfvalue.SessionID(
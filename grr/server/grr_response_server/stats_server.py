@@ -15,6 +15,7 @@ from grr import config
 from grr.lib import registry
 from grr.lib import stats
 from grr.lib import utils
+from grr.server.grr_response_server import tracing
 
 
 def _JSONMetricValue(metric_info, value):
@@ -72,6 +73,12 @@ class StatsServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       self.end_headers()
 
       self.wfile.write(BuildVarzJsonString())
+    elif self.path == "/traces":
+      self.send_response(200)
+      self.send_header("Content-type", "application/json")
+      self.end_headers()
+
+      self.wfile.write(tracing.TRACER.ExportJSON())
     else:
       self.send_error(403, "Access forbidden: %s" % self.path)
 
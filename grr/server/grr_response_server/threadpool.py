@@ -22,6 +22,7 @@ Example usage:
 
 """
 
+import collections
 import itertools
 import logging
 import os
@@ -50,6 +51,128 @@ class Full(Error):
   """Raised when the threadpool is full."""
 
 
+class _TaskQueue(object):
+  """Per task class FIFO queues with weighted fair dequeueing.
+
+  This implements the part of the Queue.Queue interface the thread pool uses.
+  Every task class gets its own queue bounded by maxsize, so a flood of tasks
+  of one class can't push out the others. get() picks the class to serve by
+  smooth weighted round robin: while several classes have tasks pending, a
+  class with weight 3 gets three tasks dequeued for every task of a class
+  with weight 1.
+  """
+
+  # Stop messages are only handed out once all tasks have been.
+  STOP_CLASS = object()
+
+  def __init__(self, maxsize, weights=None):
+    self.maxsize = maxsize
+    self.weights = dict(weights or {})
+    self.queues = collections.OrderedDict()
+    self.credits = {}
+    self.unfinished_tasks = 0
+
+    self.mutex = threading.Lock()
+    self.not_empty = threading.Condition(self.mutex)
+    self.not_full = threading.Condition(self.mutex)
+    self.all_tasks_done = threading.Condition(self.mutex)
+
+  def _Size(self):
+    return sum(len(queue) for queue in self.queues.itervalues())
+
+  def qsize(self):
+    with self.mutex:
+      return self._Size()
+
+  def ClassSize(self, task_class):
+    with self.mutex:
+      return len(self.queues.get(task_class, ()))
+
+  def put(self, item, block=True, timeout=None, task_class=None):
+    """Queues item, raises Queue.Full if task_class has no room for it."""
+    if item == STOP_MESSAGE:
+      task_class = self.STOP_CLASS
+
+    with self.not_full:
+      queue = self.queues.get(task_class)
+      if queue is None:
+        queue = self.queues[task_class] = collections.deque()
+
+      if self.maxsize > 0 and task_class is not self.STOP_CLASS:
+        if not block:
+          if len(queue) >= self.maxsize:
+            raise Queue.Full()
+        elif timeout is None:
+          while len(queue) >= self.maxsize:
+            self.not_full.wait()
+        else:
+          deadline = time.time() + timeout
+          while len(queue) >= self.maxsize:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+              raise Queue.Full()
+            self.not_full.wait(remaining)
+
+      queue.append(item)
+      self.unfinished_tasks += 1
+      self.not_empty.notify()
+
+  def get(self, timeout=None):
+    """Removes and returns the next task, raises Queue.Empty on timeout."""
+    with self.not_empty:
+      if timeout is None:
+        while not self._Size():
+          self.not_empty.wait()
+      else:
+        deadline = time.time() + timeout
+        while not self._Size():
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            raise Queue.Empty()
+          self.not_empty.wait(remaining)
+
+      item = self._Next()
+      # Waiters can be waiting for different classes.
+      self.not_full.notify_all()
+      return item
+
+  def _Next(self):
+    """Picks the next task, must be called with the mutex held."""
+    total = 0
+    # None is the default task class, so it can't mean "nothing found" here.
+    best = self.STOP_CLASS
+    for task_class, queue in self.queues.iteritems():
+      if not queue or task_class is self.STOP_CLASS:
+        continue
+
+      weight = self.weights.get(task_class, 1)
+      total += weight
+      self.credits[task_class] = self.credits.get(task_class, 0) + weight
+      if (best is self.STOP_CLASS or
+          self.credits[task_class] > self.credits[best]):
+        best = task_class
+
+    if best is self.STOP_CLASS:
+      return self.queues[self.STOP_CLASS].popleft()
+
+    self.credits[best] -= total
+    return self.queues[best].popleft()
+
+  def task_done(self):
+    with self.all_tasks_done:
+      unfinished = self.unfinished_tasks - 1
+      if unfinished < 0:
+        raise ValueError("task_done() called too many times")
+      if unfinished == 0:
+        self.all_tasks_done.notify_all()
+      self.unfinished_tasks = unfinished
+
+  def join(self):
+    with self.all_tasks_done:
+      while self.unfinished_tasks:
+        self.all_tasks_done.wait()
+
+
 class _WorkerThread(threading.Thread):
   """The workers used in the ThreadPool class."""
 
@@ -59,7 +182,7 @@ class _WorkerThread(threading.Thread):
     This creates a new worker object for the ThreadPool class.
 
     Args:
-      queue: A Queue.Queue object that is used by the ThreadPool class to
+      queue: A _TaskQueue object that is used by the ThreadPool class to
           communicate with the workers. When a new task arrives, the ThreadPool
           notifies the workers by putting a message into this queue that has the
           format (target, args, name, queueing_time).
@@ -90,8 +213,9 @@ class _WorkerThread(threading.Thread):
   def ProcessTask(self, target, args, name, queueing_time):
     """Processes the tasks."""
 
+    time_in_queue = time.time() - queueing_time
+    self.pool.RecordQueueingTime(time_in_queue)
     if self.pool.name:
-      time_in_queue = time.time() - queueing_time
       stats.STATS.RecordEvent(self.pool.name + "_queueing_time", time_in_queue)
 
       start_time = time.time()
@@ -183,6 +307,12 @@ class ThreadPool(object):
   When threads are idle longer than 60 seconds they automatically exit. This
   ensures that our memory footprint is reduced when load is light.
 
+  Tasks can be given a task class. Each class is queued separately and the
+  threads serve the classes in proportion to their weights, so slow tasks of
+  one class can't starve the others. If max_queueing_time is set, the pool
+  also grows when tasks wait longer than that on average and the busy threads
+  are mostly blocked on I/O rather than using the CPU.
+
   Note that this class should not be instantiated directly, but the Factory
   should be used.
   """
@@ -190,8 +320,25 @@ class ThreadPool(object):
   POOLS = {}
   factory_lock = threading.Lock()
 
+  # Weight of the latest measurement in the moving average of queueing times.
+  QUEUEING_TIME_DECAY = 0.1
+
+  # Growing the pool because of long queueing times only helps if the busy
+  # threads spend at least this fraction of their time blocked, e.g. on I/O.
+  MIN_BLOCKED_FRACTION = 0.5
+
+  # The process CPU usage is measured over at least this many seconds. Back to
+  # back measurements only cover a few microseconds and are mostly noise.
+  CPU_SAMPLE_INTERVAL = 1.0
+
   @classmethod
-  def Factory(cls, name, min_threads, max_threads=None, cpu_check=True):
+  def Factory(cls,
+              name,
+              min_threads,
+              max_threads=None,
+              cpu_check=True,
+              task_class_weights=None,
+              max_queueing_time=None):
     """Creates a new thread pool with the given name.
 
     If the thread pool of this name already exist, we just return the existing
@@ -204,6 +351,9 @@ class ThreadPool(object):
       max_threads: The maximum number of threads to grow the pool to. If not set
         we do not grow the pool.
       cpu_check: If false, don't check CPU load when adding new threads.
+      task_class_weights: A dict of task class weights, see __init__.
+      max_queueing_time: Queueing time the pool tries to stay under, see
+        __init__.
 
     Returns:
       A threadpool instance.
@@ -212,11 +362,22 @@ class ThreadPool(object):
       result = cls.POOLS.get(name)
       if result is None:
         cls.POOLS[name] = result = cls(
-            name, min_threads, max_threads=max_threads, cpu_check=cpu_check)
+            name,
+            min_threads,
+            max_threads=max_threads,
+            cpu_check=cpu_check,
+            task_class_weights=task_class_weights,
+            max_queueing_time=max_queueing_time)
 
       return result
 
-  def __init__(self, name, min_threads, max_threads=None, cpu_check=True):
+  def __init__(self,
+               name,
+               min_threads,
+               max_threads=None,
+               cpu_check=True,
+               task_class_weights=None,
+               max_queueing_time=None):
     """This creates a new thread pool using min_threads workers.
 
     Args:
@@ -225,6 +386,11 @@ class ThreadPool(object):
       max_threads: The maximum number of threads to grow the pool to. If not set
         we do not grow the pool.
       cpu_check: If false, don't check CPU load when adding new threads.
+      task_class_weights: A dict mapping task classes to their relative share
+        of the threads while several classes have tasks queued. Classes not
+        listed have a weight of 1.
+      max_queueing_time: If set, the pool grows when tasks wait longer than
+        this many seconds on average, even if the queue isn't full.
 
 
     Raises:
@@ -239,10 +405,16 @@ class ThreadPool(object):
 
     self.max_threads = max_threads
     self.cpu_check = cpu_check
-    self._queue = Queue.Queue(maxsize=max_threads)
+    self._queue = _TaskQueue(max_threads, weights=task_class_weights)
+    self.max_queueing_time = max_queueing_time
+    # Moving average of the time tasks spend in the queue.
+    self.queueing_time = 0.0
     self.name = name
     self.started = False
     self.process = psutil.Process(os.getpid())
+    self.cpu_lock = threading.Lock()
+    self.cpu_usage = 0.0
+    self.cpu_sample_time = 0
 
     # A reference for all our workers. Keys are thread names, and values are the
     # _WorkerThread instance.
@@ -286,6 +458,10 @@ class ThreadPool(object):
   def __len__(self):
     return len(self._workers_ro_copy)
 
+  def FreeCapacity(self):
+    """Returns how many more tasks could be started without waiting."""
+    return max(0, self.max_threads - self.busy_threads - self.pending_tasks)
+
   @utils.Synchronized
   def Start(self):
     """This starts the worker threads."""
@@ -335,7 +511,8 @@ class ThreadPool(object):
               args,
               name="Unnamed task",
               blocking=True,
-              inline=True):
+              inline=True,
+              task_class=None):
     """Adds a task to be processed later.
 
     Args:
@@ -354,6 +531,9 @@ class ThreadPool(object):
         can generally block the calling thread even after the threadpool is
         available again and therefore decrease efficiency.
 
+      task_class: The class of this task. Each class has its own queue, see
+        task_class_weights in __init__.
+
     Raises:
       Full() if the pool is full and can not accept new jobs.
     """
@@ -369,22 +549,21 @@ class ThreadPool(object):
       while True:
         try:
           # Push the task on the queue but raise if unsuccessful.
-          self._queue.put((target, args, name, time.time()), block=False)
+          self._queue.put(
+              (target, args, name, time.time()),
+              block=False,
+              task_class=task_class)
+          if self._NeedsMoreThreads():
+            self._TryAddWorker()
           return
         except Queue.Full:
           # We increase the number of active threads if we do not exceed the
           # maximum _and_ our process CPU utilization is not too high. This
           # ensures that if the workers are waiting on IO we add more workers,
           # but we do not waste workers when tasks are CPU bound.
-          if len(self) < self.max_threads and self.CPUUsage() < 90:
-            try:
-              self._AddWorker()
-              continue
-
-            # If we fail to add a worker we should keep going anyway.
-            except (RuntimeError, threading.ThreadError):
-              logging.error("Threadpool exception: "
-                            "Could not spawn worker threads.")
+          if (len(self) < self.max_threads and self.CPUUsage() < 90 and
+              self._TryAddWorker()):
+            continue
 
           # If we need to process the task inline just break out of the loop,
           # therefore releasing the lock and run the task inline.
@@ -395,7 +574,10 @@ class ThreadPool(object):
           elif blocking:
             try:
               self._queue.put(
-                  (target, args, name, time.time()), block=True, timeout=1)
+                  (target, args, name, time.time()),
+                  block=True,
+                  timeout=1,
+                  task_class=task_class)
               return
             except Queue.Full:
               continue
@@ -407,13 +589,53 @@ class ThreadPool(object):
     if inline:
       target(*args)
 
+  def _TryAddWorker(self):
+    try:
+      self._AddWorker()
+      return True
+
+    # If we fail to add a worker we should keep going anyway.
+    except (RuntimeError, threading.ThreadError):
+      logging.error("Threadpool exception: Could not spawn worker threads.")
+      return False
+
+  def _NeedsMoreThreads(self):
+    """Returns True if tasks wait too long for threads blocked on I/O."""
+    if not self.max_queueing_time or len(self) >= self.max_threads:
+      return False
+
+    if self.queueing_time < self.max_queueing_time:
+      return False
+
+    # If the busy threads are using the CPU, more threads would just fight
+    # over the GIL.
+    return self.BlockedFraction() >= self.MIN_BLOCKED_FRACTION
+
+  def RecordQueueingTime(self, queueing_time):
+    """Updates the moving average of task queueing times."""
+    self.queueing_time += self.QUEUEING_TIME_DECAY * (
+        queueing_time - self.queueing_time)
+
+  def BlockedFraction(self):
+    """Estimates the fraction of time the busy threads are not on the CPU."""
+    busy_threads = self.busy_threads
+    if not busy_threads:
+      return 1.0
+    return max(0.0, 1.0 - self.CPUUsage() / (100.0 * busy_threads))
+
   def CPUUsage(self):
-    if self.cpu_check:
-      # Do not block this call.
-      return self.process.cpu_percent(0)
-    else:
+    """Returns the CPU usage of this process, sampled at most once a second."""
+    if not self.cpu_check:
       return 0
 
+    with self.cpu_lock:
+      now = time.time()
+      if now - self.cpu_sample_time >= self.CPU_SAMPLE_INTERVAL:
+        # Do not block this call, this measures the usage since the last one.
+        self.cpu_usage = self.process.cpu_percent(0)
+        self.cpu_sample_time = now
+      return self.cpu_usage
+
   def Join(self):
     """Waits until all outstanding tasks are completed."""
     self._queue.join()
@@ -428,8 +650,9 @@ class MockThreadPool(object):
     _ = max_threads
     self.ignore_errors = ignore_errors
 
-  def AddTask(self, target, args, name="Unnamed task"):
+  def AddTask(self, target, args, name="Unnamed task", task_class=None):
     _ = name
+    _ = task_class
     try:
       target(*args)
       # The real threadpool can not raise from a task. We emulate this here.
@@ -7,6 +7,8 @@ import threading
 import time
 
 
+import mock
+
 from grr.lib import flags
 from grr.lib import stats
 from grr.lib import utils
@@ -304,6 +306,135 @@ class ThreadPoolTest(test_lib.GRRBaseTest):
     self.assertEqual(pool.started, True)
     pool.Stop()
 
+  def testTaskClassesAreQueuedSeparately(self):
+    pool = threadpool.ThreadPool.Factory("pool-task-classes", 2)
+    # Do not start the pool so all tasks stay in the queue.
+    with utils.Stubber(pool, "CPUUsage", lambda: 100):
+      for _ in range(2):
+        pool.AddTask(
+            lambda: None, (), task_class="slow", inline=False, blocking=False)
+
+      self.assertRaises(
+          threadpool.Full,
+          pool.AddTask,
+          lambda: None, (),
+          task_class="slow",
+          inline=False,
+          blocking=False)
+
+      # Another class still has room.
+      pool.AddTask(
+          lambda: None, (), task_class="fast", inline=False, blocking=False)
+      self.assertEqual(pool.pending_tasks, 3)
+
+  def testPoolGrowsWhenTasksWaitTooLong(self):
+    pool = threadpool.ThreadPool.Factory(
+        "pool-queueing-time", 1, max_threads=5, max_queueing_time=1)
+    with utils.Stubber(pool, "CPUUsage", lambda: 0):
+      pool.AddTask(lambda: None, ())
+      self.assertEqual(len(pool), 0)
+
+      pool.RecordQueueingTime(100)
+      self.assertGreater(pool.queueing_time, 1)
+      pool.AddTask(lambda: None, ())
+      self.assertEqual(len(pool), 1)
+
+    # Threads which are busy on the CPU don't get company.
+    pool.RecordQueueingTime(100)
+    with utils.Stubber(pool, "BlockedFraction", lambda: 0.1):
+      pool.AddTask(lambda: None, ())
+      self.assertEqual(len(pool), 1)
+
+    pool.Start()
+    pool.Stop()
+
+  def testFreeCapacity(self):
+    pool = threadpool.ThreadPool.Factory(
+        "pool-free-capacity", 1, max_threads=5)
+    pool._workers_ro_copy = {"a": mock.Mock(idle=False),
+                             "b": mock.Mock(idle=True)}
+    self.assertEqual(pool.FreeCapacity(), 4)
+
+    # Do not start the pool so the task stays in the queue.
+    with utils.Stubber(pool, "CPUUsage", lambda: 100):
+      pool.AddTask(lambda: None, (), inline=False, blocking=False)
+    self.assertEqual(pool.FreeCapacity(), 3)
+
+  def testCPUUsageIsSampledPeriodically(self):
+    # An anonymous pool does not export its CPU usage, so the mock is only
+    # called by this test.
+    pool = threadpool.ThreadPool.Factory(None, 1)
+    pool.process = mock.Mock()
+    pool.process.cpu_percent.side_effect = [30.0, 60.0]
+
+    with test_lib.FakeTime(1000):
+      self.assertEqual(pool.CPUUsage(), 30.0)
+    with test_lib.FakeTime(1000.5):
+      self.assertEqual(pool.CPUUsage(), 30.0)
+    with test_lib.FakeTime(1001):
+      self.assertEqual(pool.CPUUsage(), 60.0)
+    self.assertEqual(pool.process.cpu_percent.call_count, 2)
+
+  def testBlockedFraction(self):
+    pool = threadpool.ThreadPool.Factory("pool-blocked-fraction", 1)
+    pool._workers_ro_copy = {"a": mock.Mock(idle=False),
+                             "b": mock.Mock(idle=False),
+                             "c": mock.Mock(idle=True)}
+
+    with utils.Stubber(pool, "CPUUsage", lambda: 50):
+      self.assertEqual(pool.BlockedFraction(), 0.75)
+    with utils.Stubber(pool, "CPUUsage", lambda: 100):
+      self.assertEqual(pool.BlockedFraction(), 0.5)
+
+
+class TaskQueueTest(test_lib.GRRBaseTest):
+  """Tests for the per task class queue."""
+
+  def testWeightedFairDequeueing(self):
+    queue = threadpool._TaskQueue(100, weights={"flow": 3})
+    for i in range(6):
+      queue.put(("flow", i), task_class="flow")
+      queue.put(("hunt", i), task_class="hunt")
+
+    order = [queue.get(timeout=0)[0] for _ in range(8)]
+    self.assertEqual(order.count("flow"), 6)
+    self.assertEqual(order.count("hunt"), 2)
+
+    # Classes keep their FIFO order.
+    self.assertEqual(queue.get(timeout=0), ("hunt", 2))
+
+  def testEmptyClassesDoNotHoldUpOthers(self):
+    queue = threadpool._TaskQueue(100, weights={"flow": 3})
+    for i in range(3):
+      queue.put(("hunt", i), task_class="hunt")
+
+    self.assertEqual([queue.get(timeout=0) for _ in range(3)],
+                     [("hunt", 0), ("hunt", 1), ("hunt", 2)])
+    self.assertRaises(Queue.Empty, queue.get, timeout=0)
+
+  def testStopMessagesComeLast(self):
+    queue = threadpool._TaskQueue(1)
+    queue.put(threadpool.STOP_MESSAGE)
+    queue.put(threadpool.STOP_MESSAGE)
+    queue.put("task", task_class="flow")
+
+    self.assertEqual(queue.get(timeout=0), "task")
+    self.assertEqual(queue.get(timeout=0), threadpool.STOP_MESSAGE)
+
+  def testJoinWaitsForTaskDone(self):
+    queue = threadpool._TaskQueue(10)
+    queue.put("task")
+    self.assertEqual(queue.get(timeout=0), "task")
+
+    joined = threading.Event()
+    joiner = threading.Thread(target=lambda: (queue.join(), joined.set()))
+    joiner.start()
+    self.assertFalse(joined.wait(0.1))
+
+    queue.task_done()
+    joiner.join()
+    self.assertTrue(joined.is_set())
+
 
 class DummyConverter(threadpool.BatchConverter):
 
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""Lightweight tracing of flow processing.
+
+A trace follows a single flow through the frontend, the queue manager, the
+worker and the flow runner. Every span records its start and end time and
+belongs to the trace of a session id. Spans started while another span of the
+same trace is open in the same thread are recorded as its children. Spans of the
+same trace recorded by different processes are tied together by the
+session_id and request_id they are tagged with.
+
+Only a configurable fraction of all flows is traced. The decision is made
+from the session id alone, so all processes trace the same flows. Finished
+spans are kept in a ring buffer in each process and can be fetched as JSON
+from the stats server.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+import zlib
+
+
+from grr import config
+from grr.lib import registry
+from grr.lib import utils
+
+
+class Span(object):
+  """A timed operation on a single flow."""
+
+  def __init__(self, name, trace_id, span_id, parent_id=None,
+               attributes=None):
+    self.name = name
+    self.trace_id = trace_id
+    self.span_id = span_id
+    self.parent_id = parent_id
+    self.attributes = attributes or {}
+    self.start_time = time.time()
+    self.end_time = None
+    # The open spans of the thread which started this span, see Tracer.
+    self.open_spans = None
+
+  @property
+  def duration(self):
+    if self.end_time is None:
+      return None
+    return self.end_time - self.start_time
+
+  def ToDict(self):
+    return dict(
+        name=self.name,
+        trace_id=self.trace_id,
+        span_id=self.span_id,
+        parent_id=self.parent_id,
+        start_time=self.start_time,
+        end_time=self.end_time,
+        attributes=self.attributes)
+
+
+class Tracer(object):
+  """Records spans for a sampled subset of all flows."""
+
+  def __init__(self, sample_rate=0.0, max_spans=10000):
+    """Constructor.
+
+    Args:
+      sample_rate: The fraction of flows to trace, between 0 and 1.
+      max_spans: The number of finished spans to keep, older ones are dropped.
+    """
+    self.sample_rate = sample_rate
+    self.enabled = sample_rate > 0
+    self.lock = threading.Lock()
+    self.spans = collections.deque(maxlen=max_spans)
+    # Every thread maps trace ids to the list of spans of the trace it
+    # currently has open, so concurrent operations on the same flow don't
+    # become each other's children.
+    self.local = threading.local()
+    self.span_prefix = "%x.%x." % (os.getpid(), id(self))
+    self.span_counter = 0
+
+  def _OpenSpans(self):
+    """Returns the open spans of the calling thread by trace id."""
+    try:
+      return self.local.open_spans
+    except AttributeError:
+      self.local.open_spans = {}
+      return self.local.open_spans
+
+  def IsSampled(self, trace_id):
+    """Returns True if the flow with the given session id is traced."""
+    if not self.enabled:
+      return False
+    bucket = zlib.crc32(utils.SmartStr(trace_id)) & 0xffffffff
+    return bucket < self.sample_rate * 0x100000000
+
+  def StartSpan(self, name, trace_id, **attributes):
+    """Starts a span, unless the trace is not sampled.
+
+    Args:
+      name: The name of the traced operation.
+      trace_id: The session id of the flow the operation works on.
+      **attributes: Additional values to record, e.g. the request_id.
+
+    Returns:
+      The started Span, which has to be passed to EndSpan(), or None if the
+      trace is not sampled.
+    """
+    if not self.IsSampled(trace_id):
+      return None
+
+    trace_id = utils.SmartUnicode(trace_id)
+    open_spans = self._OpenSpans()
+    with self.lock:
+      self.span_counter += 1
+      span_id = "%s%x" % (self.span_prefix, self.span_counter)
+      trace_spans = open_spans.setdefault(trace_id, [])
+      parent_id = trace_spans[-1].span_id if trace_spans else None
+      span = Span(name, trace_id, span_id, parent_id=parent_id,
+                  attributes=attributes)
+      span.open_spans = open_spans
+      trace_spans.append(span)
+
+    return span
+
+  def EndSpan(self, span):
+    """Finishes a span returned by StartSpan()."""
+    if span is None:
+      return
+
+    span.end_time = time.time()
+    with self.lock:
+      # The span might be ended by another thread than the one it was
+      # started in.
+      trace_spans = span.open_spans.get(span.trace_id, [])
+      if span in trace_spans:
+        trace_spans.remove(span)
+      if not trace_spans:
+        span.open_spans.pop(span.trace_id, None)
+      span.open_spans = None
+      self.spans.append(span)
+
+  @contextlib.contextmanager
+  def Span(self, name, trace_id, **attributes):
+    """A context manager recording a span around its body."""
+    span = self.StartSpan(name, trace_id, **attributes)
+    try:
+      yield span
+    finally:
+      self.EndSpan(span)
+
+  @contextlib.contextmanager
+  def Spans(self, name, attributes_by_trace_id):
+    """Like Span(), for an operation working on many flows at once.
+
+    Args:
+      name: The name of the traced operation.
+      attributes_by_trace_id: A dict mapping the session ids of the flows to
+        the attributes to record for them.
+
+    Yields:
+      The list of spans started for the sampled flows.
+    """
+    spans = []
+    try:
+      for trace_id, attributes in attributes_by_trace_id.iteritems():
+        span = self.StartSpan(name, trace_id, **attributes)
+        if span is not None:
+          spans.append(span)
+      yield spans
+    finally:
+      for span in spans:
+        self.EndSpan(span)
+
+  def GetSpans(self, trace_id=None):
+    """Returns the finished spans, optionally only those of one trace."""
+    with self.lock:
+      spans = list(self.spans)
+
+    if trace_id is not None:
+      trace_id = utils.SmartUnicode(trace_id)
+      spans = [span for span in spans if span.trace_id == trace_id]
+    return spans
+
+  def ExportJSON(self, trace_id=None):
+    """Returns the finished spans as a JSON list."""
+    return json.dumps([span.ToDict() for span in self.GetSpans(trace_id)])
+
+
+# The tracer for this process, traces nothing until TracingInit has run.
+TRACER = Tracer()
+
+
+class TracingInit(registry.InitHook):
+  """Creates the tracer from the configuration."""
+
+  def RunOnce(self):
+    global TRACER  # pylint: disable=global-statement
+
+    TRACER = Tracer(
+        sample_rate=config.CONFIG["Tracing.sample_rate"],
+        max_spans=config.CONFIG["Tracing.max_spans"])
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""Tests for flow processing traces."""
+
+import json
+import threading
+
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import utils
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.server.grr_response_server import tracing
+from grr.server.grr_response_server import worker
+from grr.test_lib import flow_test_lib
+from grr.test_lib import front_end_test_lib
+from grr.test_lib import test_lib
+
+
+class TracerTest(test_lib.GRRBaseTest):
+
+  def testNothingIsTracedWithoutSampleRate(self):
+    tracer = tracing.Tracer()
+
+    with tracer.Span("Operation", "aff4:/F:1234") as span:
+      self.assertIsNone(span)
+
+    self.assertEqual(tracer.GetSpans(), [])
+
+  def testSamplingOnlyDependsOnTheSessionId(self):
+    session_ids = ["aff4:/C.%016X/flows/F:%X" % (i, i) for i in range(100)]
+    sampled = [tracing.Tracer(sample_rate=0.5).IsSampled(s) for s in session_ids]
+
+    self.assertEqual(
+        sampled, [tracing.Tracer(sample_rate=0.5).IsSampled(s)
+                  for s in session_ids])
+    self.assertTrue(any(sampled))
+    self.assertFalse(all(sampled))
+
+  def testSpansOfTheSameTraceAreNested(self):
+    tracer = tracing.Tracer(sample_rate=1)
+
+    with tracer.Span("Outer", "aff4:/F:1", request_id=1) as outer:
+      with tracer.Span("Inner", "aff4:/F:1") as inner:
+        pass
+      with tracer.Span("Other", "aff4:/F:2") as other:
+        pass
+
+    self.assertIsNone(outer.parent_id)
+    self.assertEqual(inner.parent_id, outer.span_id)
+    self.assertIsNone(other.parent_id)
+    self.assertEqual(outer.attributes, {"request_id": 1})
+    self.assertGreaterEqual(outer.duration, inner.duration)
+
+    self.assertEqual([s.name for s in tracer.GetSpans()],
+                     ["Inner", "Other", "Outer"])
+    self.assertEqual([s.name for s in tracer.GetSpans("aff4:/F:2")], ["Other"])
+
+  def testSpansAreOnlyNestedWithinTheirThread(self):
+    tracer = tracing.Tracer(sample_rate=1)
+    spans = {}
+
+    def Process():
+      with tracer.Span("Other thread", "aff4:/F:1") as span:
+        spans["other"] = span
+
+    with tracer.Span("Outer", "aff4:/F:1") as outer:
+      thread = threading.Thread(target=Process)
+      thread.start()
+      thread.join()
+
+      with tracer.Span("Inner", "aff4:/F:1") as inner:
+        pass
+
+    self.assertIsNone(spans["other"].parent_id)
+    self.assertEqual(inner.parent_id, outer.span_id)
+
+  def testSpansCanBeEndedInAnotherThread(self):
+    tracer = tracing.Tracer(sample_rate=1)
+
+    span = tracer.StartSpan("Handed over", "aff4:/F:1")
+    thread = threading.Thread(target=tracer.EndSpan, args=(span,))
+    thread.start()
+    thread.join()
+
+    with tracer.Span("Next", "aff4:/F:1") as next_span:
+      pass
+    self.assertIsNone(next_span.parent_id)
+
+  def testSpansForManyTraces(self):
+    tracer = tracing.Tracer(sample_rate=1)
+
+    with tracer.Spans("Write", {"aff4:/F:1": {}, "aff4:/F:2": {"a": 1}}):
+      pass
+
+    self.assertEqual(len(tracer.GetSpans("aff4:/F:1")), 1)
+    self.assertEqual(tracer.GetSpans("aff4:/F:2")[0].attributes, {"a": 1})
+
+  def testOnlyTheNewestSpansAreKept(self):
+    tracer = tracing.Tracer(sample_rate=1, max_spans=2)
+
+    for name in ["First", "Second", "Third"]:
+      with tracer.Span(name, "aff4:/F:1"):
+        pass
+
+    self.assertEqual([s.name for s in tracer.GetSpans()], ["Second", "Third"])
+
+  def testExportJSON(self):
+    tracer = tracing.Tracer(sample_rate=1)
+    with tracer.Span("Operation", rdfvalue.RDFURN("aff4:/F:1"), request_id=3):
+      pass
+
+    spans = json.loads(tracer.ExportJSON())
+
+    self.assertEqual(len(spans), 1)
+    self.assertEqual(spans[0]["name"], "Operation")
+    self.assertEqual(spans[0]["trace_id"], "aff4:/F:1")
+    self.assertEqual(spans[0]["attributes"], {"request_id": 3})
+    self.assertLessEqual(spans[0]["start_time"], spans[0]["end_time"])
+
+
+class FlowTracingTest(front_end_test_lib.FrontEndServerTest):
+
+  def testFlowProcessingIsTraced(self):
+    client_id = self.SetupClient(0)
+    tracer = tracing.Tracer(sample_rate=1)
+
+    # A single notification shard, so that the worker finds the flow.
+    with test_lib.ConfigOverrider({"Worker.queue_shards": 1}):
+      with utils.Stubber(tracing, "TRACER", tracer):
+        flow_obj = self.FlowSetup(
+            flow_test_lib.FlowOrderTest.__name__, client_id=client_id)
+        session_id = flow_obj.session_id
+        flow_obj.Close()
+
+        self.server.ReceiveMessages(client_id, [
+            rdf_flows.GrrMessage(
+                request_id=1,
+                response_id=1,
+                session_id=session_id,
+                payload=rdfvalue.RDFInteger(1)),
+            rdf_flows.GrrMessage(
+                request_id=1,
+                response_id=2,
+                session_id=session_id,
+                payload=rdf_flows.GrrStatus(),
+                type=rdf_flows.GrrMessage.Type.STATUS)
+        ])
+
+        worker_obj = worker.GRRWorker(token=self.token)
+        worker_obj.RunOnce()
+        worker_obj.thread_pool.Join()
+
+    spans = dict((s.name, s) for s in tracer.GetSpans(session_id)
+                 if s.name != "QueueManager.Flush")
+    frontend_span = spans["FrontEndServer.ReceiveMessages"]
+    self.assertEqual(frontend_span.attributes["request_ids"], [1])
+    self.assertEqual(frontend_span.attributes["client_id"], client_id)
+
+    # Writing the messages to the queues is part of receiving them.
+    self.assertIn(frontend_span.span_id, [
+        s.parent_id for s in tracer.GetSpans(session_id)
+        if s.name == "QueueManager.Flush"
+    ])
+
+    state_span = spans["FlowRunner.RunStateMethod"]
+    self.assertEqual(state_span.attributes["state"], "Incoming")
+    self.assertEqual(state_span.attributes["request_id"], 1)
+    self.assertEqual(state_span.parent_id,
+                     spans["GRRWorker.ProcessMessages"].span_id)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
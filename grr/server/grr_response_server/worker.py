@@ -15,13 +15,16 @@ from grr.lib import stats
 from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.server.grr_response_server import aff4
+from grr.server.grr_response_server import data_store
 from grr.server.grr_response_server import flow
 from grr.server.grr_response_server import master
+from grr.server.grr_response_server import notification_bus
 from grr.server.grr_response_server import queue_manager as queue_manager_lib
 # pylint: disable=unused-import
 from grr.server.grr_response_server import server_stubs
 # pylint: enable=unused-import
 from grr.server.grr_response_server import threadpool
+from grr.server.grr_response_server import tracing
 
 
 class Error(Exception):
@@ -52,11 +55,26 @@ class GRRWorker(object):
   # Duration of a well known flow lease time in seconds.
   well_known_flow_lease_time = 600
 
+  # Shares of the thread pool each task class gets while several classes have
+  # tasks queued. Flow steps are usually short and often interactive, so long
+  # running hunts must not starve them.
+  TASK_CLASS_WEIGHTS = {
+      flow.WELL_KNOWN_FLOW_TASK: 4,
+      flow.FLOW_TASK: 4,
+      flow.HUNT_TASK: 1,
+      flow.HUNT_REQUEST_TASK: 2,
+  }
+
+  # Maximum number of responses prefetched for a batch of flows. Responses of
+  # requests beyond this are read by each flow on its own.
+  PREFETCH_RESPONSES_LIMIT = 10000
+
   def __init__(self,
                queues=queues_config.WORKER_LIST,
                threadpool_prefix="grr_threadpool",
                threadpool_size=None,
-               token=None):
+               token=None,
+               queue_shards=None):
     """Constructor.
 
     Args:
@@ -64,12 +82,18 @@ class GRRWorker(object):
       threadpool_prefix: A name for the thread pool used by this worker.
       threadpool_size: The number of workers to start in this thread pool.
       token: The token to use for the worker.
+      queue_shards: Optional list of notification shard indices this worker
+        owns. If given, notifications are only read from these shards,
+        otherwise all shards are polled in turn.
 
     Raises:
       RuntimeError: If the token is not provided.
     """
     logging.info("started worker with queues: " + str(queues))
     self.queues = queues
+    self.queue_shards = queue_shards
+    if queue_shards:
+      logging.info("Worker owns notification shards %s", queue_shards)
 
     # self.queued_flows is a timed cache of locked flows. If this worker
     # encounters a lock failure on a flow, it will not attempt to grab this flow
@@ -85,26 +109,42 @@ class GRRWorker(object):
         threadpool_size = config.CONFIG["Threadpool.size"]
 
       self.__class__.thread_pool = threadpool.ThreadPool.Factory(
-          threadpool_prefix, min_threads=2, max_threads=threadpool_size)
+          threadpool_prefix,
+          min_threads=2,
+          max_threads=threadpool_size,
+          task_class_weights=self.TASK_CLASS_WEIGHTS,
+          max_queueing_time=config.CONFIG["Threadpool.max_queueing_time"])
 
       self.__class__.thread_pool.Start()
 
     self.token = token
     self.last_active = 0
+    self.flow_batch_size = config.CONFIG["Worker.flow_batch_size"]
 
     # Well known flows are just instantiated.
     self.well_known_flows = flow.WellKnownFlow.GetAllWellKnownFlows(token=token)
 
   def Run(self):
     """Event loop."""
+    # Without a notification bus this subscription just sleeps, so we
+    # effectively poll.
+    subscription = (notification_bus.BUS or
+                    notification_bus.NotificationBus()).Subscribe(
+                        self.queues, shard_indices=self.queue_shards)
+    # Shards we were woken up for, they are scanned one after the other
+    # before going back to scanning our shards in turn.
+    woken_shards = []
     try:
       while 1:
+        shard_indices = [woken_shards.pop(0)] if woken_shards else None
         if master.MASTER_WATCHER.IsMaster():
-          processed = self.RunOnce()
+          processed = self.RunOnce(shard_indices=shard_indices)
         else:
           processed = 0
 
-        if processed == 0:
+        if processed:
+          self.last_active = time.time()
+        elif not woken_shards:
           logger = logging.getLogger()
           for h in logger.handlers:
             h.flush()
@@ -114,20 +154,24 @@ class GRRWorker(object):
           else:
             interval = self.SHORT_POLLING_INTERVAL
 
-          time.sleep(interval)
-        else:
-          self.last_active = time.time()
+          woken_shards = subscription.Wait(interval)
 
     except KeyboardInterrupt:
       logging.info("Caught interrupt, exiting.")
       self.__class__.thread_pool.Join()
+    finally:
+      subscription.Close()
 
-  def RunOnce(self):
+  def RunOnce(self, shard_indices=None):
     """Processes one set of messages from Task Scheduler.
 
     The worker processes new jobs from the task master. For each job
     we retrieve the session from the Task Scheduler.
 
+    Args:
+      shard_indices: The notification shards to choose from, defaults to the
+        shards this worker owns.
+
     Returns:
         Total number of messages processed by this call.
     """
@@ -142,7 +186,7 @@ class GRRWorker(object):
 
       fetch_messages_start = time.time()
       notifications_by_priority = queue_manager.GetNotificationsByPriority(
-          queue)
+          queue, shard_indices=shard_indices or self.queue_shards)
       stats.STATS.RecordEvent("worker_time_to_retrieve_notifications",
                               time.time() - fetch_messages_start)
 
@@ -227,6 +271,7 @@ class GRRWorker(object):
     """
     now = time.time()
     processed = 0
+    batch = []
     for notification in active_notifications:
       if notification.session_id not in self.queued_flows:
         if time_limit and time.time() - now > time_limit:
@@ -234,14 +279,151 @@ class GRRWorker(object):
 
         processed += 1
         self.queued_flows.Put(notification.session_id, 1)
+
+        # Well known flows are created rather than opened and don't keep
+        # their requests under the lock, so they are not batched.
+        if (self.flow_batch_size > 1 and
+            notification.session_id.FlowName() not in self.well_known_flows):
+          batch.append(notification)
+          if len(batch) >= self.flow_batch_size:
+            self._ProcessFlowBatch(batch, queue_manager)
+            batch = []
+          continue
+
         self.__class__.thread_pool.AddTask(
             target=self._ProcessMessages,
             args=(notification, queue_manager.Copy()),
-            name=self.__class__.__name__)
+            name=self.__class__.__name__,
+            task_class=self._TaskClass(notification))
+
+    if batch:
+      self._ProcessFlowBatch(batch, queue_manager)
 
     return processed
 
-  def _ProcessRegularFlowMessages(self, flow_obj, notification):
+  def _ProcessFlowBatch(self, notifications, queue_manager):
+    """Locks batches of flows at once and hands them to the thread pool.
+
+    Locked flows can't be processed by other workers until a thread of this
+    one gets to them, so the flows are locked in chunks no larger than the
+    number of tasks the thread pool can start right away.
+
+    Args:
+      notifications: A list of notifications for regular flows.
+      queue_manager: QueueManager object used to manage notifications,
+                     requests and responses.
+    """
+    notifications = list(notifications)
+    while notifications:
+      capacity = self.__class__.thread_pool.FreeCapacity()
+      if not capacity:
+        # The pool is full, the flow is only locked once a thread picks it up.
+        notification = notifications.pop(0)
+        self.__class__.thread_pool.AddTask(
+            target=self._ProcessMessages,
+            args=(notification, queue_manager.Copy()),
+            name=self.__class__.__name__,
+            task_class=self._TaskClass(notification))
+        continue
+
+      self._ProcessFlowChunk(notifications[:capacity], queue_manager)
+      notifications = notifications[capacity:]
+
+  def _ProcessFlowChunk(self, notifications, queue_manager):
+    """Locks a chunk of flows at once and hands them to the thread pool.
+
+    The flows are locked and opened with a single data store operation and
+    their completed requests and responses are read with another one, so the
+    per flow round trips of _ProcessMessages are avoided.
+
+    Args:
+      notifications: A list of notifications for regular flows.
+      queue_manager: QueueManager object used to manage notifications,
+                     requests and responses.
+    """
+    by_session_id = dict((n.session_id, n) for n in notifications)
+
+    flow_objs = {}
+    for flow_obj in aff4.FACTORY.MultiOpenWithLock(
+        by_session_id, lease_time=self.flow_lease_time, token=self.token):
+      flow_objs[flow_obj.urn] = flow_obj
+
+    # Flows that could not be locked or opened go through the regular path,
+    # which accounts for lock errors and cleans up broken flows.
+    for session_id, notification in by_session_id.iteritems():
+      if session_id not in flow_objs:
+        self.__class__.thread_pool.AddTask(
+            target=self._ProcessMessages,
+            args=(notification, queue_manager.Copy()),
+            name=self.__class__.__name__,
+            task_class=self._TaskClass(notification))
+
+    if not flow_objs:
+      return
+
+    prefetched = self._PrefetchCompletedRequests(
+        [by_session_id[session_id] for session_id in flow_objs])
+
+    for session_id, flow_obj in flow_objs.iteritems():
+      self.__class__.thread_pool.AddTask(
+          target=self._ProcessMessages,
+          args=(by_session_id[session_id], queue_manager.Copy(), flow_obj,
+                prefetched[session_id]),
+          name=self.__class__.__name__,
+          task_class=self._TaskClass(by_session_id[session_id]))
+
+  def _TaskClass(self, notification):
+    """Returns the thread pool task class for processing a notification."""
+    session_id = notification.session_id
+    if session_id.FlowName() in self.well_known_flows:
+      return flow.WELL_KNOWN_FLOW_TASK
+    if session_id.Queue() == queues_config.HUNTS:
+      return flow.HUNT_TASK
+    return flow.FLOW_TASK
+
+  def _PrefetchCompletedRequests(self, notifications):
+    """Reads completed requests and their responses for many flows at once.
+
+    Args:
+      notifications: The notifications of the flows to read.
+
+    Returns:
+      A dict mapping session ids to (completed_requests, responses) tuples as
+      QueueManager.UsePrefetchedRequests expects them.
+    """
+    timestamps = dict(
+        (n.session_id, (0, n.timestamp)) for n in notifications)
+    completed = data_store.DB.MultiReadCompletedRequests(
+        timestamps.keys(), timestamps)
+
+    # Status messages tell us how many responses each request has, so we can
+    # stay within the budget without reading anything. Once a request does not
+    # fit, no responses of any later flow are read either.
+    request_list = []
+    total_responses = 0
+    budget_left = True
+    for completed_requests in completed.itervalues():
+      for request, status in completed_requests:
+        if total_responses + status.response_id > self.PREFETCH_RESPONSES_LIMIT:
+          budget_left = False
+          break
+        total_responses += status.response_id
+        request_list.append(request)
+
+      if not budget_left:
+        break
+
+    responses = dict((session_id, {}) for session_id in completed)
+    if request_list:
+      for request, request_responses in data_store.DB.ReadResponses(
+          request_list):
+        responses[request.session_id][request.id] = request_responses
+
+    return dict((session_id, (completed[session_id], responses[session_id]))
+                for session_id in completed)
+
+  def _ProcessRegularFlowMessages(self, flow_obj, notification,
+                                  prefetched=None):
     """Processes messages for a given flow."""
     session_id = notification.session_id
     if not isinstance(flow_obj, flow.FlowBase):
@@ -253,6 +435,11 @@ class GRRWorker(object):
       raise FlowProcessingError("Not a GRRFlow.")
 
     runner = flow_obj.GetRunner()
+    if prefetched is not None:
+      completed_requests, responses = prefetched
+      runner.queue_manager.UsePrefetchedRequests(
+          session_id, (0, notification.timestamp), completed_requests,
+          responses)
     try:
       runner.ProcessCompletedRequests(notification, self.__class__.thread_pool)
     except Exception as e:  # pylint: disable=broad-except
@@ -262,15 +449,32 @@ class GRRWorker(object):
       logging.error("Flow %s: %s", flow_obj, e)
       raise FlowProcessingError(e)
 
-  def _ProcessMessages(self, notification, queue_manager):
-    """Does the real work with a single flow."""
-    flow_obj = None
+  def _ProcessMessages(self,
+                       notification,
+                       queue_manager,
+                       flow_obj=None,
+                       prefetched=None):
+    """Does the real work with a single flow.
+
+    Args:
+      notification: The notification for the flow.
+      queue_manager: QueueManager object used to manage notifications,
+                     requests and responses.
+      flow_obj: The flow, if it was opened and locked by _ProcessFlowChunk
+                already.
+      prefetched: A (completed_requests, responses) tuple read ahead by
+                  _ProcessFlowChunk.
+    """
     session_id = notification.session_id
+    span = tracing.TRACER.StartSpan("GRRWorker.ProcessMessages", session_id)
 
     try:
       # Take a lease on the flow:
       flow_name = session_id.FlowName()
-      if flow_name in self.well_known_flows:
+      if flow_obj is not None:
+        # Already locked by _ProcessFlowChunk.
+        pass
+      elif flow_name in self.well_known_flows:
         # Well known flows are not necessarily present in the data store so
         # we need to create them instead of opening.
         expected_flow = self.well_known_flows[flow_name].__class__
@@ -311,7 +515,8 @@ class GRRWorker(object):
 
       else:
         with flow_obj:
-          self._ProcessRegularFlowMessages(flow_obj, notification)
+          self._ProcessRegularFlowMessages(
+              flow_obj, notification, prefetched=prefetched)
 
       elapsed = time.time() - now
       logging.debug("Done processing %s: %s sec", session_id, elapsed)
@@ -344,6 +549,155 @@ class GRRWorker(object):
           "worker_session_errors", fields=[str(type(e))])
       queue_manager.DeleteNotification(session_id)
 
+    finally:
+      tracing.TRACER.EndSpan(span)
+
+
+def AssignShards(num_shards, num_processes):
+  """Distributes notification shard indices over worker processes.
+
+  Args:
+    num_shards: The number of notification shards per queue.
+    num_processes: The number of worker processes.
+
+  Returns:
+    A list with one list of shard indices per process. There are never more
+    processes than shards, so no process ends up without work.
+  """
+  num_processes = max(1, min(num_processes, num_shards))
+  assignment = [[] for _ in range(num_processes)]
+  for shard in range(num_shards):
+    assignment[shard % num_processes].append(shard)
+  return assignment
+
+
+class GRRWorkerSupervisor(object):
+  """Runs several worker processes, each owning a disjoint set of shards.
+
+  Every process only reads notifications from the shards assigned to it, so
+  processes never compete for the same notifications. A process that dies is
+  restarted with the same shards. If a process keeps dying, it is dropped and
+  the shards are redistributed over the remaining processes.
+  """
+
+  # Seconds between checks of the worker processes.
+  POLL_INTERVAL = 1
+
+  # A process that dies more than MAX_RESTARTS times within RESTART_WINDOW
+  # seconds is considered crash looping.
+  MAX_RESTARTS = 5
+  RESTART_WINDOW = 300
+
+  def __init__(self, num_processes, start_process, num_shards=None):
+    """Constructor.
+
+    Args:
+      num_processes: The number of worker processes to run.
+      start_process: A callable that takes a list of shard indices and returns
+        a started process object supporting poll(), terminate() and wait(),
+        e.g. a subprocess.Popen instance.
+      num_shards: The number of notification shards, defaults to
+        Worker.queue_shards.
+    """
+    if num_shards is None:
+      num_shards = config.CONFIG["Worker.queue_shards"]
+
+    self.num_shards = num_shards
+    self.start_process = start_process
+    self.assignment = AssignShards(num_shards, num_processes)
+    self.processes = []
+    self.restarts = []
+
+  def _StartProcess(self, shards):
+    logging.info("Starting worker process for shards %s.", shards)
+    return self.start_process(shards)
+
+  def Start(self):
+    """Starts one worker process per shard assignment."""
+    self.processes = [self._StartProcess(shards) for shards in self.assignment]
+    self.restarts = [[] for _ in self.processes]
+
+  def Stop(self):
+    """Terminates all worker processes."""
+    for process in self.processes:
+      if process.poll() is None:
+        process.terminate()
+    for process in self.processes:
+      process.wait()
+    self.processes = []
+
+  def CheckProcesses(self, now=None):
+    """Restarts dead processes and drops the ones that crash loop.
+
+    Args:
+      now: The current time, defaults to time.time().
+    """
+    if now is None:
+      now = time.time()
+
+    crash_looping = []
+    for i, process in enumerate(self.processes):
+      returncode = process.poll()
+      if returncode is None:
+        continue
+
+      logging.warning("Worker process for shards %s exited with code %s.",
+                      self.assignment[i], returncode)
+      stats.STATS.IncrementCounter("worker_process_restarts")
+
+      self.restarts[i] = [
+          t for t in self.restarts[i] if now - t < self.RESTART_WINDOW
+      ] + [now]
+      if len(self.restarts[i]) > self.MAX_RESTARTS and len(self.processes) > 1:
+        crash_looping.append(i)
+      else:
+        self.processes[i] = self._StartProcess(self.assignment[i])
+
+    if crash_looping:
+      self._Rebalance(crash_looping)
+
+  def _Rebalance(self, dropped):
+    """Redistributes all shards over the processes that are not dropped."""
+    logging.error("Dropping crash looping worker processes for shards %s.",
+                  [self.assignment[i] for i in dropped])
+
+    survivors = [
+        process for i, process in enumerate(self.processes) if i not in dropped
+    ]
+    old_assignment = [
+        shards for i, shards in enumerate(self.assignment) if i not in dropped
+    ]
+    new_assignment = AssignShards(self.num_shards, len(survivors))
+
+    # All processes whose shards change have to be gone before any new process
+    # starts, otherwise two processes could own the same shard for a while.
+    changed = [
+        i for i, shards in enumerate(new_assignment)
+        if shards != old_assignment[i]
+    ]
+    for i in changed:
+      if survivors[i].poll() is None:
+        survivors[i].terminate()
+      survivors[i].wait()
+    for i in changed:
+      survivors[i] = self._StartProcess(new_assignment[i])
+
+    self.processes = survivors
+    self.assignment = new_assignment
+    self.restarts = [[] for _ in self.processes]
+
+  def Run(self):
+    """Starts the worker processes and keeps them running."""
+    self.Start()
+    try:
+      while True:
+        time.sleep(self.POLL_INTERVAL)
+        self.CheckProcesses()
+    except KeyboardInterrupt:
+      logging.info("Caught interrupt, stopping worker processes.")
+    finally:
+      self.Stop()
+
 
 class WorkerInit(registry.InitHook):
   """Registers worker stats variables."""
@@ -363,3 +717,4 @@ class WorkerInit(registry.InitHook):
     stats.STATS.RegisterEventMetric(
         "worker_flow_processing_time", fields=[("flow", str)])
     stats.STATS.RegisterEventMetric("worker_time_to_retrieve_notifications")
+    stats.STATS.RegisterCounterMetric("worker_process_restarts")
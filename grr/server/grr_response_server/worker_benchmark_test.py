@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+"""End to end benchmarks of the frontend, queue and worker pipeline.
+
+A synthetic fleet of clients polls a FrontEndServer through
+HandleMessageBundles, answering every client request with a configurable
+number of responses, while a GRRWorker processes the flows. The benchmarks
+report flow throughput, flow latency and data store calls per flow. Data
+store backends are compared by running them through the subclasses in
+data_stores/*_benchmark_test.py.
+
+These tests are only run with --benchmark.
+"""
+
+import collections
+import random
+import threading
+import time
+
+
+import pytest
+
+from grr_response_client.client_actions import standard
+
+from grr import config
+from grr.lib import communicator
+from grr.lib import flags
+from grr.lib import queues
+from grr.lib import utils
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import protodict as rdf_protodict
+from grr.server.grr_response_server import data_store
+from grr.server.grr_response_server import flow
+from grr.server.grr_response_server import front_end
+from grr.server.grr_response_server import worker
+from grr.test_lib import benchmark_test_lib
+from grr.test_lib import test_lib
+
+# Maps the urns of finished benchmark flows to the time they finished.
+COMPLETION_TIMES = {}
+
+
+class BenchmarkFlowBase(flow.GRRFlow):
+  """Records when the flow finished."""
+
+  @flow.StateHandler()
+  def End(self):
+    COMPLETION_TIMES[self.urn] = time.time()
+
+
+class BenchmarkOneRequestFlow(BenchmarkFlowBase):
+  """Sends a single client request."""
+
+  @flow.StateHandler()
+  def Start(self):
+    self.CallClient(standard.ReadBuffer, offset=0, length=1, next_state="Done")
+
+  @flow.StateHandler()
+  def Done(self, responses):
+    pass
+
+
+class BenchmarkThreeStateFlow(BenchmarkFlowBase):
+  """Sends three client requests, one after the other."""
+
+  @flow.StateHandler()
+  def Start(self):
+    self.CallClient(
+        standard.ReadBuffer, offset=0, length=1, next_state="Second")
+
+  @flow.StateHandler()
+  def Second(self, responses):
+    self.CallClient(standard.ReadBuffer, offset=1, length=1, next_state="Third")
+
+  @flow.StateHandler()
+  def Third(self, responses):
+    self.CallClient(standard.ReadBuffer, offset=2, length=1, next_state="Done")
+
+  @flow.StateHandler()
+  def Done(self, responses):
+    pass
+
+
+class BenchmarkParallelRequestsFlow(BenchmarkFlowBase):
+  """Sends five client requests at once."""
+
+  @flow.StateHandler()
+  def Start(self):
+    for i in range(5):
+      self.CallClient(
+          standard.ReadBuffer, offset=i, length=1, next_state="Done")
+
+  @flow.StateHandler()
+  def Done(self, responses):
+    pass
+
+
+class PlaintextCommunicator(object):
+  """Stands in for the ServerCommunicator, without any encryption.
+
+  Message lists are only packed and compressed, so the benchmarks measure the
+  flow pipeline rather than the crypto, and need no client certificates.
+  """
+
+  def DecodeMessages(self, request_comms):
+    packed_message_list = rdf_flows.PackedMessageList.FromSerializedString(
+        request_comms.encrypted)
+    message_list = communicator.Communicator.DecompressMessageList(
+        packed_message_list)
+
+    messages = list(message_list.job)
+    for message in messages:
+      message.source = packed_message_list.source
+      message.auth_state = (
+          rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
+    return messages, packed_message_list.source, packed_message_list.timestamp
+
+  def EncodeMessages(self,
+                     message_list,
+                     result,
+                     destination=None,
+                     timestamp=None,
+                     api_version=3):
+    packed_message_list = rdf_flows.PackedMessageList(
+        source=destination, timestamp=timestamp)
+    communicator.Communicator.EncodeMessageList(message_list,
+                                                packed_message_list)
+    result.encrypted = packed_message_list.SerializeToString()
+    result.api_version = api_version
+    return timestamp
+
+
+class SimulatedClient(object):
+  """A client answering every request with fan_out responses and a status."""
+
+  def __init__(self, client_id, fan_out, response_size=100):
+    self.client_id = client_id
+    self.fan_out = fan_out
+    self.payload = rdf_protodict.DataBlob(data="x" * response_size)
+    self.requests = []
+
+  def _Responses(self):
+    for request in self.requests:
+      for i in range(self.fan_out):
+        yield rdf_flows.GrrMessage(
+            session_id=request.session_id,
+            request_id=request.request_id,
+            response_id=i + 1,
+            payload=self.payload)
+
+      yield rdf_flows.GrrMessage(
+          session_id=request.session_id,
+          request_id=request.request_id,
+          response_id=self.fan_out + 1,
+          task_id=request.task_id,
+          type=rdf_flows.GrrMessage.Type.STATUS,
+          payload=rdf_flows.GrrStatus())
+
+  def Poll(self, server):
+    """Sends the answers to the last requests, returns the number of new ones.
+
+    Args:
+      server: The FrontEndServer to poll.
+
+    Returns:
+      The number of requests received from the server.
+    """
+    message_list = rdf_flows.MessageList(job=list(self._Responses()))
+    packed_message_list = rdf_flows.PackedMessageList(
+        source=self.client_id, timestamp=int(time.time() * 1e6))
+    communicator.Communicator.EncodeMessageList(message_list,
+                                                packed_message_list)
+    request_comms = rdf_flows.ClientCommunication(
+        encrypted=packed_message_list.SerializeToString(), api_version=3)
+
+    response_comms = rdf_flows.ClientCommunication()
+    server.HandleMessageBundles(request_comms, response_comms)
+
+    messages, _, _ = server._communicator.DecodeMessages(response_comms)
+    self.requests = messages
+    return len(messages)
+
+
+class CountingDataStore(object):
+  """Counts the calls made to a data store."""
+
+  def __init__(self, delegate):
+    self.delegate = delegate
+    self.lock = threading.Lock()
+    self.calls = collections.Counter()
+
+  def __getattr__(self, name):
+    attribute = getattr(self.delegate, name)
+    if (not callable(attribute) or name.startswith("_") or
+        name == "GetMutationPool"):
+      return attribute
+
+    def Counted(*args, **kwargs):
+      with self.lock:
+        self.calls[name] += 1
+      return attribute(*args, **kwargs)
+
+    return Counted
+
+  def TotalCalls(self):
+    with self.lock:
+      return sum(self.calls.values())
+
+
+def Percentile(values, percentile):
+  """Returns the given percentile of a non empty list of values."""
+  values = sorted(values)
+  index = int(round((len(values) - 1) * percentile / 100.0))
+  return values[index]
+
+
+@pytest.mark.large
+class WorkerBenchmarks(benchmark_test_lib.MicroBenchmarks):
+  """Benchmarks processing flows for a synthetic fleet."""
+
+  units = "s"
+
+  # Relative frequency of the flows started on every client.
+  FLOW_MIX = {
+      BenchmarkOneRequestFlow.__name__: 6,
+      BenchmarkThreeStateFlow.__name__: 3,
+      BenchmarkParallelRequestsFlow.__name__: 1,
+  }
+
+  # The benchmark fails if the flows did not finish in this time.
+  TIMEOUT = 600
+
+  # Regression gate: the benchmark fails if processing a flow takes more data
+  # store calls than this on average. Unlike the timings, this does not depend
+  # on the machine the benchmark runs on.
+  MAX_DATA_STORE_CALLS_PER_FLOW = 150
+
+  def setUp(self):
+    super(WorkerBenchmarks, self).setUp(
+        ["Flows/s", "p50 latency (s)", "p99 latency (s)", "DB calls/flow"],
+        ["<10", "<17", "<17", "<15"])
+    self.rand = random.Random(42)
+    COMPLETION_TIMES.clear()
+
+    # The well known flows configured by default are not all available here.
+    self.config_overrider = test_lib.ConfigOverrider({
+        "Frontend.well_known_flows": []
+    })
+    self.config_overrider.Start()
+
+  def tearDown(self):
+    self.config_overrider.Stop()
+    super(WorkerBenchmarks, self).tearDown()
+
+  def _StartFlows(self, client_ids, flows_per_client, flow_mix):
+    """Starts flows drawn from flow_mix, returns their start times."""
+    names = []
+    for name, weight in sorted(flow_mix.iteritems()):
+      names.extend([name] * weight)
+
+    start_times = {}
+    for client_id in client_ids:
+      for _ in range(flows_per_client):
+        start_time = time.time()
+        session_id = flow.GRRFlow.StartFlow(
+            client_id=client_id,
+            flow_name=self.rand.choice(names),
+            token=self.token)
+        start_times[session_id] = start_time
+    return start_times
+
+  def _RunWorker(self, grr_worker):
+    processed = 0
+    while True:
+      count = grr_worker.RunOnce()
+      grr_worker.thread_pool.Join()
+      if not count:
+        return processed
+      processed += count
+
+  def RunFleet(self,
+               fleet_size,
+               flows_per_client=1,
+               fan_out=1,
+               flow_mix=None):
+    """Runs flows on a synthetic fleet and records the results.
+
+    Args:
+      fleet_size: The number of simulated clients.
+      flows_per_client: The number of flows started on every client.
+      fan_out: The number of responses clients send for every request.
+      flow_mix: A dict mapping flow names to their relative frequency,
+        defaults to FLOW_MIX.
+    """
+    flow_mix = flow_mix or self.FLOW_MIX
+    client_ids = self.SetupClients(fleet_size)
+
+    counting_store = CountingDataStore(data_store.DB)
+    with utils.Stubber(data_store, "DB", counting_store):
+      server = front_end.FrontEndServer(
+          certificate=config.CONFIG["Frontend.certificate"],
+          private_key=config.CONFIG["PrivateKeys.server_key"],
+          threadpool_prefix="pool-%s" % self._testMethodName)
+      server._communicator = PlaintextCommunicator()
+      grr_worker = worker.GRRWorker(queues=[queues.FLOWS], token=self.token)
+      clients = [SimulatedClient(c, fan_out) for c in client_ids]
+
+      start = time.time()
+      start_times = self._StartFlows(client_ids, flows_per_client, flow_mix)
+
+      while len(COMPLETION_TIMES) < len(start_times):
+        self.assertLess(time.time() - start, self.TIMEOUT,
+                        "Flows did not finish in time.")
+
+        requests = sum(client.Poll(server) for client in clients)
+        if not (self._RunWorker(grr_worker) or requests):
+          # Requests queued since the last poll might be hidden by the
+          # frontend's empty queue cache for a moment.
+          time.sleep(0.05)
+
+      elapsed = time.time() - start
+
+    flow_count = len(start_times)
+    latencies = [
+        COMPLETION_TIMES[session_id] - start_time
+        for session_id, start_time in start_times.iteritems()
+    ]
+    calls_per_flow = counting_store.TotalCalls() / float(flow_count)
+
+    self.AddResult(
+        "%d clients, %d flows, fan-out %d" % (fleet_size, flow_count, fan_out),
+        elapsed, flow_count, "%.1f" % (flow_count / elapsed),
+        "%.3f" % Percentile(latencies, 50), "%.3f" % Percentile(latencies, 99),
+        "%.1f" % calls_per_flow)
+
+    self.assertLessEqual(calls_per_flow, self.MAX_DATA_STORE_CALLS_PER_FLOW)
+
+  @pytest.mark.benchmark
+  def testSmallFleet(self):
+    """A few clients running a few flows each."""
+    self.RunFleet(fleet_size=10, flows_per_client=5)
+
+  @pytest.mark.benchmark
+  def testLargeFleet(self):
+    """Many clients running a single flow each."""
+    self.RunFleet(fleet_size=200)
+
+  @pytest.mark.benchmark
+  def testLargeFanOut(self):
+    """Clients sending many responses for every request."""
+    self.RunFleet(fleet_size=10, flows_per_client=5, fan_out=100)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -20,8 +20,9 @@ class MockThreadPool(object):
   def __init__(self, *_):
     pass
 
-  def AddTask(self, target, args, name="Unnamed task"):
+  def AddTask(self, target, args, name="Unnamed task", task_class=None):
     _ = name
+    _ = task_class
     try:
       target(*args)
       # The real threadpool can not raise from a task. We emulate this here.
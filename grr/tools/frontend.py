@@ -2,10 +2,15 @@
 """This is the GRR frontend HTTP Server."""
 
 
+import asynchat
+import asyncore
 import BaseHTTPServer
 import cgi
+import collections
 import cStringIO
 import logging
+import mimetools
+import os
 import pdb
 import socket
 import SocketServer
@@ -30,8 +35,10 @@ from grr.lib.rdfvalues import flows as rdf_flows
 from grr.server.grr_response_server import aff4
 from grr.server.grr_response_server import front_end
 from grr.server.grr_response_server import master
+from grr.server.grr_response_server import process_pool
 from grr.server.grr_response_server import server_logging
 from grr.server.grr_response_server import server_startup
+from grr.server.grr_response_server import threadpool
 
 
 class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
@@ -41,7 +48,8 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       200: "200 OK",
       404: "404 Not Found",
       406: "406 Not Acceptable",
-      500: "500 Internal Server Error"
+      500: "500 Internal Server Error",
+      503: "503 Service Unavailable"
   }
 
   active_counter_lock = threading.Lock()
@@ -305,6 +313,22 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             "frontend_active_count", self.active_counter, fields=["http"])
 
 
+def _CreateFrontEndServer():
+  return front_end.FrontEndServer(
+      certificate=config.CONFIG["Frontend.certificate"],
+      private_key=config.CONFIG["PrivateKeys.server_key"],
+      max_queue_size=config.CONFIG["Frontend.max_queue_size"],
+      message_expiry_time=config.CONFIG["Frontend.message_expiry_time"],
+      max_retransmission_time=config.CONFIG["Frontend.max_retransmission_time"])
+
+
+def _AddressFamily(server_address):
+  (address, _) = server_address
+  if ipaddr.IPAddress(address).version == 4:
+    return socket.AF_INET
+  return socket.AF_INET6
+
+
 class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
   """The GRR HTTP frontend server."""
 
@@ -317,30 +341,253 @@ class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     stats.STATS.SetGaugeValue("frontend_max_active_count",
                               self.request_queue_size)
 
-    if frontend:
-      self.frontend = frontend
-    else:
-      self.frontend = front_end.FrontEndServer(
-          certificate=config.CONFIG["Frontend.certificate"],
-          private_key=config.CONFIG["PrivateKeys.server_key"],
-          max_queue_size=config.CONFIG["Frontend.max_queue_size"],
-          message_expiry_time=config.CONFIG["Frontend.message_expiry_time"],
-          max_retransmission_time=config.CONFIG[
-              "Frontend.max_retransmission_time"])
+    self.frontend = frontend or _CreateFrontEndServer()
     self.server_cert = config.CONFIG["Frontend.certificate"]
-
-    (address, _) = server_address
-    version = ipaddr.IPAddress(address).version
-    if version == 4:
-      self.address_family = socket.AF_INET
-    elif version == 6:
-      self.address_family = socket.AF_INET6
+    self.address_family = _AddressFamily(server_address)
 
     logging.info("Will attempt to listen on %s", server_address)
     BaseHTTPServer.HTTPServer.__init__(self, server_address, handler, *args,
                                        **kwargs)
 
 
+class BufferedGRRHTTPServerHandler(GRRHTTPServerHandler):
+  """Handles a request which was read completely by the event loop.
+
+  The request is read from and the response is written to memory, so the
+  handler can run on a thread pool without using the client connection.
+  """
+
+  def setup(self):
+    self.connection = None
+    self.rfile = cStringIO.StringIO(self.request)
+    self.wfile = cStringIO.StringIO()
+
+  def finish(self):
+    pass
+
+
+def _SimpleResponse(status, message):
+  return ("HTTP/1.0 %s\r\n"
+          "Server: GRR Server\r\n"
+          "Content-type: text/plain\r\n"
+          "Content-Length: %d\r\n"
+          "\r\n"
+          "%s") % (GRRHTTPServerHandler.statustext[status], len(message),
+                   message)
+
+
+class _HTTPChannel(asynchat.async_chat):
+  """Reads a single request from a client connection."""
+
+  # Connections sending larger headers than this are dropped.
+  MAX_HEADER_SIZE = 64 * 1024
+
+  def __init__(self, server, sock, client_address):
+    asynchat.async_chat.__init__(self, sock=sock, map=server.socket_map)
+    self.server = server
+    self.client_address = client_address
+    self.header = None
+    self.data = []
+    self.data_size = 0
+    self.dispatched = False
+    self.set_terminator("\r\n\r\n")
+
+  def collect_incoming_data(self, data):
+    if self.dispatched:
+      return
+
+    self.data.append(data)
+    self.data_size += len(data)
+    if self.header is None and self.data_size > self.MAX_HEADER_SIZE:
+      logging.info("Dropping connection from %s: Header too large.",
+                   self.client_address[0])
+      self.close()
+
+  def found_terminator(self):
+    if self.header is None:
+      self.header = "".join(self.data) + "\r\n\r\n"
+      self.data = []
+      content_length = self._ContentLength()
+      if content_length > 0:
+        self.set_terminator(content_length)
+        return
+
+    request = self.header + "".join(self.data)
+    self.data = []
+    self.dispatched = True
+    self.set_terminator(None)
+    self.server.Dispatch(self, request)
+
+  def _ContentLength(self):
+    _, _, headers = self.header.partition("\r\n")
+    message = mimetools.Message(cStringIO.StringIO(headers))
+    try:
+      return int(message.getheader("content-length", 0))
+    except ValueError:
+      return 0
+
+  def handle_error(self):
+    logging.exception("Error on connection from %s.", self.client_address[0])
+    self.close()
+
+
+class _ResponseTrigger(asyncore.file_dispatcher):
+  """Hands responses from the thread pool to the event loop.
+
+  Responses are queued by the pool threads, which then wake up the event loop
+  by writing to a pipe it watches.
+  """
+
+  def __init__(self, socket_map):
+    read_fd, self.write_fd = os.pipe()
+    asyncore.file_dispatcher.__init__(self, read_fd, map=socket_map)
+    # The dispatcher uses a copy of the file descriptor.
+    os.close(read_fd)
+    self.lock = threading.Lock()
+    self.responses = collections.deque()
+
+  def Send(self, channel, response):
+    """Sends a response on a connection, can be called from any thread."""
+    with self.lock:
+      self.responses.append((channel, response))
+    self.Wake()
+
+  def Wake(self):
+    os.write(self.write_fd, "x")
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    self.recv(8192)
+    with self.lock:
+      responses = list(self.responses)
+      self.responses.clear()
+
+    for channel, response in responses:
+      # The client might have given up in the meantime.
+      if channel.connected:
+        channel.push(response)
+        channel.close_when_done()
+
+  def close(self):
+    asyncore.file_dispatcher.close(self)
+    os.close(self.write_fd)
+
+
+class AsyncGRRHTTPServer(asyncore.dispatcher):
+  """An event loop based GRR HTTP frontend server.
+
+  A single thread accepts all client connections, reads the requests and
+  writes the responses, so idle or slow connections do not take up a thread
+  each. Complete requests are handled by GRRHTTPServerHandler on a bounded
+  thread pool. While the pool is saturated, no new connections are accepted
+  and requests arriving on open connections are answered with a 503, which
+  clients retry later.
+  """
+
+  request_queue_size = 500
+
+  def __init__(self, server_address, frontend=None, threads=None):
+    """Constructor.
+
+    Args:
+      server_address: The (address, port) to listen on.
+      frontend: The FrontEndServer handling the client messages, a new one is
+        created if not given.
+      threads: The number of threads handling requests, defaults to
+        Frontend.event_loop_threads.
+    """
+    self.socket_map = {}
+    asyncore.dispatcher.__init__(self, map=self.socket_map)
+
+    self.frontend = frontend or _CreateFrontEndServer()
+    self.server_cert = config.CONFIG["Frontend.certificate"]
+    self.stopped = threading.Event()
+    self.running = False
+
+    threads = threads or config.CONFIG["Frontend.event_loop_threads"]
+    stats.STATS.SetGaugeValue("frontend_max_active_count", threads)
+    self.pool = threadpool.ThreadPool.Factory(
+        "grr_frontend_http_%d" % server_address[1], threads,
+        max_threads=threads)
+    self.pool.Start()
+
+    logging.info("Will attempt to listen on %s", server_address)
+    try:
+      self.create_socket(_AddressFamily(server_address), socket.SOCK_STREAM)
+      self.set_reuse_addr()
+      self.bind(server_address)
+      self.listen(self.request_queue_size)
+    except socket.error:
+      self.close()
+      self.pool.Stop()
+      raise
+
+    self.trigger = _ResponseTrigger(self.socket_map)
+
+  def Saturated(self):
+    return self.pool.pending_tasks >= self.pool.max_threads
+
+  def readable(self):
+    # Leave new connections in the listen backlog while the pool is busy.
+    return self.accepting and not self.Saturated()
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is not None:
+      sock, client_address = pair
+      _HTTPChannel(self, sock, client_address)
+
+  def Dispatch(self, channel, request):
+    """Hands a complete request to the thread pool."""
+    try:
+      self.pool.AddTask(
+          target=self._HandleRequest,
+          args=(channel, request),
+          name="HandleRequest",
+          blocking=False,
+          inline=False)
+    except threadpool.Full:
+      stats.STATS.IncrementCounter(
+          "frontend_rejected_request_count", fields=["http"])
+      channel.push(_SimpleResponse(503, "Server busy, try again later."))
+      channel.close_when_done()
+
+  def _HandleRequest(self, channel, request):
+    try:
+      handler = BufferedGRRHTTPServerHandler(request, channel.client_address,
+                                             self)
+      response = handler.wfile.getvalue()
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error handling request: %s", e)
+      response = _SimpleResponse(500, "Error: %s" % e)
+
+    self.trigger.Send(channel, response)
+
+  def handle_error(self):
+    logging.exception("Error in the frontend event loop.")
+
+  def serve_forever(self, poll_interval=0.5):
+    """Runs the event loop until shutdown() is called."""
+    self.running = True
+    self.stopped.clear()
+    try:
+      while self.running:
+        asyncore.loop(
+            timeout=poll_interval, map=self.socket_map, use_poll=True, count=1)
+    finally:
+      asyncore.close_all(map=self.socket_map)
+      self.pool.Stop()
+      self.stopped.set()
+
+  def shutdown(self):
+    """Stops the event loop and waits for it to finish."""
+    self.running = False
+    self.trigger.Wake()
+    self.stopped.wait()
+
+
 def CreateServer(frontend=None):
   """Start frontend http server."""
   max_port = config.CONFIG.Get("Frontend.port_max",
@@ -350,8 +597,11 @@ def CreateServer(frontend=None):
 
     server_address = (config.CONFIG["Frontend.bind_address"], port)
     try:
-      httpd = GRRHTTPServer(
-          server_address, GRRHTTPServerHandler, frontend=frontend)
+      if config.CONFIG["Frontend.event_loop"]:
+        httpd = AsyncGRRHTTPServer(server_address, frontend=frontend)
+      else:
+        httpd = GRRHTTPServer(
+            server_address, GRRHTTPServerHandler, frontend=frontend)
       break
     except socket.error as e:
       if e.errno == socket.errno.EADDRINUSE and port < max_port:
@@ -371,6 +621,14 @@ def main(argv):
 
   server_startup.Init()
 
+  # The pool processes are forked after Init(), which already started the
+  # stats server and other background threads, but before the frontend starts
+  # its own. Only the forking thread exists in the pool processes, so they
+  # must only run self contained functions like
+  # communicator.DecryptMessageList(), which use no connections and take no
+  # locks other than the logging and stats locks the pool recreates.
+  process_pool.Start(config.CONFIG["Frontend.process_pool_size"])
+
   httpd = CreateServer()
 
   server_startup.DropPrivileges()
@@ -379,6 +637,9 @@ def main(argv):
     httpd.serve_forever()
   except KeyboardInterrupt:
     print "Caught keyboard interrupt, stopping"
+  finally:
+    httpd.frontend.Stop()
+    process_pool.Stop()
 
 
 if __name__ == "__main__":
@@ -21,6 +21,7 @@ from grr.lib.rdfvalues import rekall_types as rdf_rekall_types
 from grr.server.grr_response_server import aff4
 from grr.server.grr_response_server import flow
 from grr.server.grr_response_server import front_end
+from grr.server.grr_response_server import threadpool
 from grr.server.grr_response_server.aff4_objects import aff4_grr
 from grr.server.grr_response_server.aff4_objects import filestore
 from grr.server.grr_response_server.flows.general import file_finder
@@ -53,8 +54,7 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     # Bring up a local server for testing.
     port = portpicker.PickUnusedPort()
     ip = utils.ResolveHostnameToIP("localhost", port)
-    cls.httpd = frontend.GRRHTTPServer((ip, port),
-                                       frontend.GRRHTTPServerHandler)
+    cls.httpd = cls.CreateHTTPServer((ip, port))
 
     if ipaddr.IPAddress(ip).version == 6:
       cls.address_family = socket.AF_INET6
@@ -72,6 +72,11 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     cls.httpd.shutdown()
     cls.config_overrider.Stop()
 
+  @classmethod
+  def CreateHTTPServer(cls, server_address):
+    return frontend.GRRHTTPServer(server_address,
+                                  frontend.GRRHTTPServerHandler)
+
   def setUp(self):
     super(GRRHTTPServerTest, self).setUp()
     self.client_id = self.SetupClient(0)
@@ -281,6 +286,52 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     self.assertEqual(profile.data[:2], "\x1f\x8b")
 
 
+class AsyncGRRHTTPServerTest(GRRHTTPServerTest):
+  """Test the event loop based http server."""
+
+  @classmethod
+  def CreateHTTPServer(cls, server_address):
+    return frontend.AsyncGRRHTTPServer(server_address, threads=2)
+
+  def _Connect(self):
+    _, port = self.httpd.socket.getsockname()[:2]
+    sock = socket.socket(self.address_family, socket.SOCK_STREAM)
+    sock.connect((utils.ResolveHostnameToIP("localhost", port), port))
+    return sock
+
+  def testIdleConnectionsDoNotBlockRequests(self):
+    idle_connections = []
+    for _ in range(10):
+      sock = self._Connect()
+      sock.sendall("POST /control HTTP/1.0\r\n")
+      idle_connections.append(sock)
+
+    req = requests.get(self.base_url + "server.pem")
+    self.assertEqual(req.status_code, 200)
+    self.assertTrue("BEGIN CERTIFICATE" in req.content)
+
+    for sock in idle_connections:
+      sock.close()
+
+  def testRequestsAreRejectedWhileThePoolIsFull(self):
+
+    def FullAddTask(*unused_args, **unused_kwargs):
+      raise threadpool.Full()
+
+    with utils.Stubber(self.httpd.pool, "AddTask", FullAddTask):
+      req = requests.get(self.base_url + "server.pem")
+
+    self.assertEqual(req.status_code, 503)
+
+    req = requests.get(self.base_url + "server.pem")
+    self.assertEqual(req.status_code, 200)
+
+  def testNoConnectionsAreAcceptedWhileThePoolIsSaturated(self):
+    with utils.Stubber(self.httpd, "Saturated", lambda: True):
+      self.assertFalse(self.httpd.readable())
+    self.assertTrue(self.httpd.readable())
+
+
 def main(args):
   test_lib.main(args)
 
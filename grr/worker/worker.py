@@ -4,6 +4,8 @@
 We basically pull a new task from the task master, and run the plugin
 it specifies.
 """
+import subprocess
+import sys
 
 
 # pylint: disable=unused-import,g-bad-import-order
@@ -15,9 +17,31 @@ from grr.config import contexts
 from grr.lib import flags
 from grr.server.grr_response_server import access_control
 from grr.server.grr_response_server import fleetspeak_connector
+from grr.server.grr_response_server import process_pool
 from grr.server.grr_response_server import server_startup
 from grr.server.grr_response_server import worker
 
+flags.DEFINE_integer(
+    "worker_processes", 1,
+    "Number of worker processes to run. With more than one process, each "
+    "process owns a disjoint set of notification shards.")
+
+flags.DEFINE_list(
+    "worker_shards", [],
+    "Comma separated notification shard indices this worker reads from. "
+    "Set by the worker supervisor, empty means all shards.")
+
+
+def StartWorkerProcess(shards):
+  """Starts a single worker process owning the given shards."""
+  # The child is a fresh interpreter rather than a fork, so it does not
+  # inherit the supervisor's threads and data store connections.
+  args = [sys.executable] + sys.argv + [
+      "--worker_processes=1",
+      "--worker_shards=%s" % ",".join(str(s) for s in shards)
+  ]
+  return subprocess.Popen(args)
+
 
 def main(argv):
   """Main."""
@@ -28,10 +52,24 @@ def main(argv):
   # Initialise flows and config_lib
   server_startup.Init()
 
+  if flags.FLAGS.worker_processes > 1:
+    supervisor = worker.GRRWorkerSupervisor(flags.FLAGS.worker_processes,
+                                            StartWorkerProcess)
+    supervisor.Run()
+    return
+
+  # The pool is forked before the fleetspeak connector and the worker start
+  # their threads, but after Init() started the stats server. Only the forking
+  # thread exists in the pool processes, so they must only run functions like
+  # artifact.ParseResponses() and checks.CheckHost(), which work on their
+  # arguments alone, use no data store connections and take no locks other
+  # than the logging and stats locks the pool recreates.
+  process_pool.Start(config.CONFIG["Worker.process_pool_size"])
   fleetspeak_connector.Init()
 
+  queue_shards = [int(shard) for shard in flags.FLAGS.worker_shards] or None
   token = access_control.ACLToken(username="GRRWorker").SetUID()
-  worker_obj = worker.GRRWorker(token=token)
+  worker_obj = worker.GRRWorker(token=token, queue_shards=queue_shards)
   worker_obj.Run()
 
 
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 """Tests for the worker."""
 
+import collections
 import threading
 import time
 
@@ -19,6 +20,7 @@ from grr.server.grr_response_server import data_store
 from grr.server.grr_response_server import flow
 from grr.server.grr_response_server import flow_runner
 from grr.server.grr_response_server import front_end
+from grr.server.grr_response_server import notification_bus
 from grr.server.grr_response_server import queue_manager
 from grr.server.grr_response_server import worker
 from grr.server.grr_response_server.flows.general import administrative
@@ -215,7 +217,8 @@ class ShardedQueueManager(queue_manager.QueueManager):
   at its own shard. This class gives the worker visibility across all shards.
   """
 
-  def GetNotificationsByPriority(self, queue):
+  def GetNotificationsByPriority(self, queue, shard_indices=None):
+    del shard_indices  # Unused.
     return self.GetNotificationsByPriorityForAllShards(queue)
 
   def GetNotifications(self, queue):
@@ -342,6 +345,107 @@ class GrrWorkerTest(flow_test_lib.FlowTestsBaseclass):
         flow_obj.context.state == rdf_flows.FlowContext.State.TERMINATED)
     self.assertEqual(flow_obj.context.current_state, "End")
 
+  def testFlowsAreLockedAndReadInBatches(self):
+    session_ids = []
+    for _ in range(3):
+      flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+      session_ids.append(flow_obj.session_id)
+      flow_obj.Close()
+
+    for i, session_id in enumerate(session_ids):
+      self.SendResponse(session_id, "Hello%d" % i)
+
+    worker_obj = worker.GRRWorker(token=self.token)
+    db = data_store.DB
+    with mock.patch.object(
+        db, "MultiDBSubjectLock", wraps=db.MultiDBSubjectLock) as lock_mock:
+      with mock.patch.object(
+          db, "ReadCompletedRequests",
+          wraps=db.ReadCompletedRequests) as read_mock:
+        worker_obj.RunOnce()
+        worker_obj.thread_pool.Join()
+
+    self.assertEqual(sorted(RESULTS), ["Hello0", "Hello1", "Hello2"])
+    # All flows were locked at once and their requests were prefetched.
+    self.assertEqual(lock_mock.call_count, 1)
+    self.assertEqual(read_mock.call_count, 0)
+
+    for session_id in session_ids:
+      flow_obj = aff4.FACTORY.Open(session_id, token=self.token)
+      self.assertEqual(flow_obj.context.state,
+                       rdf_flows.FlowContext.State.TERMINATED)
+
+  def testFlowsAreOnlyLockedWhenThePoolCanStartThem(self):
+    session_ids = []
+    for _ in range(3):
+      flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+      session_ids.append(flow_obj.session_id)
+      flow_obj.Close()
+
+    for i, session_id in enumerate(session_ids):
+      self.SendResponse(session_id, "Hello%d" % i)
+
+    worker_obj = worker.GRRWorker(token=self.token)
+    db = data_store.DB
+    # The pool has room for two tasks, then it is full.
+    with mock.patch.object(
+        worker_obj.thread_pool, "FreeCapacity", side_effect=[2, 0]):
+      with mock.patch.object(
+          db, "MultiDBSubjectLock", wraps=db.MultiDBSubjectLock) as lock_mock:
+        worker_obj.RunOnce()
+        worker_obj.thread_pool.Join()
+
+    self.assertEqual(sorted(RESULTS), ["Hello0", "Hello1", "Hello2"])
+    self.assertEqual(lock_mock.call_count, 1)
+    self.assertEqual(len(lock_mock.call_args[0][0]), 2)
+
+  def testPrefetchStopsOnceTheBudgetIsUsed(self):
+    first = rdfvalue.SessionID(queue=queues.FLOWS, flow_name="First")
+    second = rdfvalue.SessionID(queue=queues.FLOWS, flow_name="Second")
+
+    def Completed(session_id, request_id, response_count):
+      return (rdf_flows.RequestState(id=request_id, session_id=session_id),
+              rdf_flows.GrrMessage(response_id=response_count))
+
+    # The first flow does not fit completely, the second one would.
+    completed = collections.OrderedDict([
+        (first, [Completed(first, 1, 2), Completed(first, 2, 2)]),
+        (second, [Completed(second, 1, 1)]),
+    ])
+    read_requests = []
+
+    def ReadResponses(requests):
+      read_requests.extend(requests)
+      return []
+
+    worker_obj = worker.GRRWorker(token=self.token)
+    with utils.MultiStubber(
+        (worker_obj, "PREFETCH_RESPONSES_LIMIT", 3),
+        (data_store.DB, "MultiReadCompletedRequests", lambda *_: completed),
+        (data_store.DB, "ReadResponses", ReadResponses)):
+      # pylint: disable=protected-access
+      prefetched = worker_obj._PrefetchCompletedRequests([
+          rdf_flows.GrrNotification(session_id=first, timestamp=100),
+          rdf_flows.GrrNotification(session_id=second, timestamp=100)
+      ])
+
+    self.assertEqual([(r.session_id, r.id) for r in read_requests],
+                     [(first, 1)])
+    self.assertEqual(sorted(prefetched), sorted([first, second]))
+
+  def testLockedFlowsAreSkippedInBatches(self):
+    flow_obj = self.FlowSetup("WorkerSendingTestFlow2")
+    session_id = flow_obj.session_id
+    flow_obj.Close()
+    self.SendResponse(session_id, "Hello")
+
+    worker_obj = worker.GRRWorker(token=self.token)
+    with aff4.FACTORY.OpenWithLock(session_id, token=self.token):
+      worker_obj.RunOnce()
+      worker_obj.thread_pool.Join()
+
+    self.assertEqual(RESULTS, [])
+
   def testNoNotificationRescheduling(self):
     """Test that no notifications are rescheduled when a flow raises."""
 
@@ -1113,6 +1217,116 @@ class GrrWorkerTest(flow_test_lib.FlowTestsBaseclass):
     # Server side out of cpu.
     self.assertIn("Out of CPU quota", errors[1].backtrace)
 
+  def testWakeUpsScanThePublishedShards(self):
+    bus = notification_bus.LocalNotificationBus()
+    worker_obj = worker.GRRWorker(token=self.token, queue_shards=[1, 3])
+    scanned = []
+
+    def RunOnce(shard_indices=None):
+      scanned.append(shard_indices)
+      if len(scanned) == 1:
+        for shard in ["3", "2", "1"]:
+          bus.Publish(queues.FLOWS.Add(shard))
+      elif len(scanned) == 4:
+        raise KeyboardInterrupt()
+      return 0
+
+    with utils.MultiStubber((notification_bus, "BUS", bus),
+                            (worker_obj, "RunOnce", RunOnce),
+                            (worker_obj, "POLLING_INTERVAL", 0)):
+      worker_obj.Run()
+
+    # Shard 2 is owned by another worker.
+    self.assertEqual(scanned, [None, [1], [3], None])
+
+
+class FakeWorkerProcess(object):
+  """A stand in for a worker subprocess."""
+
+  def __init__(self, shards):
+    self.shards = shards
+    self.returncode = None
+
+  def poll(self):
+    return self.returncode
+
+  def terminate(self):
+    self.returncode = -15
+
+  def wait(self):
+    return self.returncode
+
+
+class GRRWorkerSupervisorTest(test_lib.GRRBaseTest):
+  """Tests for the multi process worker supervisor."""
+
+  def setUp(self):
+    super(GRRWorkerSupervisorTest, self).setUp()
+    self.started = []
+
+  def StartProcess(self, shards):
+    process = FakeWorkerProcess(shards)
+    self.started.append(process)
+    return process
+
+  def testAssignShards(self):
+    self.assertEqual(worker.AssignShards(5, 2), [[0, 2, 4], [1, 3]])
+    self.assertEqual(worker.AssignShards(3, 3), [[0], [1], [2]])
+    # Never more processes than shards.
+    self.assertEqual(worker.AssignShards(2, 4), [[0], [1]])
+    self.assertEqual(worker.AssignShards(1, 1), [[0]])
+
+  def testDeadProcessIsRestartedWithTheSameShards(self):
+    supervisor = worker.GRRWorkerSupervisor(
+        2, self.StartProcess, num_shards=4)
+    supervisor.Start()
+    self.assertEqual([p.shards for p in self.started], [[0, 2], [1, 3]])
+
+    self.started[1].returncode = 1
+    supervisor.CheckProcesses(now=100)
+
+    self.assertEqual(len(self.started), 3)
+    self.assertEqual(self.started[2].shards, [1, 3])
+    self.assertEqual(supervisor.processes, [self.started[0], self.started[2]])
+
+  def testCrashLoopingProcessShardsAreRebalanced(self):
+    supervisor = worker.GRRWorkerSupervisor(
+        3, self.StartProcess, num_shards=3)
+    supervisor.Start()
+
+    for i in range(supervisor.MAX_RESTARTS + 1):
+      supervisor.processes[2].returncode = 1
+      supervisor.CheckProcesses(now=100 + i)
+
+    self.assertEqual(len(supervisor.processes), 2)
+    self.assertEqual(supervisor.assignment, [[0, 2], [1]])
+    self.assertEqual([p.shards for p in supervisor.processes], [[0, 2], [1]])
+    # The process that got a new shard was restarted, the other one was not.
+    self.assertEqual(self.started[0].returncode, -15)
+    self.assertIsNone(self.started[1].returncode)
+    self.assertIs(supervisor.processes[1], self.started[1])
+
+  def testRestartsOutsideTheWindowAreForgotten(self):
+    supervisor = worker.GRRWorkerSupervisor(
+        2, self.StartProcess, num_shards=2)
+    supervisor.Start()
+
+    for i in range(supervisor.MAX_RESTARTS * 2):
+      supervisor.processes[1].returncode = 1
+      supervisor.CheckProcesses(now=i * supervisor.RESTART_WINDOW)
+
+    self.assertEqual(supervisor.assignment, [[0], [1]])
+    self.assertEqual(len(supervisor.processes), 2)
+
+  def testStopTerminatesAllProcesses(self):
+    supervisor = worker.GRRWorkerSupervisor(
+        2, self.StartProcess, num_shards=2)
+    supervisor.Start()
+    supervisor.Stop()
+
+    self.assertEqual([p.returncode for p in self.started], [-15, -15])
+    self.assertEqual(supervisor.processes, [])
+
 
 def main(argv):
   test_lib.main(argv)